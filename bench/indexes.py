@@ -0,0 +1,112 @@
+"""
+Measure the node table indexes on a generated tree.
+
+    PYTHONPATH=. python bench/indexes.py -d "dbname=minitree" \
+        [--depth 6] [--repeat 20]
+
+A tree with a fanout of 10 is loaded into a scratch schema (--depth 6
+makes 1,111,111 nodes). The queries behind descendants, ancestors,
+children, search and override are timed before and after the indexes
+of minitree.db.postgres.Postgres.nodeIndexes are built.
+"""
+from optparse import OptionParser
+from minitree.db.postgres import Postgres
+import os
+import psycopg2
+import sys
+import time
+
+schema = "minitree_bench"
+table = "nodes"
+
+fillSQL = r"INSERT INTO %s(node_path, node_value) \
+SELECT text2ltree(substr(regexp_replace(lpad(i::text, %d, '0'), \
+'(.)', '.n\1', 'g'), 2)), hstore('i', i::text) \
+FROM generate_series(0, %d) AS i"
+
+
+def _path(digits):
+    return ".".join("n%s" % x for x in digits)
+
+
+def queries(backend, depth):
+    leaf = _path("123456789"[:depth])
+    middle = _path("123456789"[:depth // 2])
+    return [
+        ("descendants", backend.selectDescentantsSQL, dict(node_path=middle)),
+        ("ancestors", backend.selectAncestorSQL, dict(node_path=leaf)),
+        ("children", backend.selectChildrenSQL, dict(node_path=middle)),
+        ("search", backend.searchNodeSQL, dict(q="n1.*.n9")),
+        ("override", backend.selectOverrideSQL, dict(node_path=leaf)),
+    ]
+
+
+def run(cursor, tablename, tests, repeat):
+    results = dict()
+    for name, sql, params in tests:
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            cursor.execute(sql % tablename, params)
+            cursor.fetchall()
+            timings.append(time.time() - start)
+        timings.sort()
+        results[name] = timings[len(timings) // 2]
+    return results
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-d", "--dsn", default=os.environ.get("MINITREE_DSN"),
+                      help="Database to run in (default $MINITREE_DSN).")
+    parser.add_option("--depth", type="int", default=6,
+                      help="Depth of the generated tree.")
+    parser.add_option("--repeat", type="int", default=20,
+                      help="Runs per query, the median is reported.")
+    parser.add_option("--keep", action="store_true", default=False,
+                      help="Keep the generated table.")
+    options, args = parser.parse_args(argv)
+    if not options.dsn:
+        parser.error("a dsn is required")
+
+    backend = Postgres()
+    tablename = backend._buildTableName(schema, table)
+    conn = psycopg2.connect(options.dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+        cursor.execute(backend.createSchemaSQL % schema)
+        cursor.execute(backend.createTableSQL % tablename)
+        cursor.execute(backend.initTableSQL % tablename)
+        start = time.time()
+        for level in range(1, options.depth + 1):
+            cursor.execute(fillSQL % (tablename, level, 10 ** level - 1))
+        cursor.execute("ANALYZE %s" % tablename)
+        cursor.execute("SELECT count(*) FROM %s" % tablename)
+        sys.stdout.write("loaded %d nodes in %.1fs\n"
+                         % (cursor.fetchone()[0], time.time() - start))
+
+        tests = queries(backend, options.depth)
+        before = run(cursor, tablename, tests, options.repeat)
+        start = time.time()
+        for sql in backend._createIndexSQL(schema, table):
+            cursor.execute(sql)
+        cursor.execute("ANALYZE %s" % tablename)
+        sys.stdout.write("built indexes in %.1fs\n" % (time.time() - start))
+        after = run(cursor, tablename, tests, options.repeat)
+
+        sys.stdout.write("%-12s %12s %12s %9s\n"
+                         % ("query", "before (ms)", "after (ms)", "speedup"))
+        for name, _, _ in tests:
+            sys.stdout.write("%-12s %12.2f %12.2f %8.1fx\n" % (
+                    name, before[name] * 1000, after[name] * 1000,
+                    before[name] / max(after[name], 1e-6)))
+    finally:
+        if not options.keep:
+            cursor.execute("DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""
+Load test a minitree server with a mixed workload.
+
+    PYTHONPATH=. python bench/loadtest.py [--dsn DSN] [--depth 4] \
+        [--fanout 10] [--width 8] [--concurrency 16] [--duration 30] \
+        [--mix select=40,override=20,...] [--set backend:main.cache_size=0] \
+        [--output result.json] [--compare baseline.json]
+
+Without --dsn a throwaway cluster is created with initdb and pg_ctl,
+which must be on $PATH. A tree of fanout ** depth nodes, each holding
+`width` keys, is imported into bench.tree, then the minitree twistd
+plugin is started on a free port and hammered by `concurrency` worker
+processes for `duration` seconds.
+
+With --set backend:main.type=memory no database is needed: the tree is
+imported into the in-memory backend of the server over HTTP instead.
+
+The result is a JSON document with requests per second and latency
+percentiles (in milliseconds) per method. The dataset and the request
+sequence only depend on the options and --seed, so runs of two commits
+with the same options are comparable; --compare exits with status 1 if
+any method lost more than --threshold percent of throughput or p95.
+"""
+from optparse import OptionParser
+from minitree.db import bulk
+from minitree.db.postgres import Postgres
+from multiprocessing import Process, Queue
+import httplib
+import json
+import os
+import psycopg2
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+defaultMix = "select=40,override=20,combo=10,descendants=10,search=5,write=15"
+
+
+def _freePort():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _waitPort(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with %d" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start listening on %d" % port)
+
+
+class Cluster(object):
+    """
+    A temporary Postgres cluster listening on a unix socket only.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.port = _freePort()
+        self.dsn = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="minitree-pg-")
+        data = os.path.join(self.directory, "data")
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["initdb", "-D", data, "-A", "trust",
+                                   "-U", "minitree"],
+                                  stdout=devnull, stderr=devnull)
+            subprocess.check_call([
+                    "pg_ctl", "-D", data, "-w", "-l",
+                    os.path.join(self.directory, "postgres.log"), "-o",
+                    "-p %d -k %s -c listen_addresses=''" % (
+                        self.port, self.directory), "start"],
+                                  stdout=devnull)
+        conn = psycopg2.connect(host=self.directory, port=self.port,
+                                user="minitree", dbname="postgres")
+        conn.autocommit = True
+        conn.cursor().execute("CREATE DATABASE minitree")
+        conn.close()
+        self.dsn = "host=%s port=%d user=minitree dbname=minitree" % (
+            self.directory, self.port)
+
+    def stop(self):
+        if self.directory is None:
+            return
+        with open(os.devnull, "w") as devnull:
+            subprocess.call(["pg_ctl", "-D",
+                             os.path.join(self.directory, "data"),
+                             "-m", "fast", "stop"], stdout=devnull)
+        shutil.rmtree(self.directory, True)
+        self.directory = None
+
+
+class Server(object):
+    """
+    The minitree twistd plugin running in a subprocess.
+    """
+
+    def __init__(self, dsn, settings):
+        self.dsn = dsn
+        self.settings = settings
+        self.port = _freePort()
+        self.directory = None
+        self.process = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="minitree-bench-")
+        config = os.path.join(self.directory, "minitree.ini")
+        sections = {"server:main": {}, "backend:main": {
+                "dsn": self.dsn.replace("%", "%%")}}
+        for (section, key), value in self.settings:
+            sections.setdefault(section, {})[key] = value
+        with open(config, "w") as f:
+            for section, values in sorted(sections.items()):
+                f.write("[%s]\n" % section)
+                for key, value in sorted(values.items()):
+                    f.write("%s = %s\n" % (key, value))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [root, env.get("PYTHONPATH")]))
+        self.process = subprocess.Popen(
+            ["twistd", "-n", "--pidfile=", "-l",
+             os.path.join(self.directory, "twistd.log"),
+             "minitree", "-c", config, "-p", str(self.port)],
+            cwd=root, env=env)
+        _waitPort(self.port, self.process)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, True)
+
+
+def generateTree(depth, fanout, width, seed):
+    """
+    Yield (node_path, value) pairs of a complete tree, parents first.
+    """
+    rnd = random.Random(seed)
+    level = [""]
+    for i in range(depth):
+        children = []
+        for parent in level:
+            for j in range(fanout):
+                node_path = ("%s.n%d" % (parent, j)).lstrip(".")
+                children.append(node_path)
+                yield node_path, dict(
+                    ("k%d" % k, "%08x" % rnd.getrandbits(32))
+                    for k in range(rnd.randint(1, width)))
+        level = children
+
+
+def load(dsn, options):
+    conn = psycopg2.connect(dsn)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS ltree")
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS hstore")
+        with open(os.path.join(root, "sql", "functions.sql")) as f:
+            cursor.execute(f.read())
+        cursor.execute("DROP SCHEMA IF EXISTS bench CASCADE")
+        conn.commit()
+        return bulk.importNodes(conn, Postgres(), u"bench/tree", generateTree(
+                options.depth, options.fanout, options.width, options.seed))
+    finally:
+        conn.close()
+
+
+class Workload(object):
+    """
+    Pick requests at random, weighted by the `mix` of methods.
+    """
+
+    def __init__(self, mix, depth, fanout, width, seed):
+        self.rnd = random.Random(seed)
+        self.depth = depth
+        self.fanout = fanout
+        self.width = width
+        self.choices = []
+        total = 0
+        for name, weight in mix:
+            total += weight
+            self.choices.append((total, name))
+        self.total = total
+
+    def _path(self, level):
+        return "/".join("n%d" % self.rnd.randrange(self.fanout)
+                        for i in range(level))
+
+    def next(self):
+        n = self.rnd.uniform(0, self.total)
+        for total, name in self.choices:
+            if n <= total:
+                break
+        leaf = "/node/bench/tree/" + self._path(self.depth)
+        if name == "select":
+            return name, "GET", leaf, None
+        elif name in ("override", "combo"):
+            return name, "GET", leaf + "?method=" + name, None
+        elif name == "descendants":
+            # keep the result size independent of the tree size
+            url = "/node/bench/tree/" + self._path(max(self.depth - 2, 0))
+            return name, "GET", url.rstrip("/") + "?method=descendants", None
+        elif name == "search":
+            q = "n%d.*.n%d" % (self.rnd.randrange(self.fanout),
+                               self.rnd.randrange(self.fanout))
+            return name, "GET", "/node/bench/tree?" + urllib.urlencode(
+                dict(q=q)), None
+        elif name == "write":
+            body = json.dumps({"k%d" % self.rnd.randrange(self.width):
+                                   "%08x" % self.rnd.getrandbits(32)})
+            return name, "POST", leaf, body
+        raise ValueError("unknown method %s" % name)
+
+
+def worker(port, workload, warmup, duration, queue):
+    samples = dict()
+    errors = dict()
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+    start = time.time() + warmup
+    deadline = start + duration
+    while True:
+        name, method, url, body = workload.next()
+        began = time.time()
+        if began >= deadline:
+            break
+        try:
+            conn.request(method, url, body)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 500
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            conn = httplib.HTTPConnection("127.0.0.1", port)
+            ok = False
+        if began < start:
+            continue
+        if ok:
+            samples.setdefault(name, []).append(time.time() - began)
+        else:
+            errors[name] = errors.get(name, 0) + 1
+    conn.close()
+    queue.put((samples, errors))
+
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(results, duration):
+    samples = dict()
+    errors = dict()
+    for s, e in results:
+        for name, values in s.iteritems():
+            samples.setdefault(name, []).extend(values)
+        for name, count in e.iteritems():
+            errors[name] = errors.get(name, 0) + count
+
+    methods = dict()
+    for name in set(samples) | set(errors):
+        values = sorted(samples.get(name, []))
+        stats = dict(requests=len(values), errors=errors.get(name, 0),
+                     rps=round(len(values) / float(duration), 2))
+        if values:
+            stats.update(dict(
+                    (key, round(value * 1000, 3)) for key, value in [
+                        ("mean", sum(values) / len(values)),
+                        ("p50", _percentile(values, 50)),
+                        ("p95", _percentile(values, 95)),
+                        ("p99", _percentile(values, 99))]))
+        methods[name] = stats
+
+    requests = sum(x["requests"] for x in methods.values())
+    return dict(methods=methods, total=dict(
+            requests=requests,
+            errors=sum(x["errors"] for x in methods.values()),
+            rps=round(requests / float(duration), 2)))
+
+
+def compare(result, baseline, threshold, out):
+    """
+    Print the change of throughput and p95 per method against
+    `baseline`, return False if any of them got worse than `threshold`
+    percent.
+    """
+    ok = True
+    out.write("%-12s %10s %10s %10s %10s\n" % (
+            "method", "rps", "change", "p95 (ms)", "change"))
+    for name, stats in sorted(result["methods"].items()):
+        base = baseline["methods"].get(name)
+        if not base or not base.get("rps") or "p95" not in stats:
+            continue
+        rps = (stats["rps"] - base["rps"]) * 100.0 / base["rps"]
+        p95 = (stats["p95"] - base["p95"]) * 100.0 / max(base["p95"], 1e-3)
+        regressed = rps < -threshold or p95 > threshold
+        ok = ok and not regressed
+        out.write("%-12s %10.1f %+9.1f%% %10.2f %+9.1f%%%s\n" % (
+                name, stats["rps"], rps, stats["p95"], p95,
+                regressed and "  REGRESSED" or ""))
+    return ok
+
+
+def loadHTTP(port, options):
+    """
+    Import the tree through the import method of a running server.
+    """
+    body = "".join(json.dumps(dict(path=node_path, value=value)) + "\n"
+                   for node_path, value in generateTree(
+            options.depth, options.fanout, options.width, options.seed))
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+    try:
+        conn.request("PUT", "/node/bench/tree?import=ndjson", body)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError("import failed: %s" % data)
+        return json.loads(data)["affected"]
+    finally:
+        conn.close()
+
+
+def _commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                           cwd=root, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--dsn", help="Use this (disposable) database "
+                      "instead of a temporary cluster.")
+    parser.add_option("--depth", type="int", default=4)
+    parser.add_option("--fanout", type="int", default=10)
+    parser.add_option("--width", type="int", default=8,
+                      help="Maximum number of keys per node.")
+    parser.add_option("--concurrency", type="int", default=16,
+                      help="Number of client processes.")
+    parser.add_option("--duration", type="float", default=30,
+                      help="Seconds to measure.")
+    parser.add_option("--warmup", type="float", default=5,
+                      help="Seconds to run before measuring.")
+    parser.add_option("--mix", default=defaultMix,
+                      help="Weights of methods, default %s." % defaultMix)
+    parser.add_option("--set", action="append", default=[],
+                      metavar="SECTION.KEY=VALUE",
+                      help="Server configuration, may be repeated.")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--output", help="Write the result to this file.")
+    parser.add_option("--compare", metavar="FILE",
+                      help="A previous result to compare with.")
+    parser.add_option("--threshold", type="float", default=10,
+                      help="Tolerated regression in percent.")
+    options, args = parser.parse_args(argv)
+
+    try:
+        mix = [(name, float(weight)) for name, weight in
+               (x.split("=", 1) for x in options.mix.split(","))]
+        settings = [(tuple(key.rsplit(".", 1)), value) for key, value in
+                    (x.split("=", 1) for x in options.set)]
+    except ValueError:
+        parser.error("malformed --mix or --set")
+
+    cluster = None
+    server = None
+    try:
+        memory = dict(settings).get(("backend:main", "type")) == "memory"
+        dsn = options.dsn or ""
+        if not dsn and not memory:
+            cluster = Cluster()
+            cluster.start()
+            dsn = cluster.dsn
+        if not memory:
+            nodes = load(dsn, options)
+
+        server = Server(dsn, settings)
+        server.start()
+        if memory:
+            nodes = loadHTTP(server.port, options)
+        sys.stderr.write("imported %d nodes\n" % nodes)
+
+        queue = Queue()
+        workers = [Process(target=worker, args=(
+                    server.port,
+                    Workload(mix, options.depth, options.fanout,
+                             options.width, options.seed + i),
+                    options.warmup, options.duration, queue))
+                   for i in range(options.concurrency)]
+        for p in workers:
+            p.start()
+        results = [queue.get() for p in workers]
+        for p in workers:
+            p.join()
+    finally:
+        if server is not None:
+            server.stop()
+        if cluster is not None:
+            cluster.stop()
+
+    result = report(results, options.duration)
+    result.update(commit=_commit(), timestamp=int(time.time()), nodes=nodes,
+                  options=dict(
+            depth=options.depth, fanout=options.fanout, width=options.width,
+            concurrency=options.concurrency, duration=options.duration,
+            warmup=options.warmup, mix=dict(mix), seed=options.seed,
+            settings=dict(("%s.%s" % key, value)
+                          for key, value in settings)))
+    output = json.dumps(result, indent=2, sort_keys=True) + "\n"
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("options") != result["options"]:
+            sys.stderr.write("warning: the baseline ran with other options\n")
+        if not compare(result, baseline, options.threshold, sys.stderr):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,16 +9,35 @@ def configure(ini_file):
     default = """
 [server:main]
 port = 8000
+workers = 0
 admin_user =
 admin_pass =
 max_threads = 4
+auth_cache_size = 0
+auth_cache_ttl = 60
+watch_timeout = 60
+watch_history = 1024
+gzip_min_size = 8192
+max_page_size = 1000
 
 [backend:main]
+type = postgres
 dsn = host=%(server)s port=%(port)s dbname=%(database)s \
 user=%(user)s password=%(password)s
 user =
 password =
 max_connections = 4
+cache_size = 0
+prepared_statements = 0
+update_batch_delay = 0
+update_batch_size = 100
+materialized =
+mirrored =
+mirror_poll = 1
+mirror_retention = 3600
+tables_refresh = 60
+replica_check = 5
+replica_window = 5
 """
     p = ConfigParser()
     p.readfp(StringIO(default))
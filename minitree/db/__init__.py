@@ -22,3 +22,20 @@ class PathDuplicatedError(Exception):
 
 class DataTypeError(Exception):
     pass
+
+
+class NodeValue(dict):
+    """
+    The value of a node, with the validators of the rows it was read
+    from: `modified`, the latest change in seconds since the epoch, and
+    `versions`, the number of rows.
+    """
+
+    def __init__(self, items=(), modified=None, versions=1):
+        dict.__init__(self, items)
+        self.modified = modified
+        self.versions = versions
+
+    @property
+    def etag(self):
+        return "\"%x-%x\"" % (int(self.modified * 1000000), self.versions)
@@ -0,0 +1,180 @@
+from minitree.db import ParentNotFound, PathDuplicatedError, PathError
+from ujson import decode as json_decode
+import psycopg2
+
+__all__ = ["readNodes", "importNodes"]
+
+stagingTableSQL = "CREATE TEMP TABLE minitree_import(node_path ltree, \
+node_value hstore) ON COMMIT DROP"
+stagingIndexSQL = "CREATE INDEX ON minitree_import(node_path)"
+copySQL = "COPY minitree_import(node_path, node_value) FROM STDIN"
+duplicatedSQL = "SELECT node_path FROM minitree_import \
+GROUP BY node_path HAVING count(*) > 1 LIMIT 1"
+orphanSQL = "SELECT i.node_path FROM minitree_import i \
+WHERE nlevel(i.node_path) > 1 AND NOT EXISTS (SELECT 1 FROM %s n \
+WHERE n.node_path = subpath(i.node_path, 0, nlevel(i.node_path) - 1)) \
+AND NOT EXISTS (SELECT 1 FROM minitree_import j \
+WHERE j.node_path = subpath(i.node_path, 0, nlevel(i.node_path) - 1)) \
+LIMIT 1"
+insertSQL = "INSERT INTO %s(node_path, node_value) \
+SELECT node_path, node_value FROM minitree_import ORDER BY node_path"
+initTableSQL = "INSERT INTO %s(node_path) SELECT '' WHERE NOT EXISTS \
+(SELECT 1 FROM minitree_import WHERE node_path = '')"
+schemaExistsSQL = "SELECT 1 FROM pg_namespace WHERE nspname = %s"
+tableExistsSQL = "SELECT 1 FROM pg_tables \
+WHERE schemaname = %s AND tablename = %s"
+
+
+def _walk(tree, node_path):
+    if "value" in tree:
+        yield node_path, tree["value"]
+    for label, child in tree.get("children", {}).iteritems():
+        child = dict(child)
+        child.setdefault("value", {})
+        for node in _walk(child, ("%s.%s" % (node_path, label)).lstrip(".")):
+            yield node
+
+
+def readNodes(stream, format="ndjson"):
+    """
+    Read (relative node_path, value) pairs from `stream`.
+
+    "ndjson" streams carry one {"path": ..., "value": {...}} object per
+    line. A "json" stream is a single nested {"value": {...}, "children":
+    {label: {...}}} tree rooted at the import path.
+    """
+    if format == "json":
+        for node in _walk(json_decode(stream.read() or "{}"), ""):
+            yield node
+    elif format == "ndjson":
+        for line in stream:
+            line = line.strip()
+            if line:
+                node = json_decode(line)
+                yield (node.get("path", "").replace("/", ".").strip("."),
+                       node.get("value", {}))
+    else:
+        raise ValueError("unsupported import format %r" % format)
+
+
+class _CopyStream(object):
+    """
+    A file-like object feeding COPY from an iterator of lines. An error
+    raised by the iterator is kept in `error`, as psycopg2 fails the
+    COPY with a QueryCanceledError of its own.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ""
+        self.error = None
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+            except Exception as e:
+                self.error = e
+                raise
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _escape(s):
+    return s.replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+
+def importNodes(conn, backend, path, nodes):
+    """
+    Load `nodes` below `path` into its table in one transaction on the
+    blocking psycopg2 connection `conn`. The nodes are COPYed into a
+    staging table, checked for duplicates and missing parents, then
+    inserted with a single INSERT ... SELECT. `backend` provides the
+    SQL templates and path helpers of minitree.db.postgres.Postgres.
+    Returns the number of imported nodes.
+    """
+    def _lines():
+        for node_path, value in nodes:
+            if not isinstance(value, dict):
+                raise ValueError("the value of %r is not a dict" % node_path)
+            node_path = ".".join([x for x in (base, node_path) if x])
+            if isinstance(node_path, unicode):
+                node_path = node_path.encode("UTF-8")
+            yield "%s\t%s\n" % (_escape(node_path),
+                                _escape(backend._serialize_hstore(value)))
+
+    schema, table, base = backend._splitPath(path, False)
+    if not schema or not table:
+        raise PathError("Not enough level")
+    tablename = backend._buildTableName(schema.encode("UTF-8"),
+                                        table.encode("UTF-8"))
+    cursor = conn.cursor()
+    try:
+        # a single notification for the whole subtree is sent below
+        cursor.execute("SET LOCAL minitree.skip_notify = 'on'")
+        cursor.execute(stagingTableSQL)
+        stream = _CopyStream(_lines())
+        try:
+            cursor.copy_expert(copySQL, stream)
+        except psycopg2.extensions.QueryCanceledError:
+            if stream.error is None:
+                raise
+            raise stream.error
+        cursor.execute(stagingIndexSQL)
+        cursor.execute("ANALYZE minitree_import")
+
+        cursor.execute(duplicatedSQL)
+        duplicated = cursor.fetchone()
+        if duplicated:
+            raise PathDuplicatedError("%s is duplicated" % duplicated[0])
+
+        cursor.execute(backend.lockSchemaSQL, [schema])
+        cursor.execute(schemaExistsSQL, [schema])
+        if not cursor.fetchone():
+            cursor.execute(backend.createSchemaSQL % schema.encode("UTF-8"))
+        cursor.execute(tableExistsSQL, [schema, table])
+        created = not cursor.fetchone()
+        if created:
+            cursor.execute(backend.createTableSQL % tablename)
+            cursor.execute(backend.createTriggerSQL % tablename)
+            if tablename in backend.changelogged:
+                cursor.execute(backend.enableChangelogSQL, [tablename])
+            cursor.execute(initTableSQL % tablename)
+
+        cursor.execute(orphanSQL % tablename)
+        orphan = cursor.fetchone()
+        if orphan:
+            raise ParentNotFound("parent of %s not found" % orphan[0])
+
+        try:
+            cursor.execute(insertSQL % tablename)
+        except psycopg2.IntegrityError as e:
+            if str(e).startswith("duplicate key value violates"):
+                raise PathDuplicatedError("node already exists below %s"
+                                          % path)
+            raise
+        rowcount = cursor.rowcount
+        if created:
+            # cheaper to build once the rows are in
+            for sql in backend._createIndexSQL(schema.encode("UTF-8"),
+                                               table.encode("UTF-8")):
+                cursor.execute(sql)
+            # computed for all the rows at once, with the indexes
+            if tablename in backend.materialized:
+                cursor.execute(backend.enableEffectiveSQL, [tablename])
+
+        cursor.execute(backend.notifySQL, [
+                backend.notifyChannel,
+                (u"%s.%s.%s" % (schema, table, base)).encode("UTF-8")])
+        conn.commit()
+        return rowcount
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
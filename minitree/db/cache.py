@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import time
+
+__all__ = ["LRUCache", "NodeCache"]
+
+
+class LRUCache(object):
+    """
+    A bounded mapping which drops the least recently used entry when
+    more than `size` entries are stored. Entries older than `ttl`
+    seconds are treated as missing, a `ttl` of 0 keeps them forever.
+
+    `generation` is bumped on every invalidation. A caller which starts
+    a lookup before an invalidation passes the generation it saw to
+    `set`, so that a stale result never makes it into the cache.
+    """
+
+    def __init__(self, size, ttl=0):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires and expires < time.time():
+            self._evict(key)
+            return default
+        self._data[key] = (value, expires)
+        return value
+
+    def set(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data.pop(key, None)
+        self._data[key] = (value, self.ttl and time.time() + self.ttl)
+        while len(self._data) > self.size:
+            self._evict(self._data.popitem(last=False)[0])
+
+    def discard(self, key):
+        self.generation += 1
+        if self._data.pop(key, None) is not None:
+            self._evict(key)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def _evict(self, key):
+        pass
+
+
+class NodeCache(LRUCache):
+    """
+    LRU cache of decoded node lookups keyed by (table, node_path, kind).
+    Keys are indexed per table so that a change only scans the entries
+    of the table it happened in.
+    """
+
+    def __init__(self, size):
+        LRUCache.__init__(self, size)
+        self._tables = dict()
+
+    def set(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        self._tables.setdefault(key[0], set()).add(key)
+        LRUCache.set(self, key, value)
+
+    def clear(self):
+        LRUCache.clear(self)
+        self._tables.clear()
+
+    def _evict(self, key):
+        keys = self._tables.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tables[key[0]]
+
+    def invalidate(self, table, node_path):
+        """
+        Drop every entry of `table` at or below `node_path`. Override
+        and combo results depend on ancestors, so a change to a node
+        invalidates its whole subtree.
+        """
+        self.generation += 1
+        prefix = node_path + "."
+        for key in list(self._tables.get(table, ())):
+            if not node_path or key[1] == node_path or \
+                    key[1].startswith(prefix):
+                self._data.pop(key, None)
+                self._evict(key)
@@ -0,0 +1,133 @@
+from zope.interface import Interface
+
+__all__ = ["IBackend"]
+
+
+class IBackend(Interface):
+    """
+    The storage NodeService runs on.
+
+    Paths are "schema.table.node.path", with dots or slashes. Every method
+    returns a Deferred. A missing schema, collection or node fails with
+    NodeNotFound, a path with less than two levels with PathError.
+    """
+
+    def addChangeObserver(observer):
+        """
+        Call `observer(schema, table, node_path)` whenever a node and its
+        subtree change. A `schema` of None means that changes may have
+        been missed.
+        """
+
+    def selectNode(path):
+        """
+        Fire with the NodeValue of `path`.
+        """
+
+    def selectNodes(paths):
+        """
+        Fire with a dict of the NodeValue of every path found in `paths`.
+        """
+
+    def getOverridedNode(path):
+        """
+        Fire with the NodeValue merged from the root down to `path`.
+        """
+
+    def getOverridedNodes(paths):
+        """
+        Fire with a dict of the merged NodeValue of every path found in
+        `paths`.
+        """
+
+    def getComboNode(path):
+        """
+        Fire with a NodeValue of every key to its values from the root
+        down to `path`.
+        """
+
+    def getReverseComboNode(path):
+        """
+        Fire with a dict of every key to its values in the subtree at
+        `path`.
+        """
+
+    def getAncestors(path):
+        """
+        Fire with the paths of the ancestors of `path`, root first.
+        """
+
+    def getChildren(path, limit=None, after=None):
+        """
+        Fire with the paths of the children of `path` in order, or of the
+        tables of a schema. With `limit`, fire with at most that many
+        paths following the path `after`.
+        """
+
+    def getDescendants(path, limit=None, after=None):
+        """
+        Fire with the paths below `path` in order, paged like
+        getChildren.
+        """
+
+    def getTree(path, depth=None):
+        """
+        Fire with a NodeValue of the subtree at `path` nested as
+        {"value": ..., "children": {label: ...}}, down to `depth` levels
+        below it.
+        """
+
+    def searchNode(path, q, limit=None, after=None):
+        """
+        Fire with the paths of the collection of `path` matching the
+        lquery `q`, paged like getChildren.
+        """
+
+    def streamDescendants(path, consumer):
+        """
+        Like getDescendants, but hand lists of paths to `consumer` as they
+        are read. A Deferred returned by `consumer` delays the next call.
+        """
+
+    def streamReverseCombo(path, consumer):
+        """
+        Like getReverseComboNode, but hand lists of (key, values) pairs to
+        `consumer`.
+        """
+
+    def streamSearch(path, q, consumer):
+        """
+        Like searchNode, but hand lists of paths to `consumer`.
+        """
+
+    def createNode(path, content):
+        """
+        Create the node `path` holding the dict `content`. Its parent must
+        exist; the collection is created on demand.
+        """
+
+    def updateNode(path, content):
+        """
+        Merge the dict `content` into the node `path`. Fire with the
+        number of nodes updated.
+        """
+
+    def deleteNode(path, content, cascade):
+        """
+        Delete the keys of `content` from the node `path`, or the node
+        itself, with its subtree if `cascade`. Deleting the root of a
+        collection with `cascade` drops the collection.
+        """
+
+    def mutate(operations):
+        """
+        Apply a list of (op, path, content, cascade) operations, where op
+        is PUT, POST or DELETE, all or nothing. Fire with the number of
+        affected nodes of each operation.
+        """
+
+    def importTree(path, stream, format="ndjson"):
+        """
+        Load a subtree below `path` from the file-like `stream`, all or
+        nothing. Fire with the number of imported nodes.
+        """
@@ -0,0 +1,654 @@
+"""
+A backend keeping every collection in memory, as a trie of path labels.
+
+Nothing is persisted or shared between processes, which makes it fit for
+tests, benchmarks and caches filled from elsewhere. Reads walk the trie:
+a lookup costs the depth of its path and a subtree walk the size of the
+subtree.
+"""
+from functools import partial
+from itertools import islice
+from twisted.internet import defer, reactor
+from zope.interface import implements
+from minitree.db import PathError, NodeNotFound, ParentNotFound
+from minitree.db import DataTypeError, PathDuplicatedError
+from minitree.db import NodeValue
+from minitree.db.bulk import readNodes
+from minitree.db.interfaces import IBackend
+import re
+
+__all__ = ["MemoryBackend"]
+
+
+class _Node(object):
+    """
+    A trie node. `value` is None where there is no node, only nodes
+    below it.
+    """
+    __slots__ = ("children", "value", "modified")
+
+    def __init__(self):
+        self.children = dict()
+        self.value = None
+        self.modified = None
+
+
+def _text(s):
+    if isinstance(s, str):
+        return s.decode("UTF-8")
+    return s
+
+
+def _labels(node_path):
+    if not node_path:
+        return ()
+    labels = tuple(node_path.split("."))
+    if not all(labels):
+        raise PathError("empty label in %s" % node_path)
+    return labels
+
+
+def _split(path):
+    parts = _text(path).replace("/", ".").lstrip(".").split(".", 2)
+    if len(parts) < 2:
+        raise PathError("Not enough level")
+    return parts[0], parts[1], _labels(len(parts) == 3 and parts[2])
+
+
+def _value(content):
+    """
+    Check a node value the way hstore takes it: string keys and values.
+    """
+    value = dict()
+    for k, v in content.iteritems():
+        for s in (k, v):
+            if isinstance(s, dict):
+                raise DataTypeError("dict is not allowed")
+            elif isinstance(s, list):
+                raise DataTypeError("list is not allowed")
+        value[unicode(_text(k))] = unicode(_text(v))
+    return value
+
+
+_levelPattern = re.compile(r"^(!?)([^{}]+)(?:\{(\d*)(,?)(\d*)\})?$")
+_alternativePattern = re.compile(r"^([\w-]+)([@*%]*)$", re.UNICODE)
+
+
+def _alternative(alternative):
+    m = _alternativePattern.match(alternative)
+    if m is None:
+        raise PathError("invalid query %s" % alternative)
+    label, flags = m.groups()
+
+    def _word(word):
+        if "@" in flags:
+            chars = [re.escape(c) if c.lower() == c.upper() else
+                     "[%s%s]" % (c.lower(), c.upper()) for c in word]
+        else:
+            chars = [re.escape(c) for c in word]
+        if "*" in flags:
+            # a prefix, of every word with %
+            chars.append("[^._]*" if "%" in flags else "[^.]*")
+        return "".join(chars)
+
+    if "%" in flags:
+        return "_".join(map(_word, label.split("_"))) + "(?:_[^.]*)?"
+    return _word(label)
+
+
+def _level(level):
+    m = _levelPattern.match(level)
+    if m is None:
+        raise PathError("invalid query %s" % level)
+    negate, body, low, comma, high = m.groups()
+    if body == "*":
+        if negate:
+            raise PathError("invalid query %s" % level)
+        unit, quantifier = r"\.[^.]+", "*"
+    else:
+        alternatives = "|".join(map(_alternative, body.split("|")))
+        if negate:
+            unit = r"\.(?!(?:%s)(?:\.|$))[^.]+" % alternatives
+        else:
+            unit = r"\.(?:%s)" % alternatives
+        quantifier = ""
+    if low is not None:
+        quantifier = "{%s%s%s}" % (low or "0", comma, high)
+    return "(?:%s)%s" % (unit, quantifier)
+
+
+def _lquery(q):
+    """
+    Compile the lquery `q` into a regular expression matching paths
+    written as ".label.label...".
+    """
+    return re.compile("^%s$" % "".join(map(_level, _text(q).split("."))),
+                      re.UNICODE)
+
+
+class MemoryBackend(object):
+    """
+    Keeps each collection as a trie whose nodes hold their value dict.
+    Writes are all or nothing: every change appends its inverse to an
+    undo list, which is played back if a later step fails.
+    """
+    implements(IBackend)
+
+    streamSize = 1000
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.schemas = dict()
+        self.observers = []
+
+    def addChangeObserver(self, observer):
+        self.observers.append(observer)
+
+    def _written(self, schema, table, labels):
+        for observer in self.observers:
+            observer(schema.encode("UTF-8"), table.encode("UTF-8"),
+                     ".".join(labels).encode("UTF-8"))
+
+    def _collection(self, schema, table):
+        tables = self.schemas.get(schema)
+        if tables is None:
+            raise NodeNotFound("schema not found")
+        root = tables.get(table)
+        if root is None:
+            raise NodeNotFound("collection not found")
+        return root
+
+    @staticmethod
+    def _lookup(node, labels):
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                return None
+        return node
+
+    def _find(self, path):
+        """
+        Return the schema, table, labels and trie node of the existing
+        node `path`.
+        """
+        schema, table, labels = _split(path)
+        node = self._lookup(self._collection(schema, table), labels)
+        if node is None or node.value is None:
+            raise NodeNotFound()
+        return schema, table, labels, node
+
+    def _ancestry(self, path):
+        """
+        Return the (labels, trie node) of the existing nodes from the root
+        down to the existing node `path`.
+        """
+        schema, table, labels = _split(path)
+        node = self._collection(schema, table)
+        nodes = []
+        for i in range(len(labels) + 1):
+            if i:
+                node = node.children.get(labels[i - 1])
+                if node is None:
+                    break
+            if node.value is not None:
+                nodes.append((labels[:i], node))
+        if not nodes or nodes[-1][0] != labels:
+            raise NodeNotFound()
+        return nodes
+
+    @staticmethod
+    def _validated(value, nodes):
+        return NodeValue(value, max(x.modified for _, x in nodes),
+                         len(nodes))
+
+    def _walk(self, node, labels, after=()):
+        """
+        Yield (labels, trie node) of the nodes below `node`, which is at
+        `labels`, in path order. Only paths following `after`, relative to
+        `node`, are yielded.
+        """
+        for label in sorted(node.children):
+            if after and label < after[0]:
+                continue
+            child = node.children[label]
+            path = labels + (label,)
+            if after and label == after[0]:
+                rest = after[1:]
+            else:
+                rest = ()
+                if child.value is not None:
+                    yield path, child
+            for item in self._walk(child, path, rest):
+                yield item
+
+    @staticmethod
+    def _relative(schema, table, labels, after):
+        """
+        Turn the full path `after` of a previous page into labels relative
+        to `labels`, or None if nothing below `labels` follows it.
+        """
+        if after is None:
+            return ()
+        s, t, after = _split(after)
+        if (s, t) != (schema, table):
+            raise PathError("cursor does not belong to %s.%s" %
+                            (schema, table))
+        n = len(labels)
+        if after[:n] == labels:
+            return after[n:]
+        if after < labels:
+            return ()
+        return None
+
+    @staticmethod
+    def _join(schema, table, labels):
+        return ".".join((schema, table) + labels)
+
+    def _stream(self, items, consumer):
+        """
+        Hand `items` to `consumer` `streamSize` at a time. A Deferred
+        returned by the consumer delays the next call until it fires.
+        """
+        def _next(_):
+            while True:
+                chunk = list(islice(items, self.streamSize))
+                if not chunk:
+                    return None
+                result = consumer(chunk)
+                if isinstance(result, defer.Deferred):
+                    return result.addCallback(_next)
+
+        return defer.maybeDeferred(_next, None)
+
+    # reads
+
+    def _selectNode(self, path):
+        schema, table, labels, node = self._find(path)
+        return NodeValue(node.value, node.modified, 1)
+
+    def selectNode(self, path):
+        return defer.maybeDeferred(self._selectNode, path)
+
+    def _overridedNode(self, path):
+        nodes = self._ancestry(path)
+        value = self._validated((), nodes)
+        for _, node in nodes:
+            value.update(node.value)
+        return value
+
+    def getOverridedNode(self, path):
+        return defer.maybeDeferred(self._overridedNode, path)
+
+    def _selectMany(self, paths, f):
+        result = dict()
+        for path in paths:
+            try:
+                result[path] = f(path)
+            except (PathError, NodeNotFound):
+                pass
+        return result
+
+    def selectNodes(self, paths):
+        return defer.maybeDeferred(self._selectMany, paths, self._selectNode)
+
+    def getOverridedNodes(self, paths):
+        return defer.maybeDeferred(self._selectMany, paths,
+                                   self._overridedNode)
+
+    def _comboNode(self, path):
+        nodes = self._ancestry(path)
+        combo = self._validated((), nodes)
+        for _, node in nodes:
+            for key, value in node.value.iteritems():
+                combo.setdefault(key, []).append(value)
+        return combo
+
+    def getComboNode(self, path):
+        return defer.maybeDeferred(self._comboNode, path)
+
+    def _subtree(self, path):
+        schema, table, labels, node = self._find(path)
+        yield labels, node
+        for item in self._walk(node, labels):
+            yield item
+
+    def _reverseCombo(self, path):
+        rcombo = dict()
+        for _, node in self._subtree(path):
+            for key, value in node.value.iteritems():
+                rcombo.setdefault(key, []).append(value)
+        return rcombo
+
+    def getReverseComboNode(self, path):
+        return defer.maybeDeferred(self._reverseCombo, path)
+
+    def streamReverseCombo(self, path, consumer):
+        d = defer.maybeDeferred(self._reverseCombo, path)
+        d.addCallback(lambda rcombo: self._stream(
+                iter(sorted(rcombo.iteritems())), consumer))
+        return d
+
+    def _ancestors(self, path):
+        schema, table, _ = _split(path)
+        return [self._join(schema, table, labels)
+                for labels, _ in self._ancestry(path)[:-1]]
+
+    def getAncestors(self, path):
+        return defer.maybeDeferred(self._ancestors, path)
+
+    def _tables(self, schema):
+        tables = self.schemas.get(_text(schema))
+        if not tables:
+            raise NodeNotFound()
+        return ["%s.%s" % (schema, table) for table in sorted(tables)]
+
+    def _children(self, path, limit, after):
+        if len(filter(None, _text(path).replace("/", ".").split("."))) == 1:
+            paths = self._tables(path.strip("/."))
+            if after is not None:
+                paths = [x for x in paths if x > after]
+            return paths[:limit]
+
+        schema, table, labels, node = self._find(path)
+        after = self._relative(schema, table, labels, after)
+        if after is None:
+            return []
+        paths = (self._join(schema, table, labels + (label,))
+                 for label in sorted(node.children)
+                 if node.children[label].value is not None and
+                 (label,) > after)
+        return list(islice(paths, limit))
+
+    def getChildren(self, path, limit=None, after=None):
+        return defer.maybeDeferred(self._children, path, limit, after)
+
+    def _descendants(self, path, after=None):
+        schema, table, labels, node = self._find(path)
+        after = self._relative(schema, table, labels, after)
+        if after is None:
+            return iter(())
+        return (self._join(schema, table, x)
+                for x, _ in self._walk(node, labels, after))
+
+    def getDescendants(self, path, limit=None, after=None):
+        d = defer.maybeDeferred(self._descendants, path, after)
+        return d.addCallback(lambda paths: list(islice(paths, limit)))
+
+    def streamDescendants(self, path, consumer):
+        d = defer.maybeDeferred(self._descendants, path)
+        return d.addCallback(self._stream, consumer)
+
+    def _tree(self, path, depth):
+        def _build(node, level):
+            if node.value is not None:
+                nodes.append((None, node))
+            children = dict()
+            if depth is None or level < depth:
+                for label, child in node.children.iteritems():
+                    children[label] = _build(child, level + 1)
+            if node.value is None:
+                return dict(value=None, children=children)
+            return dict(value=dict(node.value), children=children)
+
+        schema, table, labels, node = self._find(path)
+        nodes = []
+        return self._validated(_build(node, 0), nodes)
+
+    def getTree(self, path, depth=None):
+        return defer.maybeDeferred(self._tree, path, depth)
+
+    def _search(self, path, q, after=None):
+        def _nodes():
+            if not after and root.value is not None:
+                yield (), root
+            for item in self._walk(root, (), after):
+                yield item
+
+        # the whole collection is searched, as long as the node exists
+        schema, table, labels, _ = self._find(path)
+        match = _lquery(q).match
+        root = self._collection(schema, table)
+        after = self._relative(schema, table, (), after)
+        return (self._join(schema, table, x) for x, _ in _nodes()
+                if match("".join("." + label for label in x)))
+
+    def searchNode(self, path, q, limit=None, after=None):
+        d = defer.maybeDeferred(self._search, path, q, after)
+        return d.addCallback(lambda paths: list(islice(paths, limit)))
+
+    def streamSearch(self, path, q, consumer):
+        d = defer.maybeDeferred(self._search, path, q)
+        return d.addCallback(self._stream, consumer)
+
+    # writes
+
+    def _assign(self, node, value, undo):
+        undo.append(partial(self._restore, node, node.value, node.modified))
+        node.value = value
+        node.modified = self.clock.seconds()
+
+    @staticmethod
+    def _restore(node, value, modified):
+        node.value = value
+        node.modified = modified
+
+    @staticmethod
+    def _rollback(undo):
+        for f in reversed(undo):
+            f()
+
+    @staticmethod
+    def _count(node):
+        count = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            count += node.value is not None
+            stack.extend(node.children.itervalues())
+        return count
+
+    def _table(self, schema, table, undo, root=True):
+        tables = self.schemas.get(schema)
+        if tables is None:
+            tables = self.schemas[schema] = dict()
+            undo.append(partial(self.schemas.pop, schema, None))
+        node = tables.get(table)
+        if node is None:
+            node = tables[table] = _Node()
+            undo.append(partial(tables.pop, table, None))
+            if root:
+                self._assign(node, dict(), undo)
+        return node
+
+    def _insert(self, root, labels, value, undo, missing):
+        parent = self._lookup(root, labels[:-1])
+        if len(labels) > 1 and (parent is None or parent.value is None):
+            raise missing("parent of %s not found" % ".".join(labels))
+        if not labels:
+            node = root
+        else:
+            node = parent.children.get(labels[-1])
+            if node is None:
+                node = parent.children[labels[-1]] = _Node()
+                undo.append(partial(parent.children.pop, labels[-1], None))
+        if node.value is not None:
+            raise PathDuplicatedError("%s already exists" %
+                                      ".".join(labels))
+        self._assign(node, value, undo)
+
+    def _update(self, schema, table, labels, value, undo):
+        node = self._lookup(self._collection(schema, table), labels)
+        if node is None or node.value is None:
+            return 0
+        merged = dict(node.value)
+        merged.update(value)
+        self._assign(node, merged, undo)
+        return 1
+
+    def _delete(self, schema, table, labels, content, cascade, undo):
+        root = self._collection(schema, table)
+        if content:
+            node = self._lookup(root, labels)
+            if node is None or node.value is None:
+                return 0
+            self._assign(node, dict((k, v) for k, v in node.value.iteritems()
+                                    if k not in content), undo)
+            return 1
+        elif labels:
+            parent = self._lookup(root, labels[:-1])
+            node = parent and parent.children.get(labels[-1])
+            if node is None:
+                return 0
+            if cascade:
+                count = self._count(node)
+            elif node.value is None:
+                return 0
+            elif node.children:
+                # the nodes below stay, as they do in a table
+                self._assign(node, None, undo)
+                return 1
+            else:
+                count = 1
+            del parent.children[labels[-1]]
+            undo.append(partial(parent.children.__setitem__, labels[-1],
+                                node))
+            return count
+        elif cascade:
+            tables = self.schemas[schema]
+            del tables[table]
+            undo.append(partial(tables.__setitem__, table, root))
+            return self._count(root)
+        return 0
+
+    def _mutate(self, operations, missing=ParentNotFound):
+        # as in a table, a collection gets a root unless one is created
+        roots = set(_split(path)[:2] for op, path, _, _ in operations
+                    if op == "PUT" and not _split(path)[2])
+        affected = []
+        undo = []
+        try:
+            for op, path, content, cascade in operations:
+                schema, table, labels = _split(path)
+                if op == "PUT":
+                    root = self._table(schema, table, undo,
+                                       (schema, table) not in roots)
+                    self._insert(root, labels, _value(content), undo,
+                                 missing)
+                    affected.append(1)
+                elif op == "POST":
+                    affected.append(self._update(schema, table, labels,
+                                                 _value(content), undo))
+                else:
+                    affected.append(self._delete(schema, table, labels,
+                                                 content, cascade, undo))
+        except:
+            self._rollback(undo)
+            raise
+        for path in set(map(lambda x: x[1], operations)):
+            self._written(*_split(path))
+        return affected
+
+    def mutate(self, operations):
+        return defer.maybeDeferred(self._mutate, operations)
+
+    def createNode(self, path, content):
+        d = defer.maybeDeferred(self._mutate, [("PUT", path, content, False)],
+                                NodeNotFound)
+        return d.addCallback(lambda affected: affected[0])
+
+    def updateNode(self, path, content):
+        d = self.mutate([("POST", path, content, False)])
+        return d.addCallback(lambda affected: affected[0])
+
+    def deleteNode(self, path, content, cascade):
+        d = self.mutate([("DELETE", path, content, cascade)])
+        return d.addCallback(lambda affected: affected[0])
+
+    def _importTree(self, path, stream, format):
+        schema, table, base = _split(path)
+        nodes = dict()
+        for node_path, value in readNodes(stream, format):
+            if not isinstance(value, dict):
+                raise ValueError("the value of %r is not a dict" % node_path)
+            labels = base + _labels(_text(node_path))
+            if labels in nodes:
+                raise PathDuplicatedError("%s is duplicated" %
+                                          ".".join(labels))
+            nodes[labels] = _value(value)
+
+        undo = []
+        try:
+            root = self._table(schema, table, undo, () not in nodes)
+            # parents sort first
+            for labels in sorted(nodes):
+                self._insert(root, labels, nodes[labels], undo,
+                             ParentNotFound)
+        except:
+            self._rollback(undo)
+            raise
+        self._written(schema, table, base)
+        return len(nodes)
+
+    def importTree(self, path, stream, format="ndjson"):
+        return defer.maybeDeferred(self._importTree, path, stream, format)
+
+    # state copied from elsewhere, stored as it is
+
+    @staticmethod
+    def _place(root, labels, value, modified):
+        node = root
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        node.value = value
+        node.modified = modified
+
+    def loadCollection(self, schema, table, nodes):
+        """
+        Replace the collection `schema`.`table` with the (node_path, value,
+        modified) tuples of `nodes`, in any order.
+        """
+        root = _Node()
+        for node_path, value, modified in nodes:
+            self._place(root, _labels(_text(node_path)), value, modified)
+        self.schemas.setdefault(_text(schema), dict())[_text(table)] = root
+
+    def setNode(self, schema, table, node_path, value, modified):
+        """
+        Set the node `node_path` to `value`, whether it exists or not.
+        """
+        tables = self.schemas.setdefault(_text(schema), dict())
+        root = tables.get(_text(table))
+        if root is None:
+            root = tables[_text(table)] = _Node()
+        self._place(root, _labels(_text(node_path)), value, modified)
+
+    def removeNode(self, schema, table, node_path):
+        """
+        Remove the node `node_path`, but not the nodes below it.
+        """
+        labels = _labels(_text(node_path))
+        try:
+            nodes = [self._collection(_text(schema), _text(table))]
+        except NodeNotFound:
+            return
+        for label in labels:
+            node = nodes[-1].children.get(label)
+            if node is None:
+                return
+            nodes.append(node)
+        self._restore(nodes[-1], None, None)
+        # drop the placeholders nothing is below any more
+        for i in range(len(labels), 0, -1):
+            if nodes[i].value is not None or nodes[i].children:
+                break
+            del nodes[i - 1].children[labels[i - 1]]
+
+    def dropCollection(self, schema, table):
+        tables = self.schemas.get(_text(schema))
+        if tables is not None:
+            tables.pop(_text(table), None)
+            if not tables:
+                del self.schemas[_text(schema)]
@@ -0,0 +1,365 @@
+"""
+Collections kept in memory, in step with their Postgres tables.
+
+A mirrored table is read whole into a MemoryBackend once, then kept
+current by replaying, in id order, the rows its trigger logs in
+minitree_changes (see sql/functions.sql). Notifications only tell when
+to look; a periodic poll covers the lost ones. Reads of a loaded table
+are answered from memory, everything else goes to Postgres, writes
+included. A write returns once it is replayed here, so that the process
+reads its own writes.
+
+Ids are taken from a sequence when rows are logged but show up when
+their transaction commits, possibly after higher ones. Ids skipped over
+are looked for again until they are `gapTimeout` seconds old.
+"""
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from twisted.python.failure import Failure
+from zope.interface import implements
+from minitree.db import PathError
+from minitree.db.interfaces import IBackend
+from minitree.db.memory import MemoryBackend
+from minitree.metrics import registry
+from ujson import decode as json_decode
+
+__all__ = ["Mirror"]
+
+
+class Mirror(object):
+    """
+    Serve the "schema.table" collections in `paths` from memory and
+    everything else from the Postgres backend `backend`.
+    """
+    implements(IBackend)
+
+    # longest a transaction may take to commit what it logged
+    gapTimeout = 60
+    maxGaps = 10000
+    batchSize = 10000
+
+    positionSQL = "SELECT coalesce((SELECT min(id) - 1 FROM minitree_changes \
+WHERE logged > now() - %s * interval '1 second'), \
+(SELECT max(id) FROM minitree_changes), 0)"
+    scanSQL = "SELECT node_path, hstore_to_json(node_value)::text, \
+extract(epoch FROM last_modification::timestamptz)::float8 FROM %s"
+    changesSQL = "SELECT id, schemaname, tablename, node_path, \
+hstore_to_json(node_value)::text, \
+extract(epoch FROM modified::timestamptz)::float8, deleted \
+FROM minitree_changes"
+    followSQL = changesSQL + " WHERE id > %(last)s \
+OR id = ANY(%(gaps)s::bigint[]) ORDER BY id LIMIT %(limit)s"
+    replaySQL = changesSQL + " WHERE id > %(start)s AND id <= %(last)s \
+AND schemaname = %(schema)s AND tablename = %(table)s ORDER BY id"
+    pruneSQL = "DELETE FROM minitree_changes \
+WHERE logged < now() - %s * interval '1 second'"
+
+    def __init__(self, backend, paths, clock=reactor):
+        self.backend = backend
+        self.memory = MemoryBackend(clock)
+        self.clock = clock
+        self.mirrored = set(backend._splitPath(path)[:2] for path in paths)
+        self.loaded = set()
+        self.pending = set(self.mirrored)
+        self.last = None
+        self.gaps = dict()
+        self.synced = None
+        self.retention = None
+        self.observers = []
+        self.waiting = []
+        self.running = None
+        self.pollLoop = None
+        self.pruneLoop = None
+        backend.addChangeObserver(self._changed)
+
+    def start(self, interval, retention):
+        """
+        Load the mirrored tables and poll for changes every `interval`
+        seconds. Changes are logged for `retention` seconds; a mirror
+        which could not poll for half of that loads its tables again.
+        """
+        self.retention = retention
+        d = self.backend.changelog(["%s.%s" % x for x in self.mirrored])
+        d.addCallback(lambda _: self.poll())
+        self.pollLoop = task.LoopingCall(self.poll)
+        self.pollLoop.clock = self.clock
+        self.pollLoop.start(interval, False)
+        self.pruneLoop = task.LoopingCall(self._prune)
+        self.pruneLoop.clock = self.clock
+        self.pruneLoop.start(max(retention / 10.0, interval), False)
+        return d
+
+    def _prune(self):
+        d = self.backend.pool.runOperation(self.pruneSQL, [self.retention])
+        d.addErrback(lambda e: log.err(e, "Pruning the change log failed"))
+        return d
+
+    def addChangeObserver(self, observer):
+        self.observers.append(observer)
+
+    def _notify(self, schema, table, node_path):
+        for observer in self.observers:
+            observer(schema, table, node_path)
+
+    def _changed(self, schema, table, node_path):
+        if schema is None:
+            self.poll()
+        elif (schema, table) in self.mirrored:
+            # observers hear of it once it is replayed
+            self.poll()
+            return
+        self._notify(schema, table, node_path)
+
+    # following the change log
+
+    def poll(self):
+        """
+        Replay the logged changes. Fire once the changes logged before
+        the call are replayed.
+        """
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if self.running is None:
+            self._run()
+        return d
+
+    def _run(self):
+        def _done(result):
+            self.running = None
+            if isinstance(result, Failure):
+                log.err(result, "Mirroring changes failed")
+            for d in waiting:
+                d.callback(None)
+            if self.waiting:
+                self._run()
+
+        # callers arriving meanwhile wait for the next run
+        waiting, self.waiting = self.waiting, []
+        self.running = d = defer.maybeDeferred(self._update)
+        d.addBoth(_done)
+
+    def _update(self):
+        now = self.clock.seconds()
+        if self.synced is not None and self.retention is not None and \
+                now - self.synced > self.retention / 2.0:
+            # the changes since may be pruned already
+            log.msg("Mirror out of date, loading the tables again")
+            self.pending.update(self.mirrored)
+            self.last = None
+            self.gaps.clear()
+        d = defer.succeed(None)
+        for key in sorted(self.pending):
+            d.addCallback(lambda _, key=key: self._load(*key))
+        d.addCallback(lambda _: self._position())
+        d.addCallback(lambda _: self._follow())
+        d.addCallback(lambda _: setattr(self, "synced", now))
+        return d
+
+    def _load(self, schema, table):
+        def _scan(c):
+            d = c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            d.addCallback(lambda c: c.execute(self.positionSQL,
+                                              [self.gapTimeout]))
+            d.addCallback(lambda c: position.append(c.fetchone()[0]))
+            d.addCallback(lambda _: c.execute(self.scanSQL % tablename))
+            d.addCallback(lambda c: c.fetchall())
+            return d
+
+        def _enabled(rows):
+            if not rows:
+                self._drop(schema, table)
+                return None
+            d = self.backend.pool.runInteraction(_scan)
+            d.addCallback(_scanned)
+            return d
+
+        def _scanned(rows):
+            values = json_decode("[%s]" % ",".join(x[1] or "{}"
+                                                   for x in rows))
+            self.memory.loadCollection(schema, table, (
+                    (x[0].decode("UTF-8"), value, x[2])
+                    for x, value in zip(rows, values)))
+            self.loaded.add((schema, table))
+            start = position[0]
+            if self.last is None:
+                self.last = start
+            elif start < self.last:
+                # changes followed already may be newer than the snapshot
+                return self.backend.pool.runQuery(self.replaySQL, dict(
+                        start=start, last=self.last, schema=schema,
+                        table=table)).addCallback(self._apply)
+
+        def _failed(e):
+            self.pending.add((schema, table))
+            return e
+
+        self.pending.discard((schema, table))
+        tablename = self.backend._buildTableName(schema, table)
+        position = []
+        d = self.backend.pool.runQuery(self.backend.enableChangelogSQL,
+                                       [tablename])
+        d.addCallback(_enabled)
+        d.addErrback(_failed)
+        return d
+
+    def _position(self):
+        # no table was loaded, follow on to notice the ones created later
+        if self.last is not None:
+            return None
+        d = self.backend.pool.runQuery(self.positionSQL, [self.gapTimeout])
+        d.addCallback(lambda rows: setattr(self, "last", rows[0][0]))
+        return d
+
+    def _drop(self, schema, table):
+        self.memory.dropCollection(schema, table)
+        self.loaded.discard((schema, table))
+
+    def _follow(self):
+        d = self.backend.pool.runQuery(self.followSQL, dict(
+                last=self.last, gaps=sorted(self.gaps),
+                limit=self.batchSize))
+        d.addCallback(self._followed)
+        return d
+
+    def _followed(self, rows):
+        now = self.clock.seconds()
+        self._apply(rows)
+        for row in rows:
+            self.gaps.pop(row[0], None)
+        for id in [row[0] for row in rows if row[0] > self.last]:
+            if id - self.last - 1 + len(self.gaps) <= self.maxGaps:
+                for skipped in xrange(self.last + 1, id):
+                    self.gaps[skipped] = now
+            self.last = id
+        for id, seen in self.gaps.items():
+            if now - seen > self.gapTimeout:
+                del self.gaps[id]
+        if len(rows) == self.batchSize:
+            return self._follow()
+
+    def _apply(self, rows):
+        values = json_decode("[%s]" % ",".join(x[4] or "null" for x in rows))
+        for row, value in zip(rows, values):
+            _, schema, table, node_path, _, modified, deleted = row
+            if (schema, table) not in self.loaded:
+                if (schema, table) in self.mirrored and not deleted:
+                    # created again since, or not there when loaded
+                    self.pending.add((schema, table))
+                continue
+            if deleted and not node_path:
+                # logged by minitree_log_drop
+                self._drop(schema, table)
+            elif deleted:
+                self.memory.removeNode(schema, table, node_path)
+            else:
+                self.memory.setNode(schema, table, node_path.decode("UTF-8"),
+                                    value or dict(), modified)
+            replayedChanges.inc()
+            self._notify(schema, table, node_path)
+
+    # reads
+
+    def _reader(self, path):
+        try:
+            schema, table, _ = self.backend._splitPath(path)
+        except PathError:
+            return self.backend
+        if (schema, table) in self.loaded:
+            return self.memory
+        return self.backend
+
+    def _selectMany(self, paths, name):
+        readers = dict()
+        for path in paths:
+            readers.setdefault(self._reader(path), []).append(path)
+
+        def _merged(results):
+            merged = dict()
+            for result in results:
+                merged.update(result)
+            return merged
+
+        d = defer.gatherResults([getattr(reader, name)(paths)
+                                 for reader, paths in readers.iteritems()])
+        d.addCallback(_merged)
+        return d
+
+    def selectNode(self, path):
+        return self._reader(path).selectNode(path)
+
+    def selectNodes(self, paths):
+        return self._selectMany(paths, "selectNodes")
+
+    def getOverridedNode(self, path):
+        return self._reader(path).getOverridedNode(path)
+
+    def getOverridedNodes(self, paths):
+        return self._selectMany(paths, "getOverridedNodes")
+
+    def getComboNode(self, path):
+        return self._reader(path).getComboNode(path)
+
+    def getReverseComboNode(self, path):
+        return self._reader(path).getReverseComboNode(path)
+
+    def getAncestors(self, path):
+        return self._reader(path).getAncestors(path)
+
+    def getChildren(self, path, limit=None, after=None):
+        return self._reader(path).getChildren(path, limit, after)
+
+    def getDescendants(self, path, limit=None, after=None):
+        return self._reader(path).getDescendants(path, limit, after)
+
+    def getTree(self, path, depth=None):
+        return self._reader(path).getTree(path, depth)
+
+    def searchNode(self, path, q, limit=None, after=None):
+        return self._reader(path).searchNode(path, q, limit, after)
+
+    def streamDescendants(self, path, consumer):
+        return self._reader(path).streamDescendants(path, consumer)
+
+    def streamReverseCombo(self, path, consumer):
+        return self._reader(path).streamReverseCombo(path, consumer)
+
+    def streamSearch(self, path, q, consumer):
+        return self._reader(path).streamSearch(path, q, consumer)
+
+    # writes
+
+    def _replayed(self, d, paths):
+        def _wait(result):
+            return self.poll().addCallback(lambda _: result)
+
+        for path in paths:
+            try:
+                schema, table, _ = self.backend._splitPath(path)
+            except PathError:
+                continue
+            if (schema, table) in self.mirrored:
+                return d.addCallback(_wait)
+        return d
+
+    def createNode(self, path, content):
+        return self._replayed(self.backend.createNode(path, content), [path])
+
+    def updateNode(self, path, content):
+        return self._replayed(self.backend.updateNode(path, content), [path])
+
+    def deleteNode(self, path, content, cascade):
+        return self._replayed(self.backend.deleteNode(path, content, cascade),
+                              [path])
+
+    def mutate(self, operations):
+        return self._replayed(self.backend.mutate(operations),
+                              [x[1] for x in operations])
+
+    def importTree(self, path, stream, format="ndjson"):
+        return self._replayed(self.backend.importTree(path, stream, format),
+                              [path])
+
+
+replayedChanges = registry.counter(
+    "minitree_mirror_changes_total",
+    "Logged changes replayed into mirrored collections.")
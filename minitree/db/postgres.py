@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import context, log
 from twisted.python.failure import Failure
+from zope.interface import implements
 from minitree.db import PathError, NodeNotFound, NodeCreationError
+from minitree.db import ParentNotFound
 from minitree.db import DataTypeError
 from minitree.db import PathDuplicatedError
+from minitree.db import NodeValue
+from minitree.db.cache import NodeCache
+from minitree.db.prepared import PreparedStatements
+from minitree.db import bulk
+from minitree.db.interfaces import IBackend
+from minitree.metrics import registry
 from collections import defaultdict
 from txpostgres import txpostgres
+from ujson import decode as json_decode
 from os.path import splitext
 import psycopg2
 import re
@@ -14,29 +24,72 @@ __all__ = ["dbBackend"]
 
 
 class Postgres(object):
+    implements(IBackend)
 
     selectOneSQL = "SELECT 1 FROM %s WHERE node_path = %%(node_path)s LIMIT 1"
+    probeSQL = "WITH target AS (SELECT 1 FROM %s \
+WHERE node_path = %%(node_path)s LIMIT 1) \
+SELECT q.* FROM target LEFT JOIN (%s) AS q ON true"
+    probeValidatorSQL = "WITH target AS (SELECT 1 FROM %s \
+WHERE node_path = %%(node_path)s LIMIT 1), validator AS (%s) \
+SELECT q.*, validator.* FROM target CROSS JOIN validator \
+LEFT JOIN (%s) AS q ON true"
+    nodeValidatorSQL = "SELECT \
+extract(epoch FROM max(last_modification)::timestamptz)::float8, count(*) \
+FROM %s WHERE node_path = %%(node_path)s"
+    ancestorsValidatorSQL = "SELECT \
+extract(epoch FROM max(last_modification)::timestamptz)::float8, count(*) \
+FROM %s WHERE node_path @> %%(node_path)s"
     selectSQL = "SELECT key, value FROM each( \
 (SELECT node_value FROM %s WHERE node_path = %%(node_path)s LIMIT 1))"
     selectOverrideSQL = "SELECT key, value FROM each( \
 (SELECT hstore_override(node_value order by node_path asc) AS node_value \
 FROM %s WHERE node_path @> %%(node_path)s))"
-    selectComboSQL = "SELECT (each(node_value)).key, (each(node_value)).value \
-FROM %s WHERE node_path @> %%(node_path)s"
-    selectReverseComboSQL = "SELECT (each(node_value)).key, (each(node_value)).value \
-FROM %s WHERE node_path <@ %%(node_path)s"
+    selectEffectiveSQL = "SELECT key, value FROM each( \
+(SELECT effective_value FROM %s WHERE node_path = %%(node_path)s LIMIT 1))"
+    selectComboSQL = "SELECT e.key, \
+json_agg(e.value ORDER BY n.node_path)::text \
+FROM %s n, each(n.node_value) e WHERE n.node_path @> %%(node_path)s \
+GROUP BY e.key"
+    selectReverseComboSQL = "SELECT e.key, \
+json_agg(e.value ORDER BY n.node_path)::text \
+FROM %s n, each(n.node_value) e WHERE n.node_path <@ %%(node_path)s \
+GROUP BY e.key"
     selectAncestorSQL = "SELECT node_path FROM %s \
 WHERE node_path @> %%(node_path)s AND node_path != %%(node_path)s"
     selectAllSQL = "SELECT node_path FROM %s WHERE node_path ~ %%(q)s"
+    selectChildrenSQL = "SELECT node_path FROM %s \
+WHERE node_path <@ %%(node_path)s \
+AND nlevel(node_path) = nlevel(%%(node_path)s) + 1"
     selectDescentantsSQL = "SELECT node_path, node_value FROM %s \
 WHERE node_path <@ %%(node_path)s AND node_path != %%(node_path)s"
+    selectTreeSQL = "SELECT node_path, hstore_to_json(node_value)::text, \
+extract(epoch FROM last_modification::timestamptz)::float8 FROM %s \
+WHERE node_path <@ %%(node_path)s"
+    treeDepthSQL = " AND nlevel(node_path) <= nlevel(%%(node_path)s) + \
+%%(depth)s"
+    selectManySQL = "SELECT node_path, hstore_to_json(node_value)::text, \
+extract(epoch FROM last_modification::timestamptz)::float8, 1 \
+FROM %s WHERE node_path = ANY(%%(node_paths)s::text[]::ltree[])"
+    selectOverrideManySQL = "SELECT q.node_path, hstore_to_json(\
+hstore_override(n.node_value ORDER BY n.node_path))::text, \
+extract(epoch FROM max(n.last_modification)::timestamptz)::float8, count(*) \
+FROM unnest(%%(node_paths)s::text[]::ltree[]) AS q(node_path) \
+JOIN %s n ON n.node_path @> q.node_path \
+GROUP BY q.node_path HAVING bool_or(n.node_path = q.node_path)"
+    selectEffectiveManySQL = "SELECT q.node_path, hstore_to_json((array_agg(\
+n.effective_value) FILTER (WHERE n.node_path = q.node_path))[1])::text, \
+extract(epoch FROM max(n.last_modification)::timestamptz)::float8, count(*) \
+FROM unnest(%%(node_paths)s::text[]::ltree[]) AS q(node_path) \
+JOIN %s n ON n.node_path @> q.node_path \
+GROUP BY q.node_path HAVING bool_or(n.node_path = q.node_path)"
     selectTablesSQL = "SELECT (schemaname || '.' || tablename) AS node_path \
-FROM pg_tables WHERE schemaname=%(name)s;"
+FROM pg_tables WHERE schemaname=%(name)s ORDER BY 1;"
     searchNodeSQL = "SELECT node_path FROM %s WHERE node_path ~ %%(q)s"
     updateSQL = "UPDATE %s SET node_value = node_value || %%s, \
 last_modification = now() \
 WHERE node_path = %%s"
-    deleteSQL = "UPDATE %s SET node_value = delete(node_value, %%s), \
+    deleteSQL = "UPDATE %s SET node_value = delete(node_value, %%s::text[]), \
 last_modification = now() \
 WHERE node_path = %%s"
     deleteNodeSQL = "DELETE FROM %s WHERE node_path = %%s"
@@ -46,14 +99,82 @@ WHERE node_path = %%s"
     createTableSQL = "CREATE TABLE %s(id SERIAL PRIMARY KEY, \
 node_path ltree unique, node_value hstore, \
 last_modification timestamp default now())"
+    createIndexSQL = "CREATE INDEX %s %s ON %s %s"
     createSchemaSQL = "CREATE SCHEMA %s"
+    createSchemaIfMissingSQL = "CREATE SCHEMA IF NOT EXISTS %s"
+    lockSchemaSQL = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+    selectAllTablesSQL = "SELECT schemaname, tablename FROM pg_tables \
+WHERE schemaname NOT IN ('pg_catalog', 'information_schema')"
+    tableExistsSQL = "SELECT 1 FROM pg_tables \
+WHERE schemaname = %s AND tablename = %s"
+    createManySQL = "INSERT INTO %s(node_path, node_value) \
+SELECT * FROM unnest(%%(node_paths)s::text[]::ltree[], \
+%%(node_values)s::text[]::hstore[])"
+    orphanManySQL = "SELECT v.node_path \
+FROM unnest(%%(node_paths)s::text[]::ltree[]) AS v(node_path) \
+WHERE nlevel(v.node_path) > 1 AND NOT EXISTS (SELECT 1 FROM %s n \
+WHERE n.node_path = subpath(v.node_path, 0, nlevel(v.node_path) - 1)) \
+AND subpath(v.node_path, 0, nlevel(v.node_path) - 1) \
+<> ALL(%%(node_paths)s::text[]::ltree[]) LIMIT 1"
+    updateManySQL = "UPDATE %s n SET node_value = n.node_value || v.node_value, \
+last_modification = now() \
+FROM unnest(%%(node_paths)s::text[]::ltree[], \
+%%(node_values)s::text[]::hstore[]) AS v(node_path, node_value) \
+WHERE n.node_path = v.node_path RETURNING n.node_path"
+    deleteNodeManySQL = "DELETE FROM %s \
+WHERE node_path = ANY(%%(node_paths)s::text[]::ltree[]) RETURNING node_path"
     initTableSQL = "INSERT INTO %s(node_path) VALUES('')"
+    createTriggerSQL = "CREATE TRIGGER minitree_notify \
+AFTER INSERT OR UPDATE OF node_path, node_value OR DELETE ON %s \
+FOR EACH ROW EXECUTE PROCEDURE minitree_notify()"
+    notifySQL = "SELECT pg_notify(%s, %s)"
+    enableEffectiveSQL = "SELECT minitree_enable_effective(c) \
+FROM to_regclass(%s) AS c WHERE c IS NOT NULL"
+    enableChangelogSQL = "SELECT minitree_enable_changelog(c) \
+FROM to_regclass(%s) AS c WHERE c IS NOT NULL"
+    logDropSQL = "SELECT minitree_log_drop(%s::regclass)"
+    declareSQL = "SET LOCAL idle_in_transaction_session_timeout = %d; \
+DECLARE minitree_stream NO SCROLL CURSOR FOR %s; \
+FETCH %d FROM minitree_stream"
+    fetchSQL = "FETCH %d FROM minitree_stream"
+
+    streamSize = 1000
+    # seconds a stream waits for its consumer, holding the transaction
+    # of its cursor
+    streamTimeout = 60
+
+    # (name suffix, definition) of the indexes on every node table, the
+    # unique btree on node_path only serves equality lookups
+    nodeIndexes = (("node_path_gist", "USING gist (node_path)"),
+                   ("nlevel", "(nlevel(node_path))"))
+
+    notifyChannel = "minitree"
+    reconnectDelay = 5
+    replicaWindow = 5
+    healthCheckSQL = "SELECT 1"
 
     regexNoTable = re.compile(r"relation \"[^\"]+\" does not exist")
     regexNoSchema = re.compile(r"schema \"[^\"]+\" does not exist")
 
     def __init__(self):
         self.pool = None
+        self.dsn = None
+        self.cache = None
+        self.listener = None
+        self.listening = False
+        self.observers = []
+        self.prepared = None
+        self.materialized = set()
+        self.changelogged = set()
+        self.tables = set()
+        self.tablesLoop = None
+        self.replicas = []
+        self.replicasLoop = None
+        self.replicaIndex = 0
+        self.lastChange = dict()
+        self.flights = dict()
+        self.groupCommit = None
+        self.updateBatches = dict()
 
     @staticmethod
     def _buildTableName(schema, table):
@@ -62,6 +183,20 @@ last_modification timestamp default now())"
 
         return "\"%s\".\"%s\"" % (_quote(schema), _quote(table))
 
+    @staticmethod
+    def _buildIndexName(table, suffix):
+        return "\"%s_%s\"" % (table.replace("\"", "\\\""), suffix)
+
+    def _createIndexSQL(self, schema, table, concurrently=False):
+        """
+        Return the statements creating the `nodeIndexes` of a table.
+        """
+        tablename = self._buildTableName(schema, table)
+        return [self.createIndexSQL % (
+                concurrently and "CONCURRENTLY IF NOT EXISTS" or "",
+                self._buildIndexName(table, suffix), tablename, definition)
+                for suffix, definition in self.nodeIndexes]
+
     @staticmethod
     def _serialize_hstore(val):
         """
@@ -102,38 +237,230 @@ last_modification timestamp default now())"
 
     def connect(self, *args, **kwargs):
         assert(self.pool == None)
-        self.pool = txpostgres.ConnectionPool(None, *args, **kwargs)
+        self.dsn = args and args[0] or kwargs.get("dsn")
+        self.pool = _ConnectionPool(None, *args, **kwargs)
         return self.pool.start()
 
-    def _selectPath(self, c, path, sql, q=None):
+    def enablePrepared(self, size):
+        """
+        Run queries as server side prepared statements, keeping up to
+        `size` of them per pooled connection.
+        """
+        self.prepared = PreparedStatements(size)
 
-        def _exists(c):
-            if not c.fetchone():
-                raise  NodeNotFound()
+    def _execute(self, c, sql, params=None, tablename=None):
+        if self.prepared is None:
+            return c.execute(sql, params)
+        return self.prepared.execute(c, sql, params, tablename)
 
-        schema, table, node_path = self._splitPath(path)
+    def materialize(self, paths):
+        """
+        Keep the override result of every node of the "schema.table"
+        collections in `paths` in an effective_value column, maintained
+        by triggers, so that getOverridedNode is a point lookup there.
+        """
+        dl = []
+        for path in paths:
+            schema, table, _ = self._splitPath(path)
+            tablename = self._buildTableName(schema, table)
+            self.materialized.add(tablename)
+            dl.append(self.pool.runOperation(self.enableEffectiveSQL,
+                                             [tablename]))
+        return defer.gatherResults(dl)
+
+    def changelog(self, paths):
+        """
+        Log every change of the "schema.table" collections in `paths` in
+        minitree_changes, for processes keeping them in memory.
+        """
+        dl = []
+        for path in paths:
+            schema, table, _ = self._splitPath(path)
+            tablename = self._buildTableName(schema, table)
+            self.changelogged.add(tablename)
+            dl.append(self.pool.runOperation(self.enableChangelogSQL,
+                                             [tablename]))
+        return defer.gatherResults(dl)
+
+    def _overrideSQL(self, path, sql, effective):
+        try:
+            schema, table, _ = self._splitPath(path)
+        except PathError:
+            return sql
+        if self._buildTableName(schema, table) in self.materialized:
+            return effective
+        return sql
+
+    def enableCache(self, size):
+        """
+        Keep up to `size` decoded select/override results in memory.
+        Cached results are only served while the change listener is up.
+        """
+        self.cache = NodeCache(size)
+
+    def listen(self, *args, **kwargs):
+        """
+        Open a dedicated connection which LISTENs for the notifications
+        sent by the minitree_notify trigger and invalidates cached nodes.
+        """
+        def _listening(_):
+            self.listening = True
+
+        def _failed(e):
+            log.msg("Listening for changes failed: %s" % str(e.value))
+            self._listenerLost(listener, e)
+
+        listener = self.listener = _NotifyConnection(self._listenerLost)
+        listener.addNotifyObserver(self._notified)
+        d = listener.connect(*args, **kwargs)
+        d.addCallback(lambda _: listener.runOperation(
+                "LISTEN %s" % self.notifyChannel))
+        d.addCallbacks(_listening, _failed)
+        self._listenArgs = (args, kwargs)
+        return d
+
+    def _listenerLost(self, listener, reason):
+        if listener is not self.listener:
+            return
+        self.listener = None
+        self.listening = False
+        if self.cache is not None:
+            self.cache.clear()
+        if self.replicas:
+            self.lastChange[None] = reactor.seconds()
+        self.flights.clear()
+        # changes may be missed until the listener is back
+        for observer in self.observers:
+            observer(None, None, None)
+        args, kwargs = self._listenArgs
+        reactor.callLater(self.reconnectDelay, self.listen, *args, **kwargs)
+
+    def _notified(self, notify):
+        if notify.channel != self.notifyChannel:
+            return
+        try:
+            self._invalidate(*self._splitPath(notify.payload, False))
+        except PathError:
+            pass
+
+    def addChangeObserver(self, observer):
+        """
+        Call `observer(schema, table, node_path)` whenever a node and its
+        subtree change, locally or in another process. A `schema` of None
+        means that changes may have been missed.
+        """
+        self.observers.append(observer)
+
+    def _invalidate(self, schema, table, node_path, notify=True):
         tablename = self._buildTableName(schema, table)
+        if self.replicas:
+            self.lastChange[tablename] = reactor.seconds()
+        if self.cache is not None:
+            self.cache.invalidate(tablename, node_path)
+        # later callers must not join a read started before the change
+        for key in [x for x in self.flights if x[0] in (tablename, None)]:
+            del self.flights[key]
+        if notify:
+            for observer in self.observers:
+                observer(schema, table, node_path)
+
+    def _written(self, result, path):
         try:
-            d = c.execute(self.selectOneSQL % tablename,
-                          dict(node_path=node_path))
-            d.addCallback(_exists)
-            if q:
-                d.addCallback(lambda _, c: c.execute(sql % tablename,
-                                                     dict(q=q)), c)
-            else:
-                d.addCallback(lambda _, c: c.execute(
-                        sql % tablename, dict(node_path=node_path)), c)
-            d.addCallback(lambda c: map(lambda x: x[0].decode("UTF-8"),
-                                        c.fetchall()))
-            return d
-        except psycopg2.ProgrammingError as e:
-            err = str(e)
-            if self.regexNoSchema.match(err):
-                raise NodeNotFound("schema not found")
-            elif self.regexNoTable.match(err):
-                raise NodeNotFound("collection not found")
-            else:
-                raise
+            # observers hear of the write from its notification if
+            # listening, the cache must not wait for it
+            self._invalidate(*self._splitPath(path),
+                             notify=not self.listening)
+        except PathError:
+            pass
+        return result
+
+    def _cached(self, path, kind, f):
+        if self.cache is None or not self.listening:
+            return f()
+        try:
+            schema, table, node_path = self._splitPath(path)
+        except PathError:
+            return f()
+
+        key = (self._buildTableName(schema, table), node_path, kind)
+        value = self.cache.get(key)
+        if value is not None:
+            return defer.succeed(value)
+        if self._replicas(key[0]):
+            # a replica may not have replayed the last change yet
+            return f()
+
+        generation = self.cache.generation
+        d = f()
+        d.addCallback(self._cacheStore, key, generation)
+        return d
+
+    def _cacheStore(self, value, key, generation):
+        self.cache.set(key, value, generation)
+        return value
+
+    def _shared(self, path, kind, f, *args):
+        """
+        Call `f` once for concurrent reads of the same `kind` of `path`
+        and `args`. Every caller gets a Deferred of its own, which can be
+        cancelled without cancelling the read for the others.
+        """
+        key = (self._tablename(path), path, kind) + args
+        flight = self.flights.get(key)
+        if flight is not None:
+            coalescedReads.inc((kind,))
+            return flight.follow()
+
+        flight = _Flight(self.flights, key)
+        d = flight.follow()
+        flight.start(defer.maybeDeferred(f))
+        return d
+
+    def _probe(self, sql, tablename):
+        """
+        Wrap the query `sql` so that it also probes for the target node.
+        No row means the node does not exist, a row of NULLs means the
+        node exists but `sql` matched nothing.
+        """
+        return self.probeSQL % (tablename, sql % tablename)
+
+    @staticmethod
+    def _page(sql, limit, after):
+        """
+        Restrict `sql` to the `limit` paths following `after`. Keyset
+        pagination keeps every page a short range scan of the primary
+        key, however deep it is.
+        """
+        if after is not None:
+            sql += " AND node_path > %%(after)s"
+        if limit is not None:
+            sql += " ORDER BY node_path LIMIT %%(limit)s"
+        return sql
+
+    def _after(self, path, after, prefix=None):
+        """
+        Turn the full path `after`, as returned by a previous page, into
+        a node_path of the table of `path`.
+        """
+        if after is None:
+            return None
+        if prefix is None:
+            prefix = "%s.%s." % self._splitPath(path, False)[:2]
+        if not after.startswith(prefix):
+            raise PathError("cursor does not belong to %s" % path)
+        return after[len(prefix):]
+
+    def _selectPath(self, c, path, sql, q=None, limit=None, after=None):
+        schema, table, node_path = self._splitPath(path)
+        tablename = self._buildTableName(schema, table)
+
+        d = self._execute(c, self._probe(self._page(sql, limit, after),
+                                         tablename) + " ORDER BY 1",
+                          dict(node_path=node_path, q=q, limit=limit,
+                               after=after), tablename)
+        d.addBoth(self._selectNodeFinish)
+        d.addCallback(lambda r: map(lambda x: x[0].decode("UTF-8"), r))
+        return d
 
     def _patch_path_heading(self, value, path):
         schema, table, node_path = self._splitPath(path, False)
@@ -142,70 +469,211 @@ last_modification timestamp default now())"
                    value)
 
     def getAncestors(self, path):
-        d = self.pool.runInteraction(self._selectPath, path,
-                                     self.selectAncestorSQL)
-        d.addCallback(self._patch_path_heading, path)
+        def _select():
+            d = self._read(self._tablename(path), self._selectPath, path,
+                           self.selectAncestorSQL)
+            return d.addCallback(self._patch_path_heading, path)
 
-        return d
+        return self._shared(path, "ancestors", _select)
 
-    def getChildren(self, path):
+    def getChildren(self, path, limit=None, after=None):
+        """
+        Fire with the paths of the children of `path` in order, or with
+        at most `limit` of them following the path `after`.
+        """
         p = path.lstrip("/").split("/")
         n = len(p)
 
-        if n == 1:
-            d = self.pool.runInteraction(self._selectDBObject, p[0],
-                                         self.selectTablesSQL)
-        elif n == 2:
-            d = self.pool.runInteraction(self._selectPath,
-                                         ".".join(p),
-                                         self.selectAllSQL, q="*{1}")
-            d.addCallback(self._patch_path_heading, path)
-        else:
-            d = self.pool.runInteraction(self._selectPath,
-                                         ".".join(p),
-                                         self.searchNodeSQL,
-                                         q="%s.*{1}" % ".".join(p[2:]))
-            d.addCallback(self._patch_path_heading, path)
+        def _tables(result):
+            result = sorted(result)
+            if after is not None:
+                result = [x for x in result if x > after]
+            return result[:limit]
+
+        def _select():
+            if n == 1:
+                d = self._read(None, self._selectDBObject, p[0],
+                               self.selectTablesSQL)
+                if limit is None and after is None:
+                    return d
+                return d.addCallback(_tables)
+            d = self._read(self._tablename(path), self._selectPath,
+                           ".".join(p), self.selectChildrenSQL, None,
+                           limit, self._after(path, after))
+            return d.addCallback(self._patch_path_heading, path)
+
+        return self._shared(path, "children", _select, limit, after)
+
+    def getDescendants(self, path, limit=None, after=None):
+        def _select():
+            d = self._read(self._tablename(path), self._selectPath, path,
+                           self.selectDescentantsSQL, None, limit,
+                           self._after(path, after))
+            return d.addCallback(self._patch_path_heading, path)
+
+        return self._shared(path, "descendants", _select, limit, after)
+
+    def _selectTree(self, c, path, depth):
+        schema, table, node_path = self._splitPath(path)
+        tablename = self._buildTableName(schema, table)
+        sql = self.selectTreeSQL
+        if depth is not None:
+            sql += self.treeDepthSQL
+
+        d = self._execute(c, sql % tablename + " ORDER BY node_path",
+                          dict(node_path=node_path, depth=depth), tablename)
+        d.addBoth(self._selectNodeFinish)
         return d
 
-    def getDescendants(self, path):
-        d = self.pool.runInteraction(self._selectPath, path,
-                                     self.selectDescentantsSQL)
-        d.addCallback(self._patch_path_heading, path)
+    @staticmethod
+    def _buildTree(rows, node_path):
+        """
+        Nest `rows` of (node_path, json value, modified) in path order
+        below the one of `node_path`. Parents sort before their children,
+        so a row only has to look up the entry of its parent.
+        """
+        def _entry(path):
+            entry = entries.get(path)
+            if entry is None:
+                # a missing intermediate node
+                entry = entries[path] = dict(value=None, children=dict())
+                _attach(path, entry)
+            return entry
+
+        def _attach(path, entry):
+            parent, _, label = path.rpartition(".")
+            _entry(parent)["children"][label.decode("UTF-8")] = entry
 
+        if rows[0][0] != node_path:
+            raise NodeNotFound()
+        # decode every value with a single call
+        values = json_decode("[%s]" % ",".join(x[1] or "{}" for x in rows))
+        entries = dict()
+        for (path, _, _), value in zip(rows, values):
+            entry = entries[path] = dict(value=value, children=dict())
+            if path != node_path:
+                _attach(path, entry)
+        return NodeValue(entries[node_path], max(x[2] for x in rows),
+                         len(rows))
+
+    def getTree(self, path, depth=None):
+        """
+        Fire with the values of the subtree at `path` nested as
+        {"value": ..., "children": {label: ...}}, down to `depth` levels
+        below it, read with one query.
+        """
+        def _select():
+            d = self._read(self._tablename(path), self._selectTree, path,
+                           depth)
+            return d.addCallback(self._buildTree,
+                                 self._splitPath(path)[2])
+
+        return self._shared(path, "tree", _select, depth)
+
+    def _stream(self, c, path, sql, order, consumer, q=None):
+        """
+        Run `sql` through a server side cursor and hand the rows to
+        `consumer` `streamSize` at a time. A Deferred returned by the
+        consumer delays the next FETCH until it fires, or is cancelled
+        after `streamTimeout` seconds, which fails the stream.
+        """
+        def _rows(c, first):
+            if isinstance(c, Failure):
+                self._selectNodeFinish(c)
+            rows = c.fetchall()
+            if first and not rows:
+                raise NodeNotFound()
+            d = defer.maybeDeferred(consumer,
+                                    [row for row in rows if row[0] is not None])
+            if not d.called:
+                call = reactor.callLater(self.streamTimeout, d.cancel)
+                d.addErrback(_stalled, call)
+                d.addBoth(lambda r: call.active() and call.cancel() or r)
+            if len(rows) == self.streamSize:
+                d.addCallback(lambda _: c.execute(
+                        self.fetchSQL % self.streamSize))
+                d.addBoth(_rows, False)
+            return d
+
+        def _stalled(e, call):
+            e.trap(defer.CancelledError)
+            if call.active():
+                # cancelled by the consumer
+                return e
+            raise defer.TimeoutError("the stream consumer stalled")
+
+        schema, table, node_path = self._splitPath(path)
+        tablename = self._buildTableName(schema, table)
+
+        sql = self._probe(sql, tablename) + order
+        # in case this process stops fetching too, in milliseconds
+        d = c.execute(self.declareSQL % (self.streamTimeout * 2000, sql,
+                                         self.streamSize),
+                      dict(node_path=node_path, q=q))
+        d.addBoth(_rows, True)
         return d
 
+    def streamDescendants(self, path, consumer):
+        def _paths(rows):
+            return consumer(self._patch_path_heading(
+                    map(lambda x: x[0].decode("UTF-8"), rows), path))
+
+        return self._readPool(self._tablename(path)).runInteraction(
+            self._stream, path, self.selectDescentantsSQL, " ORDER BY 1",
+            _paths)
+
     def getOverridedNode(self, path):
-        def _decode(x):
-            return (x[0].decode("UTF-8"), x[1].decode("UTF-8"))
+        def _select():
+            d = self._read(self._tablename(path), self._selectNode, path,
+                           self._overrideSQL(path, self.selectOverrideSQL,
+                                             self.selectEffectiveSQL),
+                           self.ancestorsValidatorSQL)
+            d.addCallback(self._nodeValue)
+            return d
 
-        d = self.pool.runInteraction(self._selectNode, path,
-                                     self.selectOverrideSQL)
-        d.addCallback(lambda x: dict(map(_decode, x)))
+        return self._cached(path, "override",
+                            lambda: self._shared(path, "override", _select))
 
-        return d
+    @staticmethod
+    def _comboPairs(rows):
+        """
+        Turn (key, JSON array of values) rows into (key, values) pairs,
+        decoding all the arrays at once.
+        """
+        values = json_decode("[%s]" % ",".join(x[1] for x in rows))
+        return zip((x[0].decode("UTF-8") for x in rows), values)
 
     def getComboNode(self, path):
 
-        def _combo(result):
-            combo = defaultdict(list)
-            map(lambda x: combo[x[0]].append(x[1].decode("UTF-8")), result)
-            return combo
+        def _select():
+            d = self._read(self._tablename(path), self._selectNode, path,
+                           self.selectComboSQL, self.ancestorsValidatorSQL)
+            return d.addCallback(lambda result: NodeValue(
+                    self._comboPairs(result[0]), *result[1]))
 
-        d = self.pool.runInteraction(self._selectNode, path,
-                                     self.selectComboSQL)
-        return d.addCallback(_combo)
+        return self._shared(path, "combo", _select)
 
     def getReverseComboNode(self, path):
 
-        def _rcombo(result):
-            rcombo = defaultdict(list)
-            map(lambda x: rcombo[x[0]].append(x[1].decode("UTF-8")), result)
-            return rcombo
+        def _select():
+            d = self._read(self._tablename(path), self._selectNode, path,
+                           self.selectReverseComboSQL)
+            d.addCallback(self._comboPairs)
+            return d.addCallback(dict)
+
+        return self._shared(path, "rcombo", _select)
 
-        d = self.pool.runInteraction(self._selectNode, path,
-                                     self.selectReverseComboSQL)
-        return d.addCallback(_rcombo)
+    def streamReverseCombo(self, path, consumer):
+        """
+        Like getReverseComboNode, but hand (key, values) pairs to
+        `consumer` as they are read, one row per key.
+        """
+        def _pairs(rows):
+            return consumer(self._comboPairs(rows))
+
+        return self._readPool(self._tablename(path)).runInteraction(
+            self._stream, path, self.selectReverseComboSQL, " ORDER BY 1",
+            _pairs)
 
     def _selectDBObject(self, c, name, sql):
 
@@ -215,12 +683,12 @@ last_modification timestamp default now())"
             else:
                 raise NodeNotFound()
 
-        d = c.execute(sql, dict(name=name))
+        d = self._execute(c, sql, dict(name=name))
         d.addCallback(lambda c: c.fetchall())
         d.addBoth(_finish, c)
         return d
 
-    def _selectNodeFinish(self, c):
+    def _selectNodeFinish(self, c, validated=False):
         if isinstance(c, Failure):
             exc = c.value
             s_exc = str(exc)
@@ -232,125 +700,576 @@ last_modification timestamp default now())"
 
             raise c.value
 
-        return c.fetchall()
-
-    def _selectNode(self, c, path, sql):
-
-        def _exists(c):
-            if not c.fetchone():
-                raise  NodeNotFound()
+        rows = c.fetchall()
+        if not rows:
+            raise NodeNotFound()
+        found = [row for row in rows if row[0] is not None]
+        if validated:
+            # the validator columns come last, on every row
+            return found, rows[0][-2:]
+        return found
 
+    def _selectNode(self, c, path, sql, validator=None):
+        """
+        Select the rows of `sql` for an existing node. With a `validator`
+        query, fire with the rows and the validator row instead.
+        """
         schema, table, node_path = self._splitPath(path)
         tablename = self._buildTableName(schema, table)
 
-        d = c.execute(self.selectOneSQL % tablename, dict(node_path=node_path))
-        d.addCallback(_exists)
-        d.addCallback(lambda _, c: c.execute(sql % tablename,
-                                             dict(node_path=node_path)), c)
-        d.addBoth(self._selectNodeFinish)
+        if validator is None:
+            sql = self._probe(sql, tablename)
+        else:
+            sql = self.probeValidatorSQL % (tablename, validator % tablename,
+                                            sql % tablename)
+        d = self._execute(c, sql, dict(node_path=node_path), tablename)
+        d.addBoth(self._selectNodeFinish, validator is not None)
 
         return d
 
+    @staticmethod
+    def _nodeValue(result):
+        rows, validator = result
+        return NodeValue(((x[0].decode("UTF-8"), x[1].decode("UTF-8"))
+                          for x in rows), *validator)
+
     def selectNode(self, path):
-        def _decode(x):
-            return (x[0].decode("UTF-8"), x[1].decode("UTF-8"))
+        def _select():
+            d = self._read(self._tablename(path), self._selectNode, path,
+                           self.selectSQL, self.nodeValidatorSQL)
+            d.addCallback(self._nodeValue)
+            return d
+
+        return self._cached(path, "select",
+                            lambda: self._shared(path, "select", _select))
+
+    def _selectManyFinish(self, c):
+        if isinstance(c, Failure):
+            exc = c.value
+            s_exc = str(exc)
+            if isinstance(exc, psycopg2.ProgrammingError):
+                if self.regexNoSchema.match(s_exc) or \
+                        self.regexNoTable.match(s_exc):
+                    return []
+            raise exc
+
+        return c.fetchall()
 
-        d = self.pool.runInteraction(self._selectNode, path, self.selectSQL)
-        d.addCallback(lambda x: dict(map(_decode, x)))
+    def _selectMany(self, c, tablename, sql, node_paths):
+        d = self._execute(c, sql % tablename, dict(node_paths=node_paths),
+                          tablename)
+        d.addBoth(self._selectManyFinish)
         return d
 
-    def searchNode(self, path, q):
-        prefix = path.lstrip("/").replace("/", ".") + "."
-        d = self.pool.runInteraction(self._selectPath, path,
-                                     self.searchNodeSQL, q)
-        d.addCallback(lambda r: map(lambda x: prefix + x, r))
+    def _selectNodes(self, paths, kind, sql):
+        """
+        Look up many paths with one set based query per table. Fires with
+        a dict of the paths found; missing nodes and bad paths are left
+        out.
+        """
+        def _found(rows, tablename, group, generation):
+            for node_path, value, modified, versions in rows:
+                value = NodeValue(json_decode(value or "{}"), modified,
+                                  versions)
+                for path in group[node_path]:
+                    result[path] = value
+                if generation is not None:
+                    self.cache.set((tablename, node_path, kind), value,
+                                   generation)
+
+        cached = self.cache is not None and self.listening
+        generation = None
+        if cached:
+            generation = self.cache.generation
+        result = dict()
+        groups = defaultdict(lambda: defaultdict(list))
+        for path in paths:
+            try:
+                schema, table, node_path = self._splitPath(path)
+            except PathError:
+                continue
+            tablename = self._buildTableName(schema, table)
+            if cached:
+                value = self.cache.get((tablename, node_path, kind))
+                if value is not None:
+                    result[path] = value
+                    continue
+            groups[tablename][node_path].append(path)
 
+        dl = []
+        for tablename, group in groups.iteritems():
+            stored = generation
+            if self._replicas(tablename):
+                # results of replicas are not cached
+                stored = None
+            if kind == "override" and tablename in self.materialized:
+                d = self._read(tablename, self._selectMany, tablename,
+                               self.selectEffectiveManySQL, group.keys())
+            else:
+                d = self._read(tablename, self._selectMany, tablename,
+                               sql, group.keys())
+            d.addCallback(_found, tablename, group, stored)
+            dl.append(d)
+
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda _: result)
         return d
 
-    def _createFinish(self, e, c, inode, icall):
+    def selectNodes(self, paths):
+        return self._selectNodes(paths, "select", self.selectManySQL)
+
+    def getOverridedNodes(self, paths):
+        return self._selectNodes(paths, "override",
+                                 self.selectOverrideManySQL)
+
+    def searchNode(self, path, q, limit=None, after=None):
+        prefix = path.lstrip("/").replace("/", ".") + "."
+        def _select():
+            d = self._read(self._tablename(path), self._selectPath, path,
+                           self.searchNodeSQL, q, limit,
+                           self._after(path, after, prefix))
+            return d.addCallback(lambda r: map(lambda x: prefix + x, r))
+
+        return self._shared(path, "search", _select, q, limit, after)
+
+    def streamSearch(self, path, q, consumer):
+        prefix = path.lstrip("/").replace("/", ".") + "."
+        return self._readPool(self._tablename(path)).runInteraction(
+            self._stream, path, self.searchNodeSQL, " ORDER BY 1",
+            lambda r: consumer(map(lambda x: prefix + x[0].decode("UTF-8"),
+                                   r)), q)
+
+    def _createFinish(self, e, c, inode):
         if isinstance(e, Failure):
-            schema, tablename, node_path = inode
-            path, content, ncall = icall
+            schema, table, node_path = inode
             exc = e.value
             s_exc = str(exc)
             if isinstance(exc, psycopg2.IntegrityError):
                 if s_exc.startswith("duplicate key value violates"):
                     raise PathDuplicatedError("%s already exists" % node_path)
             elif isinstance(exc, psycopg2.ProgrammingError):
-                if self.regexNoSchema.match(s_exc):
-                    d = c.execute("ROLLBACK")
-                    d.addCallback(lambda c:
-                                      c.execute(self.createSchemaSQL % schema))
-                    d.addCallback(self._createNode, path, content,
-                                  ncall=ncall + 1)
-                    return d
-                elif self.regexNoTable.match(s_exc):
-                    d = c.execute("ROLLBACK")
-                    d.addCallback(lambda c: c.execute(
-                            self.createTableSQL % tablename))
-                    if node_path:
-                        d.addCallback(lambda c: c.execute(
-                                self.initTableSQL % tablename))
-                    d.addCallback(self._createNode, path, content,
-                                  ncall=ncall + 1)
-                    return d
+                if self.regexNoSchema.match(s_exc) or \
+                        self.regexNoTable.match(s_exc):
+                    # dropped by somebody else since it was registered
+                    self.tables.discard((schema, table))
+                    raise _UnknownTable()
             raise exc
         else:
             return c._cursor.rowcount
 
-    def _createNode(self, c, path, content, ncall=0):
+    def _createNode(self, c, created, path, content):
 
         def _exists(c):
             if not c.fetchone():
                 raise  NodeNotFound()
 
-        if ncall > 3:
-            raise NodeCreationError("internal error")
         schema, table, node_path = self._splitPath(path)
         tablename = self._buildTableName(schema, table)
         hstore_value = self._serialize_hstore(content)
 
         parent_path, rest = splitext(node_path)
-        d = c.execute(self.selectOneSQL % tablename,
-                      dict(node_path=parent_path))
-        if rest:  # check exists when first execution
+        d = self._ensureTable(c, created, schema, table, bool(node_path))
+        if rest:
+            d.addCallback(lambda _, c: self._execute(
+                    c, self.selectOneSQL % tablename,
+                    dict(node_path=parent_path), tablename), c)
             d.addCallback(_exists)
-        d.addCallback(lambda _, c: c.execute(self.createSQL % tablename,
-                                             [node_path, hstore_value]), c)
-        d.addBoth(self._createFinish, c, (schema, tablename, node_path),
-                  (path, content, ncall))
+        d.addCallback(lambda _, c: self._execute(
+                c, self.createSQL % tablename, [node_path, hstore_value],
+                tablename), c)
+        d.addBoth(self._createFinish, c, (schema, table, node_path))
 
         return d
 
     def createNode(self, path, content):
-        return self.pool.runInteraction(self._createNode, path, content)
+        def _retry(e):
+            e.trap(_UnknownTable)
+            d = self._creating(self._createNode, path, content)
+            d.addErrback(_failed)
+            return d
+
+        def _failed(e):
+            e.trap(_UnknownTable)
+            raise NodeCreationError("internal error")
+
+        d = self._creating(self._createNode, path, content)
+        d.addErrback(_retry)
+        d.addCallback(self._written, path)
+        return d
+
+    def _importTree(self, path, stream, format):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            return bulk.importNodes(conn, self, path,
+                                    bulk.readNodes(stream, format))
+        finally:
+            conn.close()
+
+    def importTree(self, path, stream, format="ndjson"):
+        """
+        Bulk load a subtree below `path` from `stream` with COPY. The load
+        runs on a blocking connection in the reactor thread pool.
+        """
+        d = threads.deferToThread(self._importTree, path, stream, format)
+        d.addCallback(self._written, path)
+        return d
 
     def _deleteNode(self, c, path, content, cascade=False):
         schema, table, node_path = self._splitPath(path)
         tablename = self._buildTableName(schema, table)
         if content:
             hstore_key = content.keys()
-            d = c.execute(self.deleteSQL % tablename, [hstore_key, node_path])
+            d = self._execute(c, self.deleteSQL % tablename,
+                              [hstore_key, node_path], tablename)
             d.addCallback(lambda c: c._cursor.rowcount)
             return d
         elif node_path:
             if cascade:
-                d = c.execute(self.deleteNodeCascadedSQL % tablename,
-                            [node_path])
+                d = self._execute(c, self.deleteNodeCascadedSQL % tablename,
+                                  [node_path], tablename)
             else:
-                d = c.execute(self.deleteNodeSQL % tablename, [node_path])
+                d = self._execute(c, self.deleteNodeSQL % tablename,
+                                  [node_path], tablename)
             d.addCallback(lambda c: c._cursor.rowcount)
             return d
         elif cascade:
-            d = c.execute(self.dropTableSQL % tablename)
+            # DROP TABLE does not fire row triggers, notify explicitly
+            # and answer with the row count of the DROP, not of the notify
+            self.tables.discard((schema, table))
+            if self.prepared is not None:
+                self.prepared.forget(tablename)
+            if tablename in self.changelogged:
+                d = c.execute(self.logDropSQL, [tablename])
+            else:
+                d = defer.succeed(c)
+            d.addCallback(lambda c: c.execute(self.dropTableSQL % tablename))
             d.addCallback(lambda c: c._cursor.rowcount)
+            d.addCallback(lambda rowcount: c.execute(self.notifySQL, [
+                        self.notifyChannel, "%s.%s" % (schema, table)
+                        ]).addCallback(lambda _: rowcount))
             return d
         else:
             return defer.succeed(0)
 
     def deleteNode(self, path, content, cascade):
-        return self.pool.runInteraction(self._deleteNode, path, content,
-                                        cascade)
+        d = self.pool.runInteraction(self._deleteNode, path, content,
+                                     cascade)
+        d.addCallback(self._written, path)
+        return d
+
+    def loadTables(self):
+        """
+        Reload the registry of existing (schema, table) pairs.
+        """
+        def _loaded(rows):
+            self.tables = set(rows)
+
+        d = self.pool.runQuery(self.selectAllTablesSQL)
+        d.addCallback(_loaded)
+        return d
+
+    def addReplica(self, *args, **kwargs):
+        """
+        Send reads to another server too. The arguments are those of
+        connect. Fires once the replica was checked, it is used as soon
+        as it is found healthy.
+        """
+        replica = _Replica(args, kwargs)
+        self.replicas.append(replica)
+        return self._checkReplica(replica)
+
+    def watchReplicas(self, interval, window=None):
+        """
+        Check the replicas every `interval` seconds. Reads of a table
+        changed within `window` seconds go to the primary, so that
+        clients read their own writes.
+        """
+        if window is not None:
+            self.replicaWindow = window
+        self.replicasLoop = task.LoopingCall(self._checkReplicas, interval)
+        d = self.replicasLoop.start(interval, False)
+        d.addErrback(lambda e: log.err(e, "Checking replicas failed"))
+
+    def _checkReplicas(self, timeout):
+        return defer.DeferredList([self._checkReplica(x, timeout)
+                                   for x in self.replicas])
+
+    def _checkReplica(self, replica, timeout=None):
+        def _up(_):
+            if not replica.healthy:
+                log.msg("Replica %s is up" % replica)
+            replica.healthy = True
+
+        def _down(e):
+            if replica.healthy is not False:
+                log.msg("Replica %s is down: %s" % (replica, e.value))
+            replica.healthy = False
+            pool, replica.pool = replica.pool, None
+            if pool is not None:
+                # reconnect from scratch on the next check
+                defer.maybeDeferred(pool.close).addErrback(lambda _: None)
+
+        def _timeout(d):
+            if not d.called:
+                d.cancel()
+
+        if replica.pool is None:
+            replica.pool = _ConnectionPool(None, *replica.args,
+                                           **replica.kwargs)
+            d = replica.pool.start()
+            d.addCallback(lambda _: replica.pool.runQuery(
+                    self.healthCheckSQL))
+        else:
+            d = replica.pool.runQuery(self.healthCheckSQL)
+        if timeout:
+            call = reactor.callLater(timeout, _timeout, d)
+            d.addBoth(lambda r: call.active() and call.cancel() or r)
+        d.addCallbacks(_up, _down)
+        return d
+
+    def _replicas(self, tablename):
+        """
+        Return the replicas `tablename` may be read from now, none if it
+        must be read from the primary.
+        """
+        healthy = [x for x in self.replicas if x.healthy]
+        if not healthy:
+            return healthy
+        if self.listener is not None and not self.listening:
+            # writes of other processes go unheard until it listens
+            return []
+        now = reactor.seconds()
+        for key in (tablename, None):
+            if now - self.lastChange.get(key, 0) < self.replicaWindow:
+                return []
+        return healthy
+
+    def _replica(self, tablename):
+        """
+        Pick the replica to read `tablename` from, None for the primary.
+        """
+        healthy = self._replicas(tablename)
+        if not healthy:
+            return None
+        self.replicaIndex += 1
+        return healthy[self.replicaIndex % len(healthy)]
+
+    def _tablename(self, path):
+        try:
+            return self._buildTableName(*self._splitPath(path)[:2])
+        except PathError:
+            return None
+
+    def _readPool(self, tablename):
+        replica = self._replica(tablename)
+        if replica is None:
+            return self.pool
+        return replica.pool
+
+    def _read(self, tablename, read, *args, **kwargs):
+        """
+        Run `read`, a function of a cursor sending a single read only
+        statement, on a replica, or on the primary if there is none to
+        use. A replica which fails to run it is taken out and the
+        primary runs it instead.
+        """
+        def _failed(e):
+            e.trap(psycopg2.OperationalError, psycopg2.InterfaceError)
+            log.msg("Replica %s failed: %s" % (replica, e.value))
+            replica.healthy = False
+            return self.pool.runRead(read, *args, **kwargs)
+
+        replica = self._replica(tablename)
+        if replica is None:
+            return self.pool.runRead(read, *args, **kwargs)
+        d = replica.pool.runRead(read, *args, **kwargs)
+        d.addErrback(_failed)
+        return d
+
+    def watchTables(self, interval):
+        """
+        Load the table registry now and every `interval` seconds, to
+        notice tables created or dropped by other processes.
+        """
+        self.tablesLoop = task.LoopingCall(self.loadTables)
+        d = self.tablesLoop.start(interval)
+        d.addErrback(lambda e: log.err(e, "Loading tables failed"))
+
+    def _creating(self, interaction, *args):
+        """
+        Run `interaction`, which may create tables, in a transaction. The
+        tables it creates are registered once the transaction commits,
+        as a rolled back CREATE TABLE must not stay in the registry.
+        """
+        def _committed(result):
+            self.tables.update(created)
+            return result
+
+        created = []
+        d = self.pool.runInteraction(interaction, created, *args)
+        d.addCallback(_committed)
+        return d
+
+    def _ensureTable(self, c, created, schema, table, root=True):
+        """
+        Create `schema`.`table` inside the running transaction unless it
+        is known to exist. Creation is serialized between processes by an
+        advisory lock on the schema. A root node is added to new tables
+        if `root`. Tables found are registered right away, the ones
+        created are appended to `created` for the caller to register
+        after the commit.
+        """
+        def _created(c):
+            created.append((schema, table))
+            return c
+
+        def _create(c):
+            if c.fetchone():
+                self.tables.add((schema, table))
+                return c
+            d = c.execute(self.createSchemaIfMissingSQL % schema)
+            d.addCallback(lambda c: c.execute(
+                    self.createTableSQL % tablename))
+            d.addCallback(lambda c: c.execute("; ".join(
+                        self._createIndexSQL(schema, table))))
+            d.addCallback(lambda c: c.execute(
+                    self.createTriggerSQL % tablename))
+            if tablename in self.materialized:
+                d.addCallback(lambda c: c.execute(
+                        self.enableEffectiveSQL, [tablename]))
+            if tablename in self.changelogged:
+                d.addCallback(lambda c: c.execute(
+                        self.enableChangelogSQL, [tablename]))
+            if root:
+                d.addCallback(lambda c: c.execute(
+                        self.initTableSQL % tablename))
+            d.addCallback(_created)
+            return d
+
+        if (schema, table) in self.tables:
+            return defer.succeed(c)
+
+        tablename = self._buildTableName(schema, table)
+        d = c.execute(self.lockSchemaSQL, [schema])
+        d.addCallback(lambda c: self._execute(c, self.tableExistsSQL,
+                                              [schema, table]))
+        d.addCallback(_create)
+        return d
+
+    def _mutateGroups(self, operations):
+        """
+        Split (op, path, content, cascade) operations into runs which can
+        be applied with one set based statement each. Creations, updates
+        and plain node deletions on the same table are grouped as long as
+        a node does not appear twice in a run; everything else runs on
+        its own.
+        """
+        groups = []
+        for op, path, content, cascade in operations:
+            schema, table, node_path = self._splitPath(path)
+            if op == "PUT":
+                kind = "create"
+                row = (node_path, self._serialize_hstore(content))
+            elif op == "POST":
+                kind = "update"
+                row = (node_path, self._serialize_hstore(content))
+            elif not content and node_path and not cascade:
+                kind = "delete"
+                row = node_path
+            else:
+                kind = None
+                row = (path, content, cascade)
+
+            last = groups and groups[-1]
+            if kind and last and last[:3] == (kind, schema, table) and \
+                    node_path not in last[4]:
+                last[3].append(row)
+                last[4].add(node_path)
+            else:
+                groups.append((kind, schema, table, [row], set([node_path])))
+        return groups
+
+    def _mutateGroup(self, _, c, created, kind, schema, table, rows):
+
+        def _orphans(c):
+            orphan = c.fetchone()
+            if orphan:
+                raise ParentNotFound("parent of %s not found" % orphan[0])
+
+        def _duplicated(e):
+            if e.check(psycopg2.IntegrityError) and \
+                    str(e.value).startswith("duplicate key value violates"):
+                raise PathDuplicatedError("node already exists")
+            return e
+
+        def _affected(c, node_paths):
+            found = set(map(lambda x: x[0], c.fetchall()))
+            return map(lambda x: int(x in found), node_paths)
+
+        if kind is None:
+            d = self._deleteNode(c, *rows[0])
+            d.addCallback(lambda rowcount: [rowcount])
+            return d
+
+        tablename = self._buildTableName(schema, table)
+        if kind == "delete":
+            d = self._execute(c, self.deleteNodeManySQL % tablename,
+                              dict(node_paths=rows), tablename)
+            d.addCallback(_affected, rows)
+            return d
+
+        node_paths = map(lambda x: x[0], rows)
+        node_values = map(lambda x: x[1], rows)
+        if kind == "update":
+            d = self._execute(c, self.updateManySQL % tablename,
+                              dict(node_paths=node_paths,
+                                   node_values=node_values), tablename)
+            d.addCallback(_affected, node_paths)
+            return d
+
+        d = self._ensureTable(c, created, schema, table, "" not in node_paths)
+        d.addCallback(lambda _: self._execute(
+                c, self.orphanManySQL % tablename,
+                dict(node_paths=node_paths), tablename))
+        d.addCallback(_orphans)
+        d.addCallback(lambda _: self._execute(
+                c, self.createManySQL % tablename,
+                dict(node_paths=node_paths, node_values=node_values),
+                tablename))
+        d.addCallbacks(lambda _: [1] * len(rows), _duplicated)
+        return d
+
+    def _mutate(self, c, created, operations):
+        affected = []
+        d = defer.succeed(None)
+        for group in self._mutateGroups(operations):
+            d.addCallback(self._mutateGroup, c, created, *group[:4])
+            d.addCallback(affected.extend)
+        d.addCallback(lambda _: affected)
+        d.addErrback(self._mutateFinish, operations)
+        return d
+
+    def _mutateFinish(self, e, operations):
+        if e.check(psycopg2.ProgrammingError):
+            # forget the tables, the next try checks them again
+            for op, path, content, cascade in operations:
+                self.tables.discard(self._splitPath(path)[:2])
+        return self._updateNodeFinish(e)
+
+    def mutate(self, operations):
+        """
+        Apply a list of (op, path, content, cascade) operations, where op
+        is PUT, POST or DELETE, in a single transaction. Fires with the
+        number of affected nodes of each operation.
+        """
+        def _written(affected):
+            for path in set(map(lambda x: x[1], operations)):
+                self._written(None, path)
+            return affected
+
+        d = self._creating(self._mutate, operations)
+        d.addCallback(_written)
+        return d
 
     def _updateNodeFinish(self, c):
         if isinstance(c, Failure):
@@ -371,14 +1290,318 @@ last_modification timestamp default now())"
         tablename = self._buildTableName(schema, table)
         hstore_value = self._serialize_hstore(content)
         try:
-            d = c.execute(self.updateSQL % tablename,
-                          [hstore_value, node_path])
+            d = self._execute(c, self.updateSQL % tablename,
+                              [hstore_value, node_path], tablename)
             d.addBoth(self._updateNodeFinish)
             return d
         except:
             return 0
 
     def updateNode(self, path, content):
-        return self.pool.runInteraction(self._updateNode, path, content)
+        if self.groupCommit is not None:
+            return defer.maybeDeferred(self._queueUpdate, path, content)
+        d = self.pool.runInteraction(self._updateNode, path, content)
+        d.addCallback(self._written, path)
+        return d
+
+    def enableGroupCommit(self, delay, size, clock=reactor):
+        """
+        Hold updateNode calls for up to `delay` seconds, or until `size`
+        of them are waiting on a table, and apply them with a single
+        UPDATE in one transaction per table. Patches to the same node
+        are merged in call order.
+        """
+        self.groupCommit = (delay, size, clock)
+
+    def _queueUpdate(self, path, content):
+        schema, table, node_path = self._splitPath(path)
+        # a value which does not serialize fails its caller, not the batch
+        self._serialize_hstore(content)
+        delay, size, clock = self.groupCommit
+        batch = self.updateBatches.get((schema, table))
+        if batch is None:
+            batch = _UpdateBatch(self.updateBatches, schema, table)
+            batch.call = clock.callLater(delay, self._flushUpdates, batch)
+        d = batch.add(node_path, content)
+        if batch.count >= size:
+            batch.call.cancel()
+            self._flushUpdates(batch)
+        return d
+
+    def _updateMany(self, c, tablename, node_paths, node_values):
+        d = self._execute(c, self.updateManySQL % tablename,
+                          dict(node_paths=node_paths,
+                               node_values=node_values), tablename)
+        d.addCallbacks(lambda c: set(map(lambda x: x[0], c.fetchall())),
+                       self._updateNodeFinish)
+        return d
+
+    def _flushUpdates(self, batch):
+        def _applied(found):
+            for node_path in found:
+                self._invalidate(batch.schema, batch.table, node_path,
+                                 not self.listening)
+            batch.applied(found)
+
+        batch.close()
+        updateBatchSize.observe(batch.count)
+        # rows are locked in the same order by every batch
+        node_paths = sorted(batch.updates)
+        d = self.pool.runInteraction(
+            self._updateMany,
+            self._buildTableName(batch.schema, batch.table), node_paths,
+            [self._serialize_hstore(batch.updates[x][0])
+             for x in node_paths])
+        d.addCallbacks(_applied, batch.failed)
+
+
+class _NotifyConnection(txpostgres.Connection):
+
+    def __init__(self, lost, *args, **kwargs):
+        txpostgres.Connection.__init__(self, *args, **kwargs)
+        self._lost = lost
+
+    def connectionLost(self, reason):
+        txpostgres.Connection.connectionLost(self, reason)
+        self._lost(self, reason)
+
+
+class RoundTrips(object):
+    """
+    Counts the statements sent to the server on behalf of a caller.
+    Backend calls made within context.call({RoundTrips: counter}, ...)
+    are counted in `counter`.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def resume(self, d):
+        """
+        Return a Deferred firing with the result of `d` in this context,
+        so that the calls of the callbacks added to it are counted too.
+        """
+        resumed = defer.Deferred(lambda _: d.cancel())
+        d.addBoth(lambda result: context.call({RoundTrips: self},
+                                              resumed.callback, result))
+        return resumed
+
+
+class _Cursor(txpostgres.Cursor):
+
+    roundtrips = None
+
+    def execute(self, *args, **kwargs):
+        if self.roundtrips is not None:
+            self.roundtrips.count += 1
+        return txpostgres.Cursor.execute(self, *args, **kwargs)
+
+
+class _Connection(txpostgres.Connection):
+
+    cursorFactory = _Cursor
+
+    def runQuery(self, *args, **kwargs):
+        if args and callable(args[0]):
+            # a read of _ConnectionPool.runRead
+            return defer.maybeDeferred(args[0], self.cursor(), *args[1:],
+                                       **kwargs)
+        return txpostgres.Connection.runQuery(self, *args, **kwargs)
+
+
+class _ConnectionPool(txpostgres.ConnectionPool):
+    """
+    A pool counting round trips of the calls made in a RoundTrips context,
+    and the calls running or waiting for a connection.
+    """
+
+    connectionFactory = _Connection
+
+    def __init__(self, *args, **kwargs):
+        txpostgres.ConnectionPool.__init__(self, *args, **kwargs)
+        self.running = 0
+
+    def _run(self, call, *args, **kwargs):
+        def _done(result):
+            self.running -= 1
+            return result
+
+        self.running += 1
+        d = call(self, *args, **kwargs)
+        d.addBoth(_done)
+        return d
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        def _interaction(c, *args, **kwargs):
+            # the BEGIN sent before the interaction and the COMMIT or
+            # ROLLBACK after it
+            roundtrips.count += 2
+            c.roundtrips = roundtrips
+            return interaction(c, *args, **kwargs)
+
+        roundtrips = context.get(RoundTrips)
+        if roundtrips is None:
+            return self._run(txpostgres.ConnectionPool.runInteraction,
+                             interaction, *args, **kwargs)
+        return self._run(txpostgres.ConnectionPool.runInteraction,
+                         _interaction, *args, **kwargs)
+
+    def runQuery(self, *args, **kwargs):
+        roundtrips = context.get(RoundTrips)
+        if roundtrips is not None:
+            roundtrips.count += 1
+        return self._run(txpostgres.ConnectionPool.runQuery, *args, **kwargs)
+
+    def runRead(self, read, *args, **kwargs):
+        """
+        Run `read(cursor, *args, **kwargs)` on a connection of the pool,
+        out of a transaction. Reads of a single statement save the BEGIN
+        and COMMIT round trips of runInteraction that way.
+        """
+        def _read(c, *args, **kwargs):
+            c.roundtrips = roundtrips
+            return read(c, *args, **kwargs)
+
+        roundtrips = context.get(RoundTrips)
+        # the connection calls functions passed to its runQuery
+        return self._run(txpostgres.ConnectionPool.runQuery, _read,
+                         *args, **kwargs)
+
+    def runOperation(self, *args, **kwargs):
+        roundtrips = context.get(RoundTrips)
+        if roundtrips is not None:
+            roundtrips.count += 1
+        return self._run(txpostgres.ConnectionPool.runOperation,
+                         *args, **kwargs)
+
+    def stats(self):
+        """
+        Return the number of busy and idle connections and of calls
+        waiting for one.
+        """
+        # calls beyond the size of the pool wait for a connection
+        return dict(busy=min(self.running, self.min),
+                    idle=len(self.connections),
+                    queued=max(self.running - self.min, 0))
+
+
+class _Replica(object):
+
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.pool = None
+        self.healthy = None
+
+    def __str__(self):
+        dsn = self.args and self.args[0] or self.kwargs.get("dsn", "")
+        # leave the password out of logs
+        return re.sub(r"password=\S*", "password=***", dsn)
+
+
+class _Flight(object):
+    """
+    A read shared by concurrent callers. The read is cancelled only once
+    every caller has cancelled its Deferred.
+    """
+
+    def __init__(self, flights, key):
+        self.flights = flights
+        self.key = key
+        self.deferred = None
+        self.followers = []
+        flights[key] = self
+
+    def _land(self):
+        if self.flights.get(self.key) is self:
+            del self.flights[self.key]
+
+    def start(self, deferred):
+        self.deferred = deferred
+        deferred.addBoth(self._landed)
+
+    def follow(self):
+        def _cancel(d):
+            self.followers.remove(d)
+            if not self.followers:
+                self._land()
+                self.deferred.cancel()
+
+        d = defer.Deferred(_cancel)
+        self.followers.append(d)
+        return d
+
+    def _landed(self, result):
+        self._land()
+        followers, self.followers = self.followers, []
+        for d in followers:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class _UpdateBatch(object):
+    """
+    updateNode calls on a table waiting to be applied together. Every
+    caller fires with the rowcount of its own node.
+    """
+
+    def __init__(self, batches, schema, table):
+        self.batches = batches
+        self.schema = schema
+        self.table = table
+        self.updates = dict()
+        self.count = 0
+        self.call = None
+        batches[(schema, table)] = self
+
+    def add(self, node_path, content):
+        d = defer.Deferred()
+        patch, waiting = self.updates.setdefault(node_path, (dict(), []))
+        patch.update(content)
+        waiting.append(d)
+        self.count += 1
+        return d
+
+    def close(self):
+        # later calls start a new batch
+        if self.batches.get((self.schema, self.table)) is self:
+            del self.batches[(self.schema, self.table)]
+
+    def applied(self, found):
+        for node_path, (_, waiting) in self.updates.iteritems():
+            for d in waiting:
+                d.callback(int(node_path in found))
+
+    def failed(self, e):
+        for _, waiting in self.updates.itervalues():
+            for d in waiting:
+                d.errback(e)
+
+
+class _UnknownTable(Exception):
+    pass
 
 dbBackend = Postgres()
+
+
+
+def _poolStats():
+    if dbBackend.pool is None:
+        return dict()
+    return dict(((state,), value)
+                for state, value in dbBackend.pool.stats().iteritems())
+
+coalescedReads = registry.counter(
+    "minitree_db_coalesced_reads_total",
+    "Reads answered by an identical read already in progress.", ("kind",))
+
+updateBatchSize = registry.histogram(
+    "minitree_db_update_batch_size",
+    "updateNode calls applied by one grouped UPDATE.", (),
+    (1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+registry.gauge("minitree_db_connections",
+               "Pooled database connections by state, and calls waiting "
+               "for one.", ("state",), _poolStats)
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from itertools import count
+from weakref import WeakKeyDictionary
+import re
+
+__all__ = ["PreparedStatements"]
+
+
+class PreparedStatements(object):
+    """
+    Server side prepared statements, kept per txpostgres connection.
+
+    Statements are keyed by their SQL text, i.e. by (template, table),
+    and at most `size` of them are kept on each connection; the least
+    recently used one is DEALLOCATEd to make room for a new one. They
+    are forgotten when the connection is made again, as they went with
+    the session.
+    """
+
+    regexParam = re.compile(r"%%|%\((\w+)\)s|%s")
+
+    def __init__(self, size):
+        self.size = size
+        self.generations = dict()
+        self._connections = WeakKeyDictionary()
+        self._names = count()
+
+    @classmethod
+    def _compile(cls, sql):
+        """
+        Turn psycopg2 placeholders into $n parameters. Returns the new
+        SQL and the dict keys (or list indexes) of the parameters in
+        order.
+        """
+        keys = []
+
+        def _param(m):
+            if m.group(0) == "%%":
+                return "%"
+            key = m.group(1)
+            if key is None:
+                key = len(keys)
+            elif key in keys:
+                return "$%d" % (keys.index(key) + 1)
+            keys.append(key)
+            return "$%d" % len(keys)
+
+        return cls.regexParam.sub(_param, sql), keys
+
+    def forget(self, tablename):
+        """
+        Invalidate statements on `tablename`, e.g. after it was dropped.
+        Each connection re-prepares them when they are next used.
+        """
+        self.generations[tablename] = self.generations.get(tablename, 0) + 1
+
+    def execute(self, c, sql, params=None, tablename=None):
+
+        def _prepared(_):
+            statements[sql] = (name, keys, generation)
+            return _execute()
+
+        def _execute():
+            if not keys:
+                d = c.execute("EXECUTE %s" % name)
+            else:
+                d = c.execute("EXECUTE %s(%s)" % (
+                        name, ", ".join(["%s"] * len(keys))),
+                              [params[k] for k in keys])
+            d.addErrback(_failed)
+            return d
+
+        def _failed(e):
+            err = str(e.value)
+            if "cached plan" in err:
+                # DEALLOCATEd and prepared again when next used
+                if sql in statements:
+                    statements[sql] = (name, keys, None)
+            elif "prepared statement" in err:
+                # not on the server
+                statements.pop(sql, None)
+            return e
+
+        # the psycopg2 connection is replaced on a reconnect
+        session, statements = self._connections.get(c._connection,
+                                                    (None, None))
+        if session is not c._connection._connection:
+            session = c._connection._connection
+            statements = OrderedDict()
+            self._connections[c._connection] = (session, statements)
+
+        generation = self.generations.get(tablename, 0)
+        entry = statements.pop(sql, None)
+        if entry is not None and entry[2] == generation:
+            name, keys = entry[0], entry[1]
+            statements[sql] = entry
+            return _execute()
+
+        stale = []
+        if entry is not None:
+            stale.append(entry[0])
+        while len(statements) >= self.size:
+            stale.append(statements.popitem(last=False)[1][0])
+
+        name = "minitree_%d" % next(self._names)
+        text, keys = self._compile(sql)
+        d = c.execute("; ".join(["DEALLOCATE %s" % x for x in stale] +
+                                ["PREPARE %s AS %s" % (name, text)]))
+        d.addCallback(_prepared)
+        return d
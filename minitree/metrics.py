@@ -0,0 +1,145 @@
+"""
+In-process metrics, exposed in the Prometheus text format.
+
+Metrics are created on the module level `registry` by the modules which
+update them. Updates are plain dict and list operations, cheap enough to
+be done for every request.
+"""
+from bisect import bisect_left
+from twisted.web.resource import Resource
+
+__all__ = ["registry", "MetricsResource"]
+
+# seconds, from 0.5ms to 10s
+defaultBuckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                  1, 2.5, 5, 10)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (name, str(value).replace("\\", "\\\\")
+                       .replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in zip(names, values))
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict()
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.iteritems()):
+            yield self.name, self.labels, labels, value
+
+
+class Gauge(object):
+    """
+    A gauge read from `collect` when rendered. `collect` returns a
+    dict of label values tuple to value.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, collect):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().iteritems()):
+            yield self.name, self.labels, labels, value
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets of upper bounds `buckets`. Buckets are
+    stored non-cumulative and summed up when rendered.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=defaultBuckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above, sum]
+        self.values = dict()
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for labels, counts in sorted(self.values.iteritems()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield (self.name + "_bucket", names,
+                       labels + (_format(bound),), total)
+            yield self.name + "_sum", self.labels, labels, counts[-1]
+            yield self.name + "_count", self.labels, labels, total
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels, collect):
+        return self._add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=defaultBuckets):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, names, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, _labels(names, labels),
+                                          _format(value)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsResource(Resource):
+
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type",
+                          "text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.render()
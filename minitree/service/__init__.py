@@ -1,10 +1,13 @@
 from twisted.web import resource
+from minitree.db.postgres import dbBackend
 from minitree.service.nodeservice import NodeService
+from minitree.metrics import MetricsResource
 
 __all__ = ['site_configure']
 
 
-def site_configure(c):
+def site_configure(c, backend=dbBackend):
     root = resource.Resource()
-    root.putChild(NodeService.serviceName, NodeService(c))
+    root.putChild(NodeService.serviceName, NodeService(c, backend))
+    root.putChild("metrics", MetricsResource())
     return root
@@ -0,0 +1,104 @@
+"""
+Response formats, chosen by the path suffix or the Accept header.
+
+msgpack is offered only if the msgpack package is installed. Streamed
+results are sent in it as a sequence of objects rather than one array.
+"""
+from collections import OrderedDict
+from twisted.internet import defer
+from minitree.service.stream import JSONStream
+from ujson import encode as json_encode
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ["formats", "negotiate"]
+
+
+class JSONFormat(object):
+    name = "json"
+    mediaTypes = ("application/json",)
+    contentType = JSONStream.contentType
+    stream = JSONStream
+
+    @staticmethod
+    def encode(value):
+        return json_encode(value) + "\n"
+
+
+class MsgpackStream(JSONStream):
+    """
+    A streamed sequence of msgpack objects, one per item, or a [key,
+    value] array per pair, to be read with msgpack.Unpacker. A msgpack
+    array would need its length before the first item is sent.
+    """
+
+    contentType = "application/x-msgpack"
+
+    def __init__(self, request, pairs=False, compress=False):
+        JSONStream.__init__(self, request, pairs, compress)
+        self.packer = msgpack.Packer(use_bin_type=False)
+
+    def write(self, items):
+        if self.stopped:
+            raise defer.CancelledError()
+        if not self.started:
+            self._start()
+        if items:
+            self._send("".join(map(self.packer.pack, items)))
+        return self.paused
+
+    def close(self, result=None):
+        if not self.started:
+            self._start()
+        self.request.unregisterProducer()
+        self._send("", zlib.Z_FINISH)
+        return self
+
+
+class MsgpackFormat(object):
+    name = "msgpack"
+    mediaTypes = ("application/x-msgpack", "application/msgpack")
+    contentType = MsgpackStream.contentType
+    stream = MsgpackStream
+
+    @staticmethod
+    def encode(value):
+        return msgpack.packb(value, use_bin_type=False)
+
+
+formats = OrderedDict([(JSONFormat.name, JSONFormat)])
+if msgpack is not None:
+    formats[MsgpackFormat.name] = MsgpackFormat
+
+
+def negotiate(accept, default="json"):
+    """
+    Return the format of the most preferred media type in the `accept`
+    header which is supported, or the `default` one.
+    """
+    best, quality = formats[default], 0.0
+    for entry in (accept or "").split(","):
+        params = entry.split(";")
+        media = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q <= quality:
+            continue
+        for format in formats.itervalues():
+            if media in format.mediaTypes:
+                best, quality = format, q
+                break
+        else:
+            if media in ("*/*", "application/*"):
+                best, quality = formats[default], q
+    return best
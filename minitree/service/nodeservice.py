@@ -1,18 +1,39 @@
 from twisted.internet import defer
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
-from twisted.python import log
+from twisted.web import http
+from twisted.python import context, log
 from twisted.python.failure import Failure
 from hashlib import md5 as md5sum
 from collections import namedtuple
-from minitree.db.postgres import dbBackend
-from ujson import encode as json_encode, decode as json_decode
+from minitree.db.postgres import dbBackend, RoundTrips
+from minitree.db import NodeValue
+from minitree.db.cache import LRUCache
+from minitree.service.stream import JSONStream
+from minitree.service.formats import formats, negotiate
+from minitree.service.watch import WatchIndex
+from minitree.metrics import registry
+from ujson import decode as json_decode
+import base64
+import math
 import time
+import zlib
 import minitree.db
 import logging
 
 INode = namedtuple("Inode", ["node_path", "format", "data", "user", "passwd"])
 
+NOT_MODIFIED = object()
+
+requestSeconds = registry.histogram(
+    "minitree_request_seconds", "Time spent on requests.", ("verb", "method"))
+requestRoundTrips = registry.histogram(
+    "minitree_request_db_roundtrips", "Database round trips per request.",
+    ("verb", "method"), (0, 1, 2, 3, 4, 6, 8, 12, 16, 32))
+requestErrors = registry.counter(
+    "minitree_request_errors_total", "Failed requests by exception class.",
+    ("error",))
+
 
 class UnsupportedGetNodeMethod(Exception):
     pass
@@ -44,7 +65,15 @@ class NodeService(Resource):
     isLeaf = True
     serviceName = "node"
     defaultFormat = "json"
-    allowedFormat = ("json", "xml")
+    allowedFormat = tuple(formats)
+    getMethods = ("override", "combo", "rcombo", "ancestors", "children",
+                  "descendants", "tree")
+    streamMethods = ("descendants", "rcombo")
+    # read from several rows, whose latest change may get older
+    combinedMethods = ("override", "combo")
+    pageMethods = ("children", "descendants")
+    batchName = "_batch"
+    mutateName = "_mutate"
 
     # privilege bits
     X_GET    = 8
@@ -68,26 +97,83 @@ class NodeService(Resource):
 
         return node_path, format
 
-    def __init__(self, c, *args, **kwargs):
+    def __init__(self, c, backend=dbBackend, *args, **kwargs):
         self.config = c
+        self.backend = backend
         self.admin_user = self.config.get("server:main", "admin_user")
         self.admin_passwd = self.config.get("server:main", "admin_pass")
+        self.userCache = None
+        cache_size = int(self.config.get("server:main", "auth_cache_size"))
+        if cache_size:
+            self.userCache = LRUCache(cache_size, int(
+                    self.config.get("server:main", "auth_cache_ttl")))
+            self.backend.addChangeObserver(self._userChanged)
+        self.gzipMinSize = int(self.config.get("server:main",
+                                               "gzip_min_size"))
+        self.maxPageSize = int(self.config.get("server:main",
+                                               "max_page_size"))
+        self.watches = None
+        self.watchTimeout = float(self.config.get("server:main",
+                                                  "watch_timeout"))
+        if self.watchTimeout:
+            self.watches = WatchIndex(int(self.config.get("server:main",
+                                                          "watch_history")))
+            self.backend.addChangeObserver(self.watches.changed)
+            registry.gauge("minitree_watches", "Pending watch requests.",
+                           (), lambda: {(): self.watches.count})
         Resource.__init__(self, *args, **kwargs)
 
-    def auth(self, inode, bits):
+    @staticmethod
+    def _namespace(node_path):
+        rns = node_path.split("/")
+        if len(rns) > 1:
+            rns = '.'.join(rns[0:2])
+        else:
+            rns = rns[0]
+        return rns.lstrip(".")
+
+    def _userChanged(self, schema, table, node_path):
+        if schema is None:
+            self.userCache.clear()
+            return
+        if schema != "_meta" or table != "users":
+            return
+        if node_path:
+            self.userCache.discard(node_path)
+        else:
+            self.userCache.clear()
+
+    def getUser(self, name):
+        """
+        Fetch the (password, namespaces) pair of user `name`.
+        """
+        def _parse(user, generation):
+            user = (user["password"], frozenset(user["ns"].split(",")))
+            if self.userCache is not None:
+                self.userCache.set(name, user, generation)
+            return user
+
+        generation = None
+        if self.userCache is not None:
+            user = self.userCache.get(name)
+            if user is not None:
+                return defer.succeed(user)
+            generation = self.userCache.generation
+
+        d = self.backend.selectNode("_meta.users." + name)
+        d.addCallback(_parse, generation)
+        return d
 
+    def authUser(self, inode):
+        """
+        Check the credentials of `inode`. Fires with the set of namespaces
+        the user may access, or None if every namespace is allowed.
+        """
         def _auth(user, inode):
-            if user["password"] != inode.passwd:
+            password, ns = user
+            if password != inode.passwd:
                 raise ServiceAuthenticationError()
-            ns = user["ns"].split(",")
-            rns = inode.node_path.split("/")
-            if len(rns) > 1:
-                rns = '.'.join(rns[0:2])
-            else:
-                rns = rns[0]
-            if rns.lstrip(".") not in ns:
-                raise ServiceAuthenticationError("this ns is not allowed")
-            return inode
+            return ns
 
         def _fail(e):
             log.msg("Authentication failed: %s" % str(e.value),
@@ -96,14 +182,91 @@ class NodeService(Resource):
 
         # if no admin_user, disable authentication
         if self.admin_user == '':
-            return inode
+            return defer.succeed(None)
 
         # admin user has all privileges
         if (inode.user == self.admin_user and
             inode.passwd == self.admin_passwd):
-            return inode
-        d = dbBackend.selectNode("_meta.users." + inode.user)
+            return defer.succeed(None)
+        d = self.getUser(inode.user)
         d.addCallbacks(_auth, _fail, callbackArgs=(inode,))
+        roundtrips = context.get(RoundTrips)
+        if roundtrips is not None:
+            # the request goes on once the user is read, out of its context
+            d = roundtrips.resume(d)
+        return d
+
+    def auth(self, inode, bits):
+
+        def _check(ns, inode):
+            if ns is not None and self._namespace(inode.node_path) not in ns:
+                raise ServiceAuthenticationError("this ns is not allowed")
+            return inode
+
+        d = self.authUser(inode)
+        d.addCallback(_check, inode)
+        return d
+
+    def batchNode(self, inode):
+        """
+        Look up many nodes at once. The input is a JSON dict with a list
+        of `paths` and an optional get `method`; the result maps each path
+        to its value under `nodes`, or to an error under `errors`.
+        """
+        def _lookup(ns, paths, method):
+            errors = dict()
+            allowed = []
+            for path in paths:
+                # in the /schema/table/... form of request paths
+                request_path = "/" + path.replace(".", "/").strip("/")
+                if ns is not None and \
+                        self._namespace(request_path) not in ns:
+                    errors[path] = self._error(
+                        ServiceAuthenticationError("this ns is not allowed"))[1]
+                else:
+                    allowed.append(path)
+
+            if method is None:
+                d = self.backend.selectNodes(allowed)
+            elif method == "override":
+                d = self.backend.getOverridedNodes(allowed)
+            else:
+                d = defer.DeferredList(
+                    [self.getNode(inode._replace(node_path=path), method)
+                     for path in allowed], consumeErrors=True)
+                d.addCallback(lambda r: dict(
+                        (path, value) for path, (ok, value) in zip(allowed, r)))
+            d.addCallback(_results, allowed, errors)
+            return d
+
+        def _results(values, paths, errors):
+            nodes = dict()
+            for path in paths:
+                value = values.get(path)
+                if value is None:
+                    value = minitree.db.NodeNotFound()
+                elif isinstance(value, Failure):
+                    value = value.value
+                if isinstance(value, Exception):
+                    errors[path] = self._error(value)[1]
+                else:
+                    nodes[path] = value
+            return dict(nodes=nodes, errors=errors)
+
+        data = inode.data
+        if not isinstance(data, dict) or \
+                not isinstance(data.get("paths"), list):
+            raise InvalidInputData("the input data must be a JSON dict "
+                                   "with a list of paths")
+        paths = [unicode(path).strip("/") for path in data["paths"]]
+        method = data.get("method")
+        if method is not None:
+            method = unicode(method).lower()
+            if method not in self.getMethods:
+                raise UnsupportedGetNodeMethod()
+
+        d = self.authUser(inode)
+        d.addCallback(_lookup, paths, method)
         return d
 
     def createNode(self, inode):
@@ -117,7 +280,59 @@ class NodeService(Resource):
 
         if not isinstance(inode.data, dict):
             raise InvalidInputData()
-        d = dbBackend.createNode(inode.node_path, inode.data)
+        d = self.backend.createNode(inode.node_path, inode.data)
+        d.addCallback(_success)
+        return d
+
+    def mutateNode(self, inode):
+        """
+        Apply a list of operations atomically. The input is a JSON dict
+        with a list of `operations`, each a dict with `op` (PUT, POST or
+        DELETE), `path`, optional `data` and, for DELETE, `cascade`.
+        """
+        def _check(ns, operations):
+            for op, path, content, cascade in operations:
+                request_path = "/" + path.replace(".", "/").strip("/")
+                if ns is not None and \
+                        self._namespace(request_path) not in ns:
+                    raise ServiceAuthenticationError(
+                        "this ns is not allowed")
+            return self.backend.mutate(operations)
+
+        def _success(affected):
+            return dict(success="%d operation(s) has been applied"
+                        % len(affected), affected=affected)
+
+        data = inode.data
+        if not isinstance(data, dict) or \
+                not isinstance(data.get("operations"), list):
+            raise InvalidInputData("the input data must be a JSON dict "
+                                   "with a list of operations")
+        operations = []
+        for operation in data["operations"]:
+            if not isinstance(operation, dict):
+                raise InvalidInputData("each operation must be a JSON dict")
+            op = unicode(operation.get("op", "")).upper()
+            content = operation.get("data", {})
+            if op not in ("PUT", "POST", "DELETE") or \
+                    not isinstance(content, dict):
+                raise InvalidInputData("invalid operation %s" % op)
+            operations.append((op, unicode(operation.get("path", "")),
+                               content, bool(operation.get("cascade"))))
+
+        d = self.authUser(inode)
+        d.addCallback(_check, operations)
+        d.addCallback(_success)
+        return d
+
+    def importNode(self, inode, content, format):
+
+        def _success(rowcount):
+            return dict(success="%d node(s) has been imported" % rowcount,
+                        affected=rowcount)
+
+        content.seek(0, 0)
+        d = self.backend.importTree(inode.node_path, content, format.lower())
         d.addCallback(_success)
         return d
 
@@ -127,93 +342,307 @@ class NodeService(Resource):
             return dict(success="%d node(s) has been modified" % rowcount,
                         affected=rowcount)
 
-        d = dbBackend.deleteNode(inode.node_path, inode.data, cascade)
+        d = self.backend.deleteNode(inode.node_path, inode.data, cascade)
         d.addCallback(_success)
         return d
 
     def getNode(self, inode, method):
         node_path = inode.node_path
         if method == 'override':
-            d = dbBackend.getOverridedNode(node_path)
+            d = self.backend.getOverridedNode(node_path)
         elif method == 'combo':
-            d = dbBackend.getComboNode(node_path)
+            d = self.backend.getComboNode(node_path)
         elif method == 'rcombo':
-            d = dbBackend.getReverseComboNode(node_path)
+            d = self.backend.getReverseComboNode(node_path)
         elif method == 'ancestors':
-            d = dbBackend.getAncestors(node_path)
+            d = self.backend.getAncestors(node_path)
         elif method == 'children':
-            d = dbBackend.getChildren(node_path)
+            d = self.backend.getChildren(node_path)
         elif method == 'descendants':
-            d = dbBackend.getDescendants(node_path)
+            d = self.backend.getDescendants(node_path)
+        elif method == 'tree':
+            d = self.backend.getTree(node_path, None)
+        else:
+            raise UnsupportedGetNodeMethod()
+        return d
+
+    def streamNode(self, inode, request, method, q=None):
+        """
+        Write a descendants, rcombo or search result to `request` while
+        it is read from the database.
+        """
+        stream = request.responseFormat.stream(
+            request, method == "rcombo",
+            bool(self.gzipMinSize) and self._acceptsGzip(request))
+        if q is not None:
+            d = self.backend.streamSearch(inode.node_path, q, stream.write)
+        elif method == "descendants":
+            d = self.backend.streamDescendants(inode.node_path, stream.write)
+        elif method == "rcombo":
+            d = self.backend.streamReverseCombo(inode.node_path, stream.write)
+        else:
+            raise UnsupportedGetNodeMethod()
+        d.addCallbacks(stream.close, stream.abort)
+        return d
+
+    def treeNode(self, inode, depth=None):
+        if depth is not None:
+            try:
+                depth = int(depth)
+            except ValueError:
+                raise InvalidInputData("depth must be a number")
+            if depth < 0:
+                raise InvalidInputData("depth must not be negative")
+        return self.backend.getTree(inode.node_path, depth)
+
+    def pageNode(self, inode, method, limit, cursor=None, q=None):
+        """
+        Return at most `limit` children, descendants or search results
+        following `cursor`, and the cursor of the next page, which is
+        None on the last one.
+        """
+        def _page(paths):
+            nextCursor = None
+            if len(paths) > limit:
+                paths = paths[:limit]
+                nextCursor = base64.urlsafe_b64encode(
+                    paths[-1].encode("UTF-8")).rstrip("=")
+            return dict(items=paths, cursor=nextCursor)
+
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise InvalidInputData("limit must be a number")
+        if limit < 1:
+            raise InvalidInputData("limit must be positive")
+        limit = min(limit, self.maxPageSize)
+        after = None
+        if cursor:
+            try:
+                after = base64.urlsafe_b64decode(
+                    cursor + "=" * (-len(cursor) % 4)).decode("UTF-8")
+            except (TypeError, ValueError):
+                raise InvalidInputData("invalid cursor")
+
+        # one more than asked tells whether there is a next page
+        if q is not None:
+            d = self.backend.searchNode(inode.node_path, q, limit + 1, after)
+        elif method == "children":
+            d = self.backend.getChildren(inode.node_path, limit + 1, after)
+        elif method == "descendants":
+            d = self.backend.getDescendants(inode.node_path, limit + 1, after)
         else:
             raise UnsupportedGetNodeMethod()
+        d.addCallback(_page)
         return d
 
     def searchNode(self, inode, q):
-        d = dbBackend.searchNode(inode.node_path, q)
+        d = self.backend.searchNode(inode.node_path, q)
         return d
 
     def selectNode(self, inode):
-        d = dbBackend.selectNode(inode.node_path)
+        d = self.backend.selectNode(inode.node_path)
         return d
 
-    def finish(self, value, request):
-        log.msg("finish value = %s" % str(value), level=logging.DEBUG)
-        request.setHeader('Content-Type', 'application/json;charset=UTF-8')
-        if isinstance(value, Failure):
-            err = value.value
-            request.setResponseCode(500)
-            error = dict(error="unknown error occurred")
-            if isinstance(err, defer.CancelledError):
-                log.msg("Request cancelled.", level=logging.DEBUG)
-                return None
-            elif isinstance(err, minitree.db.NodeNotFound):
-                request.setResponseCode(404)
-                error = dict(error="node not found", message=err.message,
+    def watchNode(self, inode, timeout, since=None):
+        """
+        Wait until the subtree at the node changes, for at most `timeout`
+        seconds, and tell which paths did. The returned token is passed
+        as `since` to the next watch so that no change goes unnoticed.
+        """
+        def _changed(result):
+            changed, token = result
+            return dict(changed=changed, token=token)
+
+        if self.watches is None:
+            raise InvalidInputData("watching is disabled")
+        try:
+            timeout = min(float(timeout or self.watchTimeout),
+                          self.watchTimeout)
+        except ValueError:
+            raise InvalidInputData("watch must be a number of seconds")
+
+        d = self.watches.watch(inode.node_path, max(timeout, 0), since)
+        d.addCallback(_changed)
+        return d
+
+    def _error(self, err):
+        """
+        Map an exception onto an HTTP status code and a JSON error body.
+        """
+        if isinstance(err, minitree.db.NodeNotFound):
+            return 404, dict(error="node not found", message=err.message,
                              instance="db.NodeNotFound")
-            elif isinstance(err, minitree.db.ParentNotFound):
-                request.setResponseCode(400)
-                error = dict(error="parent node not found",
+        elif isinstance(err, minitree.db.ParentNotFound):
+            return 400, dict(error="parent node not found",
                              message=err.message,
                              instance="db.ParentNotFound")
-            elif isinstance(err, minitree.db.PathDuplicatedError):
-                request.setResponseCode(400)
-                error = dict(error=str(err),
+        elif isinstance(err, minitree.db.PathDuplicatedError):
+            return 400, dict(error=str(err),
                              instance="db.PathDuplicatedError")
-            elif isinstance(err, minitree.db.PathError):
-                request.setResponseCode(400)
-                error = dict(error=str(err),
+        elif isinstance(err, minitree.db.PathError):
+            return 400, dict(error=str(err),
                              instance="db.PathError")
-            elif isinstance(err, minitree.db.DataTypeError):
-                request.setResponseCode(400)
-                error = dict(error=str(err),
+        elif isinstance(err, minitree.db.DataTypeError):
+            return 400, dict(error=str(err),
                              instance="db.DataTypeError")
-            elif isinstance(err, InvalidInputData):
-                request.setResponseCode(400)
-                error = dict(error=str(err),
+        elif isinstance(err, InvalidInputData):
+            return 400, dict(error=str(err),
                              instance="service.NodeSerivce.InvalidInputData")
-            elif isinstance(err, ValueError):
-                request.setResponseCode(400)
-                error = dict(error=str(err), instance="ValueError")
-            elif isinstance(err, ServiceAuthenticationError):
-                request.setResponseCode(403)
-                error = dict(error="forbidden",
+        elif isinstance(err, ValueError):
+            return 400, dict(error=str(err), instance="ValueError")
+        elif isinstance(err, ServiceAuthenticationError):
+            return 403, dict(error="forbidden",
                              message=str(err),
                              instance="service.NodeService."
                              "ServiceAuthenticationError")
-            elif isinstance(err, UnicodeDecodeError):
-                request.setResponseCode(400)
-                error = dict(error=str(err),
+        elif isinstance(err, UnicodeDecodeError):
+            return 400, dict(error=str(err),
                              instance="UnicodeDecodeError")
-            request.write(json_encode(error) + "\n")
+        return 500, dict(error="unknown error occurred")
+
+    def validate(self, value, request):
+        """
+        Send the validators of a NodeValue, and answer 304 instead of it
+        if the client's copy is still fresh.
+        """
+        if not isinstance(value, NodeValue) or value.modified is None:
+            return value
+
+        modified = int(math.ceil(value.modified))
+        etag = self._etag(value, request)
+        request.setHeader("ETag", etag)
+        combined = request.args.get("method", [""])[0].lower() in \
+            self.combinedMethods
+        if combined:
+            # deleting an ancestor can turn back its modification time,
+            # the ETag counts the rows too
+            since = None
+        else:
+            request.setHeader("Last-Modified",
+                              http.datetimeToString(modified))
+            since = request.getHeader("if-modified-since")
+
+        fresh = False
+        match = request.getHeader("if-none-match")
+        if match is not None:
+            # If-Modified-Since is ignored when If-None-Match is present
+            tags = [x.strip() for x in match.split(",")]
+            fresh = "*" in tags or etag in tags or "W/" + etag in tags
+        elif since is not None:
+            try:
+                fresh = http.stringToDatetime(since) >= modified
+            except ValueError:
+                pass
+
+        if fresh:
+            return NOT_MODIFIED
+        return value
+
+    def _etag(self, value, request):
+        """
+        The entity tag of `value` in the format and encoding it is sent
+        to `request` in.
+        """
+        variant = request.responseFormat.name
+        if self.gzipMinSize and self._acceptsGzip(request):
+            # whether the body is gzipped follows from its size
+            variant += "+gzip"
+        return "%s-%s\"" % (value.etag[:-1], variant)
+
+    def _methodLabel(self, request):
+        if "watch" in request.args:
+            return "watch"
+        if "q" in request.args:
+            return "search"
+        if request.method == "GET":
+            method = request.args.get("method", [""])[0].lower()
+            if method in self.getMethods:
+                return method
+        elif request.method == "POST":
+            name = "/".join(request.postpath).strip("/")
+            if name in (self.batchName, self.mutateName):
+                return name.lstrip("_")
+        elif request.method == "PUT" and "import" in request.args:
+            return "import"
+        return ""
+
+    def _observe(self, value, request):
+        labels = (request.method, self._methodLabel(request))
+        requestSeconds.observe(time.time() - request.startTime, labels)
+        requestRoundTrips.observe(request.roundtrips.count, labels)
+        if isinstance(value, Failure):
+            requestErrors.inc((value.type.__name__,))
+
+    def finish(self, value, request):
+        log.msg("finish value = %s" % str(value), level=logging.DEBUG)
+        self._observe(value, request)
+        if isinstance(value, JSONStream):
+            pass
+        elif value is NOT_MODIFIED:
+            request.setResponseCode(http.NOT_MODIFIED)
+        elif isinstance(value, Failure):
+            err = value.value
+            if isinstance(err, defer.CancelledError):
+                log.msg("Request cancelled.", level=logging.DEBUG)
+                return None
+            if request.startedWriting:
+                # a streamed response failed half way, the status line is
+                # gone already, so cut the connection
+                log.err(value, "Streamed response aborted")
+                request.transport.loseConnection()
+                return None
+            code, error = self._error(err)
+            request.setResponseCode(code)
+            self._write(request, error)
         else:
             request.setResponseCode(200)
-            request.write(json_encode(value) + "\n")
+            self._write(request, value)
 
-        log.msg("respone time: %.3fms" % (
-                (time.time() - self.startTime) * 1000))
         request.finish()
 
+    def _write(self, request, value):
+        format = request.responseFormat
+        body = format.encode(value)
+        request.setHeader('Content-Type', format.contentType)
+        if self.gzipMinSize and len(body) >= self.gzipMinSize and \
+                self._acceptsGzip(request):
+            request.setHeader('Content-Encoding', 'gzip')
+            body = self._gzip(body)
+        request.write(body)
+
+    @staticmethod
+    def _gzip(body):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    @staticmethod
+    def _acceptsGzip(request):
+        for entry in (request.getHeader("accept-encoding") or "").split(","):
+            params = entry.split(";")
+            if params[0].strip().lower() != "gzip":
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def _negotiate(self, request):
+        """
+        Pick the response format: a known path suffix wins over the
+        Accept header.
+        """
+        uri = request.path[len(self.serviceName) + 1:].rstrip("/")
+        if uri.find(".") > -1:
+            format = uri.split(".", 1)[1].lower()
+            return formats.get(format, formats[self.defaultFormat])
+        return negotiate(request.getHeader("accept"), self.defaultFormat)
+
     def updateNode(self, inode):
         # content must be first argument
         def _success(rowcount):
@@ -223,13 +652,18 @@ class NodeService(Resource):
         if not isinstance(inode.data, dict):
             raise InvalidInputData()
 
-        d = dbBackend.updateNode(inode.node_path, inode.data)
+        d = self.backend.updateNode(inode.node_path, inode.data)
         d.addCallback(_success)
         return d
 
-    def render(self, *args, **kwargs):
-        self.startTime = time.time()
-        return Resource.render(self, *args, **kwargs)
+    def render(self, request):
+        request.startTime = time.time()
+        request.responseFormat = self._negotiate(request)
+        request.setHeader('Vary', 'Accept, Accept-Encoding')
+        # count the statements sent while the request is dispatched
+        request.roundtrips = RoundTrips()
+        return context.call({RoundTrips: request.roundtrips},
+                            Resource.render, self, request)
 
     def cancel(self, err, call):
         log.msg("Request cancelling.", level=logging.DEBUG)
@@ -275,24 +709,57 @@ class NodeService(Resource):
         d = self.prepare(request, False)
         request.notifyFinish().addErrback(self.cancel, d)
         d.addCallback(self.auth, self.X_GET)
-        if "q" in request.args:
-            d.addCallback(self.searchNode, request.args["q"][0])
-        elif "method" in request.args:
-            d.addCallback(self.getNode, request.args["method"][0].lower())
+        method = "method" in request.args and \
+            request.args["method"][0].lower()
+        if "watch" in request.args:
+            d.addCallback(self.watchNode, request.args["watch"][0],
+                          request.args.get("since", [None])[0])
+        elif "limit" in request.args and \
+                ("q" in request.args or method in self.pageMethods):
+            d.addCallback(self.pageNode, method, request.args["limit"][0],
+                          request.args.get("cursor", [None])[0],
+                          request.args.get("q", [None])[0])
+        elif "q" in request.args:
+            d.addCallback(self.streamNode, request, None,
+                          request.args["q"][0])
+        elif method in self.streamMethods:
+            d.addCallback(self.streamNode, request, method)
+        elif method == "tree":
+            d.addCallback(self.treeNode, request.args.get("depth", [None])[0])
+            d.addCallback(self.validate, request)
+        elif method:
+            d.addCallback(self.getNode, method)
+            d.addCallback(self.validate, request)
         else:
             d.addCallback(self.selectNode)
+            d.addCallback(self.validate, request)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
     def render_POST(self, request):
         d = self.prepare(request)
         request.notifyFinish().addErrback(self.cancel, d)
-        d.addCallback(self.auth, self.X_POST)
-        d.addCallback(self.updateNode)
+        name = "/".join(request.postpath).strip("/")
+        if name == self.batchName:
+            d.addCallback(self.batchNode)
+        elif name == self.mutateName:
+            d.addCallback(self.mutateNode)
+        else:
+            d.addCallback(self.auth, self.X_POST)
+            d.addCallback(self.updateNode)
         d.addBoth(self.finish, request)
         return NOT_DONE_YET
 
     def render_PUT(self, request):
+        if "import" in request.args:
+            d = self.prepare(request, False)
+            request.notifyFinish().addErrback(self.cancel, d)
+            d.addCallback(self.auth, self.X_PUT)
+            d.addCallback(self.importNode, request.content,
+                          request.args["import"][0])
+            d.addBoth(self.finish, request)
+            return NOT_DONE_YET
+
         d = self.prepare(request)
         request.notifyFinish().addErrback(self.cancel, d)
         d.addCallback(self.auth, self.X_PUT)
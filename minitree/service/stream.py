@@ -0,0 +1,104 @@
+from zope.interface import implements
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from ujson import encode as json_encode
+import zlib
+
+__all__ = ["JSONStream"]
+
+
+class JSONStream(object):
+    """
+    Write a JSON array (or object, for (key, value) pairs) to a request
+    piece by piece, using chunked transfer encoding.
+
+    `write` is meant as a backend stream consumer: while the transport
+    is paused it returns a Deferred, which holds back the next batch of
+    rows until the client has caught up. With `compress` the body is
+    gzipped, flushing after every batch.
+    """
+    implements(IPushProducer)
+
+    contentType = "application/json;charset=UTF-8"
+
+    def __init__(self, request, pairs=False, compress=False):
+        self.request = request
+        self.pairs = pairs
+        self.started = False
+        self.stopped = False
+        self.paused = None
+        self.separator = ""
+        self.compressor = None
+        if compress:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)
+
+    def _encode(self, item):
+        if self.pairs:
+            return "%s: %s" % (json_encode(item[0]), json_encode(item[1]))
+        return json_encode(item)
+
+    def _start(self):
+        self.started = True
+        self.request.registerProducer(self, True)
+        self.request.setHeader('Content-Type', self.contentType)
+        if self.compressor is not None:
+            self.request.setHeader('Content-Encoding', 'gzip')
+        self.request.setResponseCode(200)
+
+    def _send(self, data, flush=zlib.Z_SYNC_FLUSH):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(flush)
+        if data:
+            self.request.write(data)
+
+    def write(self, items):
+        if self.stopped:
+            raise defer.CancelledError()
+        if not self.started:
+            self._start()
+            self.separator = self.pairs and "{" or "["
+        if items:
+            self._send(self.separator + ", ".join(map(self._encode, items)))
+            self.separator = ", "
+        return self.paused
+
+    def close(self, result=None):
+        """
+        Terminate the document. Used as a callback, `result` is ignored.
+        """
+        if not self.started:
+            self.write([])
+        self.request.unregisterProducer()
+        end = (self.pairs and "}" or "]") + "\n"
+        if self.separator != ", ":
+            # nothing written yet
+            end = self.separator + end
+        self._send(end, zlib.Z_FINISH)
+        return self
+
+    def abort(self, failure):
+        if self.started:
+            self.request.unregisterProducer()
+        return failure
+
+    def _unpause(self, d):
+        if self.paused is d:
+            self.paused = None
+
+    def pauseProducing(self):
+        if self.paused is None:
+            # a cancelled pause is not resumed
+            self.paused = defer.Deferred(self._unpause)
+
+    def resumeProducing(self):
+        d, self.paused = self.paused, None
+        if d is not None:
+            d.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        d, self.paused = self.paused, None
+        if d is not None:
+            d.errback(defer.CancelledError())
@@ -0,0 +1,162 @@
+from collections import deque
+from twisted.internet import defer, reactor
+from minitree.db import PathError
+import os
+
+__all__ = ["WatchIndex"]
+
+
+def _labels(path):
+    if isinstance(path, unicode):
+        path = path.encode("UTF-8")
+    labels = tuple(filter(None, path.replace("/", ".").split(".")))
+    if len(labels) < 2:
+        raise PathError("Not enough level")
+    return labels
+
+
+class _Node(object):
+    __slots__ = ("children", "watches")
+
+    def __init__(self):
+        self.children = dict()
+        self.watches = set()
+
+
+class _Watch(object):
+    __slots__ = ("labels", "deferred", "timer")
+
+
+class WatchIndex(object):
+    """
+    Pending watches on subtrees, indexed by a trie of path labels.
+
+    A change of a node wakes the watches at or above it, and the ones
+    below it, since a change to an ancestor changes their override. The
+    most recent `history` changes are kept, numbered, so that a watch can
+    pick up what happened since the token its client saw last.
+    """
+
+    def __init__(self, history=1024, clock=reactor):
+        self.root = _Node()
+        self.clock = clock
+        self.history = deque(maxlen=history)
+        # tokens of a restarted process never match
+        self.epoch = os.urandom(4).encode("hex")
+        self.seq = 0
+        self.count = 0
+
+    def token(self):
+        return "%s.%d" % (self.epoch, self.seq)
+
+    def _since(self, token, labels):
+        """
+        Return the changes relevant to `labels` after `token`, or None if
+        they are unknown.
+        """
+        try:
+            epoch, seq = token.split(".")
+            seq = int(seq)
+        except ValueError:
+            return None
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq < self.seq - len(self.history):
+            return None
+        n = len(labels)
+        return [".".join(changed) for i, changed in self.history
+                if i > seq and changed[:n] == labels[:len(changed)]]
+
+    def watch(self, path, timeout, since=None):
+        """
+        Fire with (changed paths, token) once the subtree at `path`
+        changes, or with no paths after `timeout` seconds. With a `since`
+        token, changes after it are reported right away; if they are not
+        known any more the watched path itself is reported changed.
+        """
+        def _cancel(d):
+            self._remove(watch)
+
+        labels = _labels(path)
+        if since is not None:
+            changed = self._since(since, labels)
+            if changed is None:
+                changed = [".".join(labels)]
+            if changed:
+                return defer.succeed((changed, self.token()))
+
+        watch = _Watch()
+        watch.labels = labels
+        watch.deferred = defer.Deferred(_cancel)
+        watch.timer = self.clock.callLater(timeout, self._fire, watch, [])
+
+        node = self.root
+        for label in labels:
+            node = node.children.setdefault(label, _Node())
+        node.watches.add(watch)
+        self.count += 1
+        return watch.deferred
+
+    def _remove(self, watch):
+        path = [self.root]
+        for label in watch.labels:
+            node = path[-1].children.get(label)
+            if node is None:
+                return False
+            path.append(node)
+        if watch not in path[-1].watches:
+            return False
+        path[-1].watches.discard(watch)
+        self.count -= 1
+        if watch.timer.active():
+            watch.timer.cancel()
+        # prune the branch if nothing else hangs on it
+        for label, parent, node in reversed(zip(watch.labels, path,
+                                                path[1:])):
+            if node.watches or node.children:
+                break
+            del parent.children[label]
+        return True
+
+    def _fire(self, watch, changed):
+        if self._remove(watch):
+            watch.deferred.callback((changed, self.token()))
+
+    def _collect(self, node, watches):
+        watches.extend(node.watches)
+        for child in node.children.itervalues():
+            self._collect(child, watches)
+
+    def changed(self, schema, table, node_path):
+        """
+        Change observer of the backend. A `schema` of None means that
+        anything may have changed.
+        """
+        if schema is None:
+            # tokens from before are unusable now
+            self.history.clear()
+            self.seq += 1
+            watches = []
+            self._collect(self.root, watches)
+            for watch in watches:
+                self._fire(watch, [".".join(watch.labels)])
+            return
+
+        labels = _labels("%s.%s.%s" % (schema, table, node_path))
+        self.seq += 1
+        self.history.append((self.seq, labels))
+
+        watches = []
+        node = self.root
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                break
+            watches.extend(node.watches)
+        else:
+            for child in node.children.itervalues():
+                self._collect(child, watches)
+
+        changed = [".".join(labels)]
+        for watch in watches:
+            self._fire(watch, changed)
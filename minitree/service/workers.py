@@ -0,0 +1,168 @@
+"""
+Worker processes serving a shared listening socket.
+
+The supervisor binds the socket and hands it to every worker as an
+inherited file descriptor; the workers adopt it and accept connections
+from it. Workers which exit are restarted, sooner if they ran for a
+while, later if they keep crashing.
+"""
+from twisted.application import service
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import log
+import socket
+import os
+
+__all__ = ["WorkerSupervisor", "AdoptedPort", "listeningSocket"]
+
+
+def listeningSocket(port=0, path=None, backlog=128):
+    """
+    Return a non blocking socket listening on TCP `port`, or on the UNIX
+    socket `path` if given.
+    """
+    if path:
+        if os.path.exists(path):
+            os.unlink(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("", port))
+    s.listen(backlog)
+    s.setblocking(False)
+    return s
+
+
+class AdoptedPort(service.Service):
+    """
+    Serve `factory` on the listening socket inherited as `fd`.
+    """
+
+    def __init__(self, fd, family, factory):
+        self.fd = fd
+        self.family = family
+        self.factory = factory
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = reactor.adoptStreamPort(self.fd, self.family,
+                                            self.factory)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            d = defer.maybeDeferred(self.port.stopListening)
+            self.port = None
+            return d
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, number):
+        self.supervisor = supervisor
+        self.number = number
+        self.started = None
+        self.ended = defer.Deferred()
+        self.buffers = dict()
+
+    def connectionMade(self):
+        self.started = self.supervisor.clock.seconds()
+        log.msg("worker %d started, pid %d" % (self.number,
+                                               self.transport.pid))
+
+    def childDataReceived(self, fd, data):
+        # relay the log lines of the worker into ours
+        lines = (self.buffers.pop(fd, "") + data).split("\n")
+        self.buffers[fd] = lines.pop()
+        for line in lines:
+            log.msg("[worker %d] %s" % (self.number, line))
+
+    def processEnded(self, reason):
+        for fd, line in self.buffers.iteritems():
+            if line:
+                log.msg("[worker %d] %s" % (self.number, line))
+        log.msg("worker %d ended: %s" % (self.number,
+                                         reason.getErrorMessage()))
+        self.supervisor._ended(self)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    """
+    Run `count` worker processes of `args` sharing the listening socket
+    `sock`. `args` is called with the number of the socket descriptor in
+    the workers and returns the command line to spawn.
+    """
+
+    minRestartDelay = 1
+    maxRestartDelay = 60
+    # a worker running this long is not considered crashing
+    healthyUptime = 60
+    killTimeout = 10
+
+    def __init__(self, count, sock, args, env=None, clock=reactor):
+        self.count = count
+        self.sock = sock
+        self.args = args
+        self.env = env if env is not None else os.environ
+        self.clock = clock
+        self.workers = dict()
+        self.delays = dict()
+        self.restarts = dict()
+
+    def startService(self):
+        service.Service.startService(self)
+        for number in range(self.count):
+            self._spawn(number)
+
+    def _spawn(self, number):
+        self.restarts.pop(number, None)
+        fd = self.sock.fileno()
+        args = self.args(fd)
+        worker = _WorkerProtocol(self, number)
+        reactor.spawnProcess(worker, args[0], args, env=self.env,
+                             childFDs={0: "w", 1: "r", 2: "r", fd: fd})
+        self.workers[number] = worker
+
+    def _ended(self, worker):
+        number = worker.number
+        if self.workers.get(number) is worker:
+            del self.workers[number]
+        if not self.running:
+            return
+        uptime = self.clock.seconds() - (worker.started or 0)
+        if uptime >= self.healthyUptime:
+            delay = self.minRestartDelay
+        else:
+            delay = min(self.delays.get(number, 0) * 2 or
+                        self.minRestartDelay, self.maxRestartDelay)
+        self.delays[number] = delay
+        log.msg("restarting worker %d in %d seconds" % (number, delay))
+        self.restarts[number] = self.clock.callLater(delay, self._spawn,
+                                                     number)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for call in self.restarts.values():
+            call.cancel()
+        self.restarts.clear()
+
+        dl = []
+        for worker in self.workers.values():
+            self._signal(worker, "TERM")
+            kill = self.clock.callLater(self.killTimeout, self._signal,
+                                        worker, "KILL")
+            worker.ended.addBoth(lambda _, kill=kill: kill.active() and
+                                 kill.cancel())
+            dl.append(worker.ended)
+        d = defer.DeferredList(dl)
+        d.addBoth(lambda _: self.sock.close())
+        return d
+
+    def _signal(self, worker, signal):
+        try:
+            worker.transport.signalProcess(signal)
+        except error.ProcessExitedAlready:
+            pass
@@ -0,0 +1,51 @@
+"""
+Bulk load a subtree into minitree with COPY.
+
+    python -m minitree.tools.importtree -c etc/default.ini \
+        [-f ndjson|json] schema/table[/node/path] [file]
+
+The nodes are read from `file`, or from stdin when it is omitted.
+"""
+from optparse import OptionParser
+from minitree import configure
+from minitree.db import bulk
+from minitree.db.postgres import Postgres
+import psycopg2
+import sys
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] path [file]")
+    parser.add_option("-c", "--config", default="etc/default.ini",
+                      help="Path (or name) of minitree configuration.")
+    parser.add_option("-f", "--format", default="ndjson",
+                      help="Input format, ndjson or json (nested).")
+    options, args = parser.parse_args(argv)
+    if len(args) not in (1, 2):
+        parser.error("a path is required")
+
+    c = configure(options.config)
+    path = args[0].decode("UTF-8")
+    stream = sys.stdin
+    if len(args) == 2:
+        stream = open(args[1], "rb")
+
+    def _tables(option):
+        return set(
+            backend._buildTableName(*backend._splitPath(x.strip())[:2])
+            for x in c.get("backend:main", option).split(",") if x.strip())
+
+    conn = psycopg2.connect(c.get("backend:main", "dsn"))
+    try:
+        backend = Postgres()
+        backend.materialized = _tables("materialized")
+        backend.changelogged = _tables("mirrored")
+        rowcount = bulk.importNodes(conn, backend, path,
+                                    bulk.readNodes(stream, options.format))
+    finally:
+        conn.close()
+    sys.stdout.write("%d node(s) has been imported\n" % rowcount)
+
+
+if __name__ == "__main__":
+    main()
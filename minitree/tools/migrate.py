@@ -0,0 +1,91 @@
+"""
+Bring existing node tables up to date with the current schema.
+
+    python -m minitree.tools.migrate -c etc/default.ini [schema[/table] ...]
+
+Missing indexes are built with CREATE INDEX CONCURRENTLY, so the tables
+stay writable meanwhile. Indexes left invalid by an interrupted run are
+dropped and built again. Without arguments every node table is migrated.
+"""
+from optparse import OptionParser
+from minitree import configure
+from minitree.db.postgres import Postgres
+import psycopg2
+import sys
+
+selectNodeTablesSQL = "SELECT n.nspname, c.relname FROM pg_class c \
+JOIN pg_namespace n ON n.oid = c.relnamespace \
+JOIN pg_attribute a ON a.attrelid = c.oid \
+WHERE c.relkind = 'r' AND a.attname = 'node_path' \
+AND a.atttypid = 'ltree'::regtype \
+AND n.nspname NOT IN ('pg_catalog', 'information_schema') \
+ORDER BY 1, 2"
+selectIndexSQL = "SELECT i.indisvalid FROM pg_index i \
+JOIN pg_class c ON c.oid = i.indexrelid \
+JOIN pg_namespace n ON n.oid = c.relnamespace \
+WHERE n.nspname = %s AND c.relname = %s"
+dropIndexSQL = "DROP INDEX CONCURRENTLY %s"
+
+
+def _selected(schema, table, selection):
+    if not selection:
+        return True
+    return (schema, None) in selection or (schema, table) in selection
+
+
+def migrate(conn, backend, selection=(), out=sys.stdout):
+    """
+    Create the missing `nodeIndexes` of the tables in `selection`, a
+    list of (schema, table or None) pairs, on the autocommit connection
+    `conn`. Returns the number of indexes built.
+    """
+    cursor = conn.cursor()
+    cursor.execute(selectNodeTablesSQL)
+    tables = [x for x in cursor.fetchall() if _selected(x[0], x[1], selection)]
+
+    built = 0
+    for schema, table in tables:
+        statements = backend._createIndexSQL(schema, table, True)
+        for (suffix, _), sql in zip(backend.nodeIndexes, statements):
+            name = "%s_%s" % (table, suffix)
+            cursor.execute(selectIndexSQL, [schema, name[:63]])
+            row = cursor.fetchone()
+            if row and row[0]:
+                continue
+            if row:
+                out.write("dropping invalid index %s.%s\n" % (schema, name))
+                cursor.execute(dropIndexSQL %
+                               backend._buildTableName(schema, name[:63]))
+            out.write("building index %s.%s\n" % (schema, name))
+            cursor.execute(sql)
+            built += 1
+    cursor.close()
+    return built
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] [schema[/table] ...]")
+    parser.add_option("-c", "--config", default="etc/default.ini",
+                      help="Path (or name) of minitree configuration.")
+    options, args = parser.parse_args(argv)
+
+    selection = []
+    for arg in args:
+        parts = arg.replace(".", "/").strip("/").split("/")
+        if len(parts) > 2:
+            parser.error("%s is not a schema or table" % arg)
+        selection.append((parts[0], len(parts) == 2 and parts[1] or None))
+
+    c = configure(options.config)
+    conn = psycopg2.connect(c.get("backend:main", "dsn"))
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    conn.autocommit = True
+    try:
+        built = migrate(conn, Postgres(), selection)
+    finally:
+        conn.close()
+    sys.stdout.write("%d index(es) has been built\n" % built)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,226 @@ RETURNS hstore
 AS 'SELECT $1 || $2'
 LANGUAGE SQL IMMUTABLE RETURNS NULL ON NULL INPUT;
 
-CREATE AGGREGATE hstore_override(
-  sfunc = hstore_merge,
-  basetype = hstore,
-  stype = hstore,
-  initcond = ''
+-- CREATE AGGREGATE has no IF NOT EXISTS, the file may be run again
+DO $$
+BEGIN
+  IF to_regprocedure('hstore_override(hstore)') IS NULL THEN
+    CREATE AGGREGATE hstore_override(
+      sfunc = hstore_merge,
+      basetype = hstore,
+      stype = hstore,
+      initcond = ''
+    );
+  END IF;
+END;
+$$;
+
+
+-- CHANGE NOTIFICATION
+--
+-- Every node table gets a minitree_notify trigger when it is created by
+-- minitree. The payload is the full path of the changed node
+-- (schema.table.node_path), consumed by processes which LISTEN on the
+-- "minitree" channel to invalidate their node caches. Bulk loads set
+-- minitree.skip_notify and send a single notification for the subtree.
+
+CREATE OR REPLACE FUNCTION minitree_notify()
+RETURNS trigger
+AS $$
+BEGIN
+  IF current_setting('minitree.skip_notify', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'DELETE' THEN
+    PERFORM pg_notify('minitree', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME
+                      || '.' || OLD.node_path::text);
+  ELSE
+    PERFORM pg_notify('minitree', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME
+                      || '.' || NEW.node_path::text);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- attach the trigger to node tables created before it existed, or before
+-- it left out updates of other columns, i.e. of effective_value, which
+-- are made to every descendant of a changed node
+DO $$
+DECLARE
+  t record;
+BEGIN
+  FOR t IN SELECT c.table_schema, c.table_name,
+                  (SELECT pg_get_triggerdef(g.oid) FROM pg_trigger g
+                   WHERE g.tgrelid = format('%I.%I', c.table_schema,
+                                            c.table_name)::regclass
+                   AND g.tgname = 'minitree_notify') AS definition
+           FROM information_schema.columns c
+           WHERE c.column_name = 'node_path' AND c.udt_name = 'ltree'
+  LOOP
+    CONTINUE WHEN t.definition LIKE '%UPDATE OF%';
+    IF t.definition IS NOT NULL THEN
+      EXECUTE format('DROP TRIGGER minitree_notify ON %I.%I',
+                     t.table_schema, t.table_name);
+    END IF;
+    EXECUTE format('CREATE TRIGGER minitree_notify '
+                   'AFTER INSERT OR UPDATE OF node_path, node_value '
+                   'OR DELETE ON %I.%I '
+                   'FOR EACH ROW EXECUTE PROCEDURE minitree_notify()',
+                   t.table_schema, t.table_name);
+  END LOOP;
+END;
+$$;
+
+-- EFFECTIVE VALUES
+--
+-- Tables listed in the "materialized" option get an effective_value
+-- column holding the result of hstore_override over the ancestors of
+-- each node. Statement level triggers refresh it, in the same
+-- transaction as the write, for every node at or below the nodes a
+-- statement inserted, updated or deleted. The refresh runs once the
+-- statement is done, so the order in which its rows were written does
+-- not matter, every node is refreshed once however many of its
+-- ancestors changed, and nothing is left to refresh below a subtree
+-- deleted whole. Transition tables need PostgreSQL 10.
+
+CREATE OR REPLACE FUNCTION minitree_effective_changed()
+RETURNS trigger
+AS $$
+BEGIN
+  -- the refresh updates the table itself
+  IF pg_trigger_depth() > 1 THEN
+    RETURN NULL;
+  END IF;
+  EXECUTE format('UPDATE %1$I.%2$I n SET effective_value = '
+                 '(SELECT hstore_override(a.node_value ORDER BY a.node_path) '
+                 'FROM %1$I.%2$I a WHERE a.node_path @> n.node_path) '
+                 'FROM (SELECT DISTINCT m.id FROM minitree_changed c '
+                 'JOIN %1$I.%2$I m ON m.node_path <@ c.node_path) s '
+                 'WHERE n.id = s.id',
+                 TG_TABLE_SCHEMA, TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION minitree_enable_effective(t regclass)
+RETURNS void
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(t::oid::bigint);
+  IF NOT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = t
+                 AND attname = 'effective_value' AND NOT attisdropped) THEN
+    EXECUTE format('ALTER TABLE %s ADD COLUMN effective_value hstore', t);
+    EXECUTE format('UPDATE %1$s n SET effective_value = '
+                   '(SELECT hstore_override(a.node_value '
+                   'ORDER BY a.node_path) '
+                   'FROM %1$s a WHERE a.node_path @> n.node_path)', t);
+  END IF;
+  IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = t
+             AND tgname = 'minitree_effective_inserted') THEN
+    RETURN;
+  END IF;
+  -- the row level triggers of earlier versions
+  IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = t
+             AND tgname = 'minitree_effective_insert') THEN
+    EXECUTE format('DROP TRIGGER minitree_effective_insert ON %s', t);
+    EXECUTE format('DROP TRIGGER minitree_effective_refresh ON %s', t);
+  END IF;
+  EXECUTE format('CREATE TRIGGER minitree_effective_inserted '
+                 'AFTER INSERT ON %s '
+                 'REFERENCING NEW TABLE AS minitree_changed '
+                 'FOR EACH STATEMENT '
+                 'EXECUTE PROCEDURE minitree_effective_changed()', t);
+  EXECUTE format('CREATE TRIGGER minitree_effective_updated '
+                 'AFTER UPDATE ON %s '
+                 'REFERENCING NEW TABLE AS minitree_changed '
+                 'FOR EACH STATEMENT '
+                 'EXECUTE PROCEDURE minitree_effective_changed()', t);
+  EXECUTE format('CREATE TRIGGER minitree_effective_deleted '
+                 'AFTER DELETE ON %s '
+                 'REFERENCING OLD TABLE AS minitree_changed '
+                 'FOR EACH STATEMENT '
+                 'EXECUTE PROCEDURE minitree_effective_changed()', t);
+END;
+$$ LANGUAGE plpgsql;
+
+-- move tables materialized by earlier versions to the statement triggers
+DO $$
+DECLARE
+  t record;
+BEGIN
+  FOR t IN SELECT tgrelid FROM pg_trigger
+           WHERE tgname = 'minitree_effective_insert'
+  LOOP
+    PERFORM minitree_enable_effective(t.tgrelid::regclass);
+  END LOOP;
+END;
+$$;
+
+-- CHANGE LOG
+--
+-- Tables listed in the "mirrored" option log every change of a node in
+-- minitree_changes, with the new value, so that processes keeping the
+-- table in memory can replay the changes in order; the notification
+-- only tells them when to look. Dropping a table logs the deletion of
+-- its root. Entries are removed after a while by those processes.
+
+CREATE TABLE IF NOT EXISTS minitree_changes(
+  id bigserial PRIMARY KEY,
+  schemaname text NOT NULL,
+  tablename text NOT NULL,
+  node_path ltree NOT NULL,
+  node_value hstore,
+  modified timestamp,
+  deleted boolean NOT NULL DEFAULT false,
+  logged timestamptz NOT NULL DEFAULT clock_timestamp()
 );
 
+CREATE INDEX IF NOT EXISTS minitree_changes_logged
+ON minitree_changes(logged);
+
+CREATE OR REPLACE FUNCTION minitree_log_change()
+RETURNS trigger
+AS $$
+BEGIN
+  IF TG_OP = 'DELETE' OR
+     (TG_OP = 'UPDATE' AND OLD.node_path <> NEW.node_path) THEN
+    INSERT INTO minitree_changes(schemaname, tablename, node_path, deleted)
+    VALUES (TG_TABLE_SCHEMA, TG_TABLE_NAME, OLD.node_path, true);
+  END IF;
+  IF TG_OP <> 'DELETE' THEN
+    INSERT INTO minitree_changes(schemaname, tablename, node_path,
+                                 node_value, modified)
+    VALUES (TG_TABLE_SCHEMA, TG_TABLE_NAME, NEW.node_path, NEW.node_value,
+            NEW.last_modification);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION minitree_enable_changelog(t regclass)
+RETURNS void
+AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(t::oid::bigint);
+  IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = t
+             AND tgname = 'minitree_changelog') THEN
+    RETURN;
+  END IF;
+  EXECUTE format('CREATE TRIGGER minitree_changelog '
+                 'AFTER INSERT OR UPDATE OF node_path, node_value '
+                 'OR DELETE ON %s FOR EACH ROW '
+                 'EXECUTE PROCEDURE minitree_log_change()', t);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION minitree_log_drop(t regclass)
+RETURNS void
+AS $$
+BEGIN
+  INSERT INTO minitree_changes(schemaname, tablename, node_path, deleted)
+  SELECT n.nspname, c.relname, '', true
+  FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+  WHERE c.oid = t AND EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = t
+                              AND tgname = 'minitree_changelog');
+END;
+$$ LANGUAGE plpgsql;
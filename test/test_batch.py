@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from cjson import decode as json_decode, encode as json_encode
+import unittest2
+import psycopg2
+import urllib2
+import os
+
+
+def url_access(url, data="", method="GET"):
+    opener = urllib2.build_opener(urllib2.HTTPHandler)
+    request = urllib2.Request(url, data)
+    request.get_method = lambda: method
+    return opener.open(request)
+
+
+class TestBatchFunctions(unittest2.TestCase):
+
+    base = None
+    conn = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base = os.environ["MINITREE_SERVER"]
+        cls.conn = psycopg2.connect(os.environ["MINITREE_DSN"])
+        url_access(cls.base + "/node/test/table/",
+                   json_encode(dict(key1="value1-1", key4="value4-1")),
+                   method="PUT").read()
+        url_access(cls.base + "/node/test/table/a",
+                   json_encode(dict(key1="value1-2", key2="value2-1")),
+                   method="PUT").read()
+        url_access(cls.base + "/node/test/table/a/b",
+                   json_encode(dict(key1="value1-3", key3=u"中文测试")),
+                   method="PUT").read()
+        url_access(cls.base + "/node/test/table/empty",
+                   json_encode(dict()),
+                   method="PUT").read()
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = cls.conn.cursor()
+        cursor.execute("DROP SCHEMA test CASCADE")
+        cls.conn.commit()
+
+    def test_batch_select(self):
+        data = dict(paths=["test/table/a", "test/table/a/b",
+                           "test/table/empty"])
+        ret = url_access(self.base + "/node/_batch",
+                         json_encode(data), method="POST").read()
+        data = json_decode(ret)
+        self.assertEqual(data["errors"], {})
+        self.assertEqual(data["nodes"]["test/table/a"]["key2"], "value2-1")
+        self.assertEqual(data["nodes"]["test/table/a/b"]["key3"],
+                         u"中文测试")
+        self.assertEqual(data["nodes"]["test/table/empty"], {})
+
+    def test_batch_override(self):
+        data = dict(paths=["test/table/a/b"], method="override")
+        ret = url_access(self.base + "/node/_batch",
+                         json_encode(data), method="POST").read()
+        data = json_decode(ret)["nodes"]["test/table/a/b"]
+        self.assertEqual(data["key1"], "value1-3")
+        self.assertEqual(data["key2"], "value2-1")
+        self.assertEqual(data["key4"], "value4-1")
+
+    def test_batch_not_found(self):
+        data = dict(paths=["test/table/x", "test/table_table/x", "invalid"],
+                    method="override")
+        ret = url_access(self.base + "/node/_batch",
+                         json_encode(data), method="POST").read()
+        data = json_decode(ret)
+        self.assertEqual(data["nodes"], {})
+        self.assertEqual(len(data["errors"]), 3)
+
+    def test_batch_children(self):
+        data = dict(paths=["test/table/a"], method="children")
+        ret = url_access(self.base + "/node/_batch",
+                         json_encode(data), method="POST").read()
+        data = json_decode(ret)
+        self.assertEqual(data["nodes"]["test/table/a"], ["test.table.a.b"])
+
+    def test_batch_tree(self):
+        data = dict(paths=["test/table/a", "test/table/x"], method="tree")
+        ret = url_access(self.base + "/node/_batch",
+                         json_encode(data), method="POST").read()
+        data = json_decode(ret)
+        tree = data["nodes"]["test/table/a"]
+        self.assertEqual(tree["value"]["key2"], "value2-1")
+        self.assertEqual(tree["children"]["b"]["value"]["key1"], "value1-3")
+        self.assertEqual(data["errors"].keys(), ["test/table/x"])
+
+    def test_batch_invalid_data(self):
+        code = 200
+        try:
+            url_access(self.base + "/node/_batch",
+                       json_encode(["test/table/a"]), method="POST").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+            ret = e.read()
+
+        self.assertEqual(code, 400)
+        self.assertTrue("error" in ret)
+
+    def test_mutate_normal(self):
+        data = dict(operations=[
+                dict(op="PUT", path="test/table/m", data=dict(k="v1")),
+                dict(op="PUT", path="test/table/m/n", data=dict(k="v2")),
+                dict(op="POST", path="test/table/m", data=dict(k="v3")),
+                dict(op="POST", path="test/table/x", data=dict(k="v3")),
+                dict(op="DELETE", path="test/table/m/n")])
+        ret = url_access(self.base + "/node/_mutate",
+                         json_encode(data), method="POST").read()
+        self.assertEqual(json_decode(ret)["affected"], [1, 1, 1, 0, 1])
+        ret = url_access(self.base + "/node/test/table/m").read()
+        self.assertEqual(json_decode(ret), dict(k="v3"))
+
+    def test_mutate_atomic(self):
+        code = 200
+        data = dict(operations=[
+                dict(op="PUT", path="test/table/atomic", data=dict()),
+                dict(op="PUT", path="test/table/x/y", data=dict())])
+        try:
+            url_access(self.base + "/node/_mutate",
+                       json_encode(data), method="POST").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+            ret = e.read()
+
+        self.assertEqual(code, 400)
+        self.assertTrue("parent" in ret)
+        code = 200
+        try:
+            url_access(self.base + "/node/test/table/atomic").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+        self.assertEqual(code, 404)
+
+    def test_mutate_table_rolled_back(self):
+        code = 200
+        data = dict(operations=[
+                dict(op="PUT", path="test/rolledback/a", data=dict()),
+                dict(op="PUT", path="test/rolledback/x/y", data=dict())])
+        try:
+            url_access(self.base + "/node/_mutate",
+                       json_encode(data), method="POST").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+        self.assertEqual(code, 400)
+        # the table was never committed, so it must be created again
+        data = dict(operations=[
+                dict(op="PUT", path="test/rolledback/a", data=dict(k="v"))])
+        ret = url_access(self.base + "/node/_mutate",
+                         json_encode(data), method="POST").read()
+        self.assertEqual(json_decode(ret)["affected"], [1])
+        ret = url_access(self.base + "/node/test/rolledback/a").read()
+        self.assertEqual(json_decode(ret), dict(k="v"))
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -124,5 +124,46 @@ WHERE node_path='dbval' LIMIT 1")
 
         self.assertEqual(code, 200)
 
+    def test_create_import_ndjson(self):
+        lines = [dict(path="", value=dict(key_a="value_a")),
+                 dict(path="a", value=dict(key_b="value_b")),
+                 dict(path="a/b", value={u"中文键": u"中文值"})]
+        data = "\n".join(map(json_encode, lines))
+        ret = url_access(self.base + "/node/test/table/import?import=ndjson",
+                         data, "PUT").read()
+        self.assertTrue("3 node(s)" in ret)
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT node_value FROM test.table \
+WHERE node_path='import.a.b' LIMIT 1")
+        data = cursor.fetchall()
+        self.assertEqual(data[0][0], '"中文键"=>"中文值"')
+
+    def test_create_import_orphan(self):
+        code = 200
+        data = json_encode(dict(path="x/y", value=dict()))
+        try:
+            ret = url_access(self.base + "/node/test/table/import?import=ndjson",
+                             data, "PUT").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+            ret = e.read()
+
+        self.assertEqual(code, 400)
+        self.assertTrue("parent" in ret)
+
+    def test_create_import_invalid_value(self):
+        code = 200
+        data = "\n".join([json_encode(dict(path="a", value=dict())),
+                          json_encode(dict(path="b", value=["x"]))])
+        try:
+            ret = url_access(self.base + "/node/test/table/invalid"
+                             "?import=ndjson", data, "PUT").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+            ret = e.read()
+
+        self.assertEqual(code, 400)
+        self.assertTrue("not a dict" in ret)
+
 if __name__ == "__main__":
     unittest2.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from cjson import decode as json_decode, encode as json_encode
+import unittest2
+import psycopg2
+import urllib2
+import select
+import os
+
+
+def url_access(url, data="", method="GET"):
+    opener = urllib2.build_opener(urllib2.HTTPHandler)
+    request = urllib2.Request(url, data)
+    request.get_method = lambda: method
+    return opener.open(request)
+
+
+class TestEffectiveFunctions(unittest2.TestCase):
+
+    base = None
+    conn = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base = os.environ["MINITREE_SERVER"]
+        cls.conn = psycopg2.connect(os.environ["MINITREE_DSN"])
+
+    def setUp(self):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("DROP SCHEMA test CASCADE")
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+        for path, data in (("", dict(key1="root")),
+                           ("a", dict(key2="a")),
+                           ("a/b", dict(key3="b")),
+                           ("a/b/c", dict())):
+            url_access(self.base + "/node/test/effective/" + path,
+                       json_encode(data), method="PUT").read()
+        cursor.execute("SELECT minitree_enable_effective("
+                       "'test.effective'::regclass)")
+        self.conn.commit()
+
+    def effective(self, node_path):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT hstore_to_json(effective_value)::text "
+                       "FROM test.effective WHERE node_path = %s",
+                       [node_path])
+        row = cursor.fetchone()
+        self.conn.commit()
+        return row and json_decode(row[0])
+
+    def test_effective_update(self):
+        url_access(self.base + "/node/test/effective/a",
+                   json_encode(dict(key2="changed")), method="POST").read()
+        self.assertEqual(self.effective("a.b.c"),
+                         dict(key1="root", key2="changed", key3="b"))
+
+    def test_effective_reinsert(self):
+        url_access(self.base + "/node/test/effective/a",
+                   method="DELETE").read()
+        self.assertEqual(self.effective("a.b"),
+                         dict(key1="root", key3="b"))
+        url_access(self.base + "/node/test/effective/a",
+                   json_encode(dict(key2="again")), method="PUT").read()
+        self.assertEqual(self.effective("a.b"),
+                         dict(key1="root", key2="again", key3="b"))
+        self.assertEqual(self.effective("a.b.c"),
+                         dict(key1="root", key2="again", key3="b"))
+
+    def test_effective_mutate_out_of_order(self):
+        data = dict(operations=[
+                dict(op="PUT", path="test/effective/x/y", data=dict(k="y")),
+                dict(op="PUT", path="test/effective/x", data=dict(k="x",
+                                                                  j="x"))])
+        url_access(self.base + "/node/_mutate",
+                   json_encode(data), method="POST").read()
+        self.assertEqual(self.effective("x"),
+                         dict(key1="root", k="x", j="x"))
+        self.assertEqual(self.effective("x.y"),
+                         dict(key1="root", k="y", j="x"))
+
+    def test_effective_cascade(self):
+        url_access(self.base + "/node/test/effective/a?cascade=true",
+                   method="DELETE").read()
+        self.assertEqual(self.effective("a.b"), None)
+        url_access(self.base + "/node/test/effective/a",
+                   json_encode(dict(key2="new")), method="PUT").read()
+        self.assertEqual(self.effective("a"), dict(key1="root", key2="new"))
+
+    def test_effective_notify_once(self):
+        listener = psycopg2.connect(os.environ["MINITREE_DSN"])
+        try:
+            listener.set_isolation_level(0)
+            listener.cursor().execute("LISTEN minitree")
+            url_access(self.base + "/node/test/effective/a",
+                       json_encode(dict(key2="changed")), method="POST").read()
+            # the refreshed descendants are not notified of
+            select.select([listener], [], [], 1)
+            listener.poll()
+            self.assertEqual([x.payload for x in listener.notifies],
+                             ["test.effective.a"])
+        finally:
+            listener.close()
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,108 @@
+from minitree.db import NodeNotFound
+from minitree.db.postgres import Postgres
+from twisted.internet import defer, task
+import psycopg2
+import unittest2
+
+
+class FakeCursor(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.rows = []
+
+    def execute(self, sql, params):
+        tablename = sql.split(" ")[1]
+        if tablename not in self.pool.tables:
+            return defer.fail(psycopg2.ProgrammingError(
+                    "relation \"%s\" does not exist" %
+                    tablename.replace("\"", "")))
+        self.pool.updates.append((tablename, params))
+        self.rows = [(x,) for x in params["node_paths"]
+                     if x in self.pool.tables[tablename]]
+        return defer.succeed(self)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakePool(object):
+    # a table per name, with the node paths it holds
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.updates = []
+
+    def runInteraction(self, interaction, *args):
+        return defer.maybeDeferred(interaction, FakeCursor(self), *args)
+
+
+def results(ds):
+    # what each caller fired with, None while it waits
+    fired = [None] * len(ds)
+    for i, d in enumerate(ds):
+        d.addBoth(lambda result, i=i: fired.__setitem__(i, result))
+    return fired
+
+
+def patches(value):
+    return set(value.split(", "))
+
+
+class TestGroupCommit(unittest2.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.backend = Postgres()
+        self.backend.pool = FakePool({
+                '"test"."table"': set(["a", "a.b"])})
+        self.backend.enableGroupCommit(0.01, 100, self.clock)
+
+    def test_group_commit_rowcounts(self):
+        fired = results([
+                self.backend.updateNode("test/table/a", dict(key1="1")),
+                self.backend.updateNode("test/table/a/b", dict(key1="1")),
+                self.backend.updateNode("test/table/a/x", dict(key1="1")),
+                self.backend.updateNode("test/table/a", dict(key2="2"))])
+        self.assertEqual(fired, [None] * 4)
+        self.assertEqual(self.backend.pool.updates, [])
+        self.clock.advance(0.01)
+        self.assertEqual(fired, [1, 1, 0, 1])
+        self.assertEqual(len(self.backend.pool.updates), 1)
+        _, params = self.backend.pool.updates[0]
+        self.assertEqual(params["node_paths"], ["a", "a.b", "a.x"])
+
+    def test_group_commit_merge_order(self):
+        results([
+                self.backend.updateNode("test/table/a",
+                                        dict(key1="1", key2="1")),
+                self.backend.updateNode("test/table/a", dict(key1="2")),
+                self.backend.updateNode("test/table/a", dict(key3="3"))])
+        self.clock.advance(0.01)
+        _, params = self.backend.pool.updates[0]
+        self.assertEqual(patches(params["node_values"][0]),
+                         set(['"key1"=>"2"', '"key2"=>"1"', '"key3"=>"3"']))
+
+    def test_group_commit_missing_table(self):
+        fired = results([
+                self.backend.updateNode("test/missing/a", dict(key1="1")),
+                self.backend.updateNode("test/table/a", dict(key1="1")),
+                self.backend.updateNode("test/missing/b", dict(key1="1"))])
+        self.clock.advance(0.01)
+        self.assertTrue(fired[0].check(NodeNotFound))
+        self.assertEqual(fired[1], 1)
+        self.assertTrue(fired[2].check(NodeNotFound))
+
+    def test_group_commit_size(self):
+        self.backend.enableGroupCommit(0.01, 2, self.clock)
+        fired = results([
+                self.backend.updateNode("test/table/a", dict(key1="1")),
+                self.backend.updateNode("test/table/a/b", dict(key1="1")),
+                self.backend.updateNode("test/table/a", dict(key1="2"))])
+        self.assertEqual(fired, [1, 1, None])
+        self.clock.advance(0.01)
+        self.assertEqual(fired, [1, 1, 1])
+        self.assertEqual(len(self.backend.pool.updates), 2)
+
+if __name__ == "__main__":
+    unittest2.main()
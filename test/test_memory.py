@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from minitree.db import NodeNotFound, ParentNotFound, PathDuplicatedError
+from minitree.db.memory import MemoryBackend
+from StringIO import StringIO
+import unittest2
+
+
+def result(d):
+    # the memory backend fires its Deferreds right away
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
+class TestMemoryBackend(unittest2.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+        result(self.backend.createNode("test/table/", dict(key1="value1-1")))
+        result(self.backend.createNode("test/table/a",
+                                       dict(key1="value1-2", key2="value2")))
+        result(self.backend.createNode("test/table/a/b",
+                                       dict(key3=u"中文测试")))
+        result(self.backend.createNode("test/table/a/c", dict()))
+
+    def test_memory_override(self):
+        value = result(self.backend.getOverridedNode("test/table/a/b"))
+        self.assertEqual(value, dict(key1="value1-2", key2="value2",
+                                     key3=u"中文测试"))
+        self.assertEqual(value.versions, 3)
+        value = result(self.backend.getComboNode("test/table/a/b"))
+        self.assertEqual(value["key1"], ["value1-1", "value1-2"])
+
+    def test_memory_walk(self):
+        self.assertEqual(result(self.backend.getDescendants("test/table")),
+                         ["test.table.a", "test.table.a.b", "test.table.a.c"])
+        self.assertEqual(result(self.backend.getDescendants(
+                    "test/table", 1, "test.table.a.b")), ["test.table.a.c"])
+        self.assertEqual(result(self.backend.searchNode("test/table", "*.c")),
+                         ["test.table.a.c"])
+        tree = result(self.backend.getTree("test/table/a"))
+        self.assertEqual(sorted(tree["children"]), ["b", "c"])
+
+    def test_memory_create_errors(self):
+        failure = result(self.backend.createNode("test/table/a", dict()))
+        self.assertTrue(failure.check(PathDuplicatedError))
+        failure = result(self.backend.createNode("test/table/x/y", dict()))
+        self.assertTrue(failure.check(NodeNotFound))
+
+    def test_memory_mutate_rollback(self):
+        failure = result(self.backend.mutate([
+                    ("POST", "test/table/a", dict(key1="changed"), False),
+                    ("PUT", "test/table/x/y", dict(), False)]))
+        self.assertTrue(failure.check(ParentNotFound))
+        value = result(self.backend.selectNode("test/table/a"))
+        self.assertEqual(value["key1"], "value1-2")
+
+    def test_memory_delete(self):
+        self.assertEqual(result(self.backend.deleteNode("test/table/a",
+                                                        None, True)), 3)
+        failure = result(self.backend.selectNode("test/table/a/b"))
+        self.assertTrue(failure.check(NodeNotFound))
+
+    def test_memory_import(self):
+        stream = StringIO('{"path": "d", "value": {"k": "v"}}\n'
+                          '{"path": "d.e", "value": {}}\n')
+        self.assertEqual(result(self.backend.importTree("test/table",
+                                                        stream)), 2)
+        self.assertEqual(result(self.backend.getChildren("test/table/d")),
+                         ["test.table.d.e"])
+
+    def test_memory_copied_state(self):
+        self.backend.loadCollection("test", "copy", [
+                ("a.b", dict(k="v"), 2.0), ("", dict(), 1.0)])
+        self.assertEqual(result(self.backend.getDescendants("test/copy")),
+                         ["test.copy.a.b"])
+        self.backend.setNode("test", "copy", "a", dict(k="a"), 3.0)
+        self.backend.removeNode("test", "copy", "a.b")
+        self.assertEqual(result(self.backend.getDescendants("test/copy")),
+                         ["test.copy.a"])
+        self.assertEqual(result(self.backend.selectNode(
+                    "test/copy/a")).modified, 3.0)
+        self.backend.dropCollection("test", "copy")
+        failure = result(self.backend.selectNode("test/copy"))
+        self.assertTrue(failure.check(NodeNotFound))
+
+if __name__ == "__main__":
+    unittest2.main()
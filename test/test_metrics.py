@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from cjson import encode as json_encode
+from hashlib import md5
+import unittest2
+import psycopg2
+import urllib2
+import base64
+import re
+import os
+
+
+def url_access(url, data="", method="GET", auth=None):
+    opener = urllib2.build_opener(urllib2.HTTPHandler)
+    request = urllib2.Request(url, data)
+    request.get_method = lambda: method
+    if auth is not None:
+        request.add_header("Authorization",
+                           "Basic " + base64.b64encode(auth))
+    return opener.open(request)
+
+
+class TestMetrics(unittest2.TestCase):
+
+    base = None
+    conn = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base = os.environ["MINITREE_SERVER"]
+        cls.conn = psycopg2.connect(os.environ["MINITREE_DSN"])
+        url_access(cls.base + "/node/test/table/",
+                   json_encode(dict(key1="value1")), method="PUT").read()
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = cls.conn.cursor()
+        cursor.execute("DROP SCHEMA test CASCADE")
+        cls.conn.commit()
+
+    def roundtrips(self, verb, method):
+        ret = url_access(self.base + "/metrics").read()
+        match = re.search(r'^minitree_request_db_roundtrips_sum'
+                          r'\{verb="%s",method="%s"\} (\S+)$' % (verb, method),
+                          ret, re.M)
+        return match and float(match.group(1)) or 0
+
+    def test_metrics_request(self):
+        url_access(self.base + "/node/test/table?method=override").read()
+        ret = url_access(self.base + "/metrics").read()
+        self.assertTrue('minitree_request_seconds_count'
+                        '{verb="GET",method="override"}' in ret)
+        self.assertTrue('minitree_request_db_roundtrips_bucket'
+                        '{verb="GET",method="override",le="+Inf"}' in ret)
+        self.assertTrue('minitree_db_connections{state="idle"}' in ret)
+
+    @unittest2.skipUnless(os.environ.get("MINITREE_ADMIN"),
+                          "MINITREE_ADMIN is not set to user:password")
+    def test_metrics_roundtrips_authenticated(self):
+        admin = os.environ["MINITREE_ADMIN"]
+        url_access(self.base + "/node/_meta/users/roundtrips",
+                   json_encode(dict(password=md5("secret").hexdigest(),
+                                    ns="test")),
+                   method="PUT", auth=admin).read()
+        try:
+            url = self.base + "/node/test/table?method=combo"
+            before = self.roundtrips("GET", "combo")
+            url_access(url, auth="roundtrips:secret").read()
+            user_trips = self.roundtrips("GET", "combo") - before
+            url_access(url, auth=admin).read()
+            admin_trips = self.roundtrips("GET", "combo") - before - \
+                user_trips
+            # the user is read first, then the node as for the admin
+            self.assertTrue(user_trips > admin_trips)
+        finally:
+            url_access(self.base + "/node/_meta/users/roundtrips",
+                       method="DELETE", auth=admin).read()
+
+    def test_metrics_error(self):
+        try:
+            url_access(self.base + "/node/test/table/nonexists").read()
+        except urllib2.HTTPError as e:
+            self.assertEqual(e.code, 404)
+        ret = url_access(self.base + "/metrics").read()
+        self.assertTrue('minitree_request_errors_total'
+                        '{error="NodeNotFound"}' in ret)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -3,8 +3,15 @@ from cjson import decode as json_decode, encode as json_encode
 import unittest2
 import psycopg2
 import urllib2
+import threading
+import zlib
 import os
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 def url_access(url, data="", method="GET"):
     opener = urllib2.build_opener(urllib2.HTTPHandler)
@@ -109,6 +116,75 @@ class TestSelectFunctions(unittest2.TestCase):
                           'test.table.a.c',
                           'test.table.a.c.d'])
 
+    def test_select_descendants_page(self):
+        url = self.base + "/node/test/table/a?method=descendants&limit=2"
+        data = json_decode(url_access(url).read())
+        self.assertEqual(data["items"], ['test.table.a.b', 'test.table.a.c'])
+        self.assertTrue(data["cursor"])
+
+        data = json_decode(url_access(url + "&cursor=" +
+                                      data["cursor"]).read())
+        self.assertEqual(data["items"], ['test.table.a.c.d'])
+        self.assertEqual(data["cursor"], None)
+
+    def test_select_children_page_invalid_cursor(self):
+        code = 200
+        try:
+            url_access(self.base + "/node/test/table/a?method=children"
+                       "&limit=1&cursor=%2A%2A").read()
+        except urllib2.HTTPError as e:
+            code = e.code
+
+        self.assertEqual(code, 400)
+
+    def test_select_descendants_gzip(self):
+        request = urllib2.Request(
+            self.base + "/node/test/table/a?method=descendants",
+            headers={"Accept-Encoding": "gzip"})
+        response = urllib2.urlopen(request)
+        self.assertEqual(response.info().getheader("Content-Encoding"),
+                         "gzip")
+        data = json_decode(zlib.decompress(response.read(),
+                                           16 + zlib.MAX_WBITS))
+        self.assertEqual(data,
+                         ['test.table.a.b',
+                          'test.table.a.c',
+                          'test.table.a.c.d'])
+
+    @unittest2.skipUnless(msgpack, "msgpack is not installed")
+    def test_select_node_msgpack(self):
+        for url, headers in (("/node/test/table/a/b.msgpack", {}),
+                             ("/node/test/table/a/b", {
+                        "Accept": "application/x-msgpack"})):
+            response = urllib2.urlopen(
+                urllib2.Request(self.base + url, headers=headers))
+            self.assertEqual(response.info().getheader("Content-Type"),
+                             "application/x-msgpack")
+            data = msgpack.unpackb(response.read())
+            self.assertEqual(data["key1"], "value1-3")
+
+    @unittest2.skipUnless(msgpack, "msgpack is not installed")
+    def test_select_descendants_msgpack(self):
+        response = url_access(self.base + "/node/test/table/a.msgpack"
+                              "?method=descendants")
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(response.read())
+        self.assertEqual(list(unpacker),
+                         ['test.table.a.b',
+                          'test.table.a.c',
+                          'test.table.a.c.d'])
+
+    def test_select_node_etag_format(self):
+        url = self.base + "/node/test/table/a/b"
+        etag = url_access(url).info().getheader("ETag")
+        request = urllib2.Request(url, headers={
+                "Accept-Encoding": "gzip"})
+        self.assertNotEqual(urllib2.urlopen(request).info().getheader("ETag"),
+                            etag)
+        if msgpack is not None:
+            response = url_access(url + ".msgpack")
+            self.assertNotEqual(response.info().getheader("ETag"), etag)
+
     def test_select_descendants_nonexists(self):
         code = 200
         try:
@@ -150,6 +226,91 @@ class TestSelectFunctions(unittest2.TestCase):
         self.assertEqual(data["key5"], ["value5"])
         self.assertEqual(data["key6"], [u"中文测试"])
 
+    def test_select_node_rcombo(self):
+        ret = url_access(self.base +
+                         "/node/test/table/a?method=rcombo").read()
+        data = json_decode(ret)
+        self.assertEqual(data["key1"], ["value1-2", "value1-3", "value1-3",
+                                        "value1-3"])
+        self.assertEqual(data["key4"], ["value4-2"])
+        self.assertFalse("key6" in data)
+
+    def test_select_node_tree(self):
+        ret = url_access(self.base + "/node/test/table/a?method=tree").read()
+        data = json_decode(ret)
+        self.assertEqual(data["value"]["key1"], "value1-2")
+        self.assertEqual(sorted(data["children"].keys()), ["b", "c"])
+        self.assertEqual(data["children"]["c"]["children"]["d"]["value"],
+                         dict(key1="value1-3", key2="value2-2",
+                              key3="value3"))
+
+        ret = url_access(self.base +
+                         "/node/test/table/a?method=tree&depth=1").read()
+        data = json_decode(ret)
+        self.assertEqual(data["children"]["c"]["children"], {})
+
+    def test_select_node_concurrent(self):
+        def _get(path):
+            try:
+                results.append(url_access(self.base + path).read())
+            except urllib2.HTTPError as e:
+                results.append(e.code)
+
+        for path, expected in (("/node/test/table/a/b?method=override",
+                                "value4-2"),
+                               ("/node/test/table/x/y/z", None)):
+            results = []
+            threads = [threading.Thread(target=_get, args=(path,))
+                       for i in range(8)]
+            map(lambda x: x.start(), threads)
+            map(lambda x: x.join(), threads)
+            self.assertEqual(len(results), 8)
+            for ret in results:
+                if expected is None:
+                    self.assertEqual(ret, 404)
+                else:
+                    self.assertEqual(json_decode(ret)["key4"], expected)
+
+    def test_select_node_not_modified(self):
+        url = self.base + "/node/test/table/a/b"
+        response = url_access(url)
+        etag = response.info().getheader("ETag")
+        modified = response.info().getheader("Last-Modified")
+        self.assertTrue(etag)
+        self.assertTrue(modified)
+
+        for header, value in (("If-None-Match", etag),
+                              ("If-Modified-Since", modified)):
+            code = 200
+            request = urllib2.Request(url, headers={header: value})
+            try:
+                ret = urllib2.urlopen(request).read()
+            except urllib2.HTTPError as e:
+                code = e.code
+                ret = e.read()
+            self.assertEqual(code, 304)
+            self.assertEqual(ret, "")
+
+    def test_select_override_not_modified(self):
+        url = self.base + "/node/test/table/a/b?method=override"
+        response = url_access(url)
+        etag = response.info().getheader("ETag")
+        self.assertTrue(etag)
+        self.assertEqual(response.info().getheader("Last-Modified"), None)
+
+        request = urllib2.Request(url, headers={"If-None-Match": etag})
+        code = 200
+        try:
+            urllib2.urlopen(request).read()
+        except urllib2.HTTPError as e:
+            code = e.code
+        self.assertEqual(code, 304)
+
+        # only the ETag validates a value read from several rows
+        request = urllib2.Request(url, headers={
+                "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        self.assertEqual(urllib2.urlopen(request).getcode(), 200)
+
     def test_select_node_non_exist(self):
         code = 200
         try:
@@ -2,6 +2,7 @@
 from cjson import decode as json_decode, encode as json_encode
 import unittest2
 import psycopg2
+import threading
 import urllib2
 import os
 
@@ -55,6 +56,53 @@ class TestUpdateFunctions(unittest2.TestCase):
     def setUp(self):
         pass
 
+    def test_update_node_etag(self):
+        url = self.base + "/node/test/table/a/c/d?method=override"
+        etag = url_access(url).info().getheader("ETag")
+        url_access(self.base + "/node/test/table/a",
+                   json_encode(dict(key7="value7")), method="POST").read()
+
+        response = urllib2.urlopen(
+            urllib2.Request(url, headers={"If-None-Match": etag}))
+        data = json_decode(response.read())
+        self.assertEqual(response.getcode(), 200)
+        self.assertNotEqual(response.info().getheader("ETag"), etag)
+        self.assertEqual(data["key7"], "value7")
+
+    def test_update_node_watch(self):
+        ret = url_access(self.base + "/node/test/table/a?watch=0").read()
+        data = json_decode(ret)
+        self.assertEqual(data["changed"], [])
+
+        url_access(self.base + "/node/test/table/a/b",
+                   json_encode(dict(key8="value8")), method="POST").read()
+        ret = url_access(self.base + "/node/test/table/a?watch=10&since="
+                         + data["token"]).read()
+        data = json_decode(ret)
+        self.assertTrue("test.table.a.b" in data["changed"])
+
+    def test_update_node_concurrent(self):
+        def _post(data):
+            results.append(url_access(self.base + "/node/test/table/a/b",
+                                      json_encode(data),
+                                      method="POST").read())
+
+        results = []
+        threads = [threading.Thread(target=_post,
+                                    args=(dict(key8="value8-%d" % i),))
+                   for i in range(8)]
+        threads += [threading.Thread(target=_post,
+                                     args=(dict(key9="value9"),))]
+        map(lambda x: x.start(), threads)
+        map(lambda x: x.join(), threads)
+        for ret in results:
+            self.assertTrue("1 node" in ret)
+        data = json_decode(url_access(self.base +
+                                      "/node/test/table/a/b").read())
+        self.assertTrue(data["key8"].startswith("value8-"))
+        self.assertEqual(data["key9"], "value9")
+        self.assertEqual(data["key3"], "value3")
+
     def test_update_node_non_exist(self):
         code = 200
         date = "{}"
@@ -1,6 +1,6 @@
 from zope.interface import implements
 
-from twisted.python import usage
+from twisted.python import usage, log
 from twisted.plugin import IPlugin
 from twisted.application.service import IServiceMaker
 from twisted.application import internet
@@ -13,6 +13,11 @@ class Options(usage.Options):
         ["config", "c", "etc/default.ini",
          "Path (or name) of minitree configuration."],
         ["port", "p", 0, "The port number to listen on."],
+        ["workers", "w", 0,
+         "Number of worker processes sharing the socket. Overrides "
+         "server:main workers"],
+        ["fd", None, None,
+         "Serve on this inherited listening socket, as a worker."],
     ]
 
 
@@ -29,26 +34,136 @@ class MiniTreeServiceMaker(object):
         from minitree import configure
         c = configure(options["config"])
 
+        workers = int(options["workers"] or c.get("server:main", "workers"))
+        if workers and c.get("backend:main", "type") == "memory":
+            raise usage.UsageError("workers cannot share a memory backend")
+        if workers and float(c.get("server:main", "watch_timeout")):
+            # a watch token names a position in the changes one process saw
+            c.set("server:main", "watch_timeout", "0")
+            if options["fd"] is None:
+                log.msg("Watching is turned off, workers cannot share "
+                        "watch tokens")
+        if workers and options["fd"] is None:
+            return self.makeSupervisor(options, c, workers)
+
         from twisted.internet import reactor
         reactor.suggestThreadPoolSize(int(c.get("server:main", "max_threads")))
-        from txpostgres import txpostgres
-        txpostgres.ConnectionPool.min = int(c.get("backend:main",
-                                                  "max_connections"))
-
-        from minitree.db.postgres import dbBackend
-        dbBackend.connect(c.get("backend:main", "dsn"))
+        backend = c.get("backend:main", "type")
+        if backend == "memory":
+            from minitree.db.memory import MemoryBackend
+            backend = MemoryBackend()
+        elif backend == "postgres":
+            backend = self.makePostgres(c, workers)
+        else:
+            raise usage.UsageError("unknown backend type %s" % backend)
 
         from minitree.service import site_configure
-        site_root = site_configure(c)
+        site_root = site_configure(c, backend)
         from twisted.web import server
         site = server.Site(site_root)
 
+        if options["fd"] is not None:
+            import socket
+            from minitree.service.workers import AdoptedPort
+            if options["socket"]:
+                family = socket.AF_UNIX
+            else:
+                family = socket.AF_INET
+            return AdoptedPort(int(options["fd"]), family, site)
         if "socket" in options and options["socket"]:
             return internet.UNIXServer(options["socket"], site)
         else:
             return internet.TCPServer(int(options["port"] or
                                           c.get("server:main", "port")), site)
 
+    def makePostgres(self, c, workers):
+        """
+        Connect the Postgres backend as configured in `c`, serving the
+        mirrored collections from memory if any.
+        """
+        from txpostgres import txpostgres
+        # workers share max_connections
+        txpostgres.ConnectionPool.min = max(
+            1, int(c.get("backend:main", "max_connections")) //
+            max(workers, 1))
+
+        from minitree.db.postgres import dbBackend
+        d = dbBackend.connect(c.get("backend:main", "dsn"))
+        d.addCallback(lambda _: dbBackend.watchTables(
+                int(c.get("backend:main", "tables_refresh"))))
+        materialized = filter(None, map(
+                lambda x: x.strip(),
+                c.get("backend:main", "materialized").split(",")))
+        if materialized:
+            d.addCallback(lambda _: dbBackend.materialize(materialized))
+        prepared = int(c.get("backend:main", "prepared_statements"))
+        if prepared:
+            dbBackend.enablePrepared(prepared)
+        update_delay = float(c.get("backend:main", "update_batch_delay"))
+        if update_delay:
+            dbBackend.enableGroupCommit(
+                update_delay / 1000.0,
+                int(c.get("backend:main", "update_batch_size")))
+        cache_size = int(c.get("backend:main", "cache_size"))
+        if cache_size:
+            dbBackend.enableCache(cache_size)
+        mirrored = filter(None, map(
+                lambda x: x.strip(),
+                c.get("backend:main", "mirrored").split(",")))
+        replicas = [x for x in c.sections()
+                    if x.startswith("backend:replica")]
+        # replica reads need to hear of the writes of other processes too
+        if cache_size or mirrored or replicas or \
+                int(c.get("server:main", "auth_cache_size")) or \
+                float(c.get("server:main", "watch_timeout")):
+            dbBackend.listen(c.get("backend:main", "dsn"))
+
+        for section in replicas:
+            # a replica section gives a dsn, or the parts of one
+            if c.has_option(section, "dsn"):
+                dsn = c.get(section, "dsn")
+            else:
+                dsn = c.get("backend:main", "dsn",
+                            vars=dict(c.items(section)))
+            dbBackend.addReplica(dsn)
+        if replicas:
+            dbBackend.watchReplicas(
+                float(c.get("backend:main", "replica_check")),
+                float(c.get("backend:main", "replica_window")))
+        if mirrored:
+            from minitree.db.mirror import Mirror
+            backend = Mirror(dbBackend, mirrored)
+            d.addCallback(lambda _: backend.start(
+                    float(c.get("backend:main", "mirror_poll")),
+                    float(c.get("backend:main", "mirror_retention"))))
+            return backend
+        return dbBackend
+
+    def makeSupervisor(self, options, c, workers):
+        """
+        Bind the socket and run `workers` copies of this plugin on it,
+        each with a reactor and database pool of its own.
+        """
+        from minitree.service.workers import WorkerSupervisor
+        from minitree.service.workers import listeningSocket
+        import sys
+        import os
+
+        sock = listeningSocket(int(options["port"] or
+                                   c.get("server:main", "port")),
+                               options["socket"])
+
+        def args(fd):
+            args = [sys.executable, os.path.abspath(sys.argv[0]),
+                    "--nodaemon", "--pidfile=", self.tapname,
+                    "--config", os.path.abspath(options["config"]),
+                    "--workers", str(workers), "--fd", str(fd)]
+            if options["socket"]:
+                args.extend(["--socket", options["socket"]])
+            return args
+
+        return WorkerSupervisor(workers, sock, args)
+
 
 # Now construct an object which *provides* the relevant interfaces
 # The name of this variable is irrelevant, as long as there is *some*